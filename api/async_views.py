@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# async forms of the ingest and polling views, used instead of the ones in
+#   views when WHINBOX_ASYNC_VIEWS is set. served by an asgi server
+#   (server/asgi.py), a worker keeps many of these in flight at once.
+#   requests are parsed and responses built by the helpers in views, so
+#   only the backend calls differ
+
+import functools
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseNotAllowed
+from . import backend, views
+from .views import _backend_error, _parse_create, _inbox_response, _parse_respond, _publish_response, _hit_retry, _parse_hit, _publish_hit, _hit_response, _parse_items, _items_response, _stream_response
+
+# the async calls of the backend, run in a thread. for async views served
+#   over wsgi, where every request gets an event loop of its own and a
+#   native client would make a connection pool for each
+class _ThreadedOps(object):
+	def __init__(self, db):
+		self.db = db
+
+	def __getattr__(self, name):
+		return functools.partial(getattr(backend.Backend, name), self.db)
+
+def _get_db(req):
+	if isinstance(req, ASGIRequest):
+		return views.db
+	return _ThreadedOps(views.db)
+
+async def create(req):
+	if req.method == 'POST':
+		error, args = _parse_create(req)
+		if error is not None:
+			return error
+
+		try:
+			args['id'] = await _get_db(req).inbox_create_async(args['id'], args['ttl'], args['response_mode'], args['body_max'], args['wait_timeout'])
+		except Exception as e:
+			return _backend_error(e)
+
+		return _inbox_response(req, args['id'], args)
+	else:
+		return HttpResponseNotAllowed(['POST'])
+
+async def respond(req, inbox_id, item_id):
+	if req.method == 'POST':
+		error, format = _parse_respond(req)
+		if error is not None:
+			return error
+
+		try:
+			await _get_db(req).request_remove_pending_async(inbox_id, item_id)
+		except Exception as e:
+			return _backend_error(e)
+
+		_publish_response(inbox_id, item_id, format)
+
+		return HttpResponse('Ok\n')
+	else:
+		return HttpResponseNotAllowed(['POST'])
+
+async def hit(req, inbox_id):
+	resp = _hit_retry(req)
+	if resp is not None:
+		return resp
+
+	ops = _get_db(req)
+	try:
+		inbox = await ops.inbox_get_async(inbox_id)
+	except Exception as e:
+		return _backend_error(e)
+
+	error, hit = _parse_hit(req, inbox)
+	if error is not None:
+		return error
+
+	try:
+		item_id, prev_id, item_created = await ops.inbox_ingest_item_async(inbox_id, hit.item, hit.body)
+	except Exception as e:
+		return _backend_error(e)
+
+	_publish_hit(inbox_id, hit, item_id, prev_id, item_created)
+
+	wait_timeout = inbox.get('wait_timeout')
+	if not hit.respond_now:
+		await ops.request_add_pending_async(inbox_id, item_id, wait_timeout)
+	return _hit_response(req, inbox_id, hit, wait_timeout)
+
+async def items(req, inbox_id):
+	if req.method == 'GET':
+		error, args = _parse_items(req)
+		if error is not None:
+			return error
+		item_id, imax, order = args
+
+		# reading the items also refreshes the inbox
+		try:
+			result = await _get_db(req).inbox_read_items_async(inbox_id, item_id, imax, reverse=(order == '-created'))
+		except Exception as e:
+			return _backend_error(e)
+
+		return _items_response(req, inbox_id, order, result)
+	else:
+		return HttpResponseNotAllowed(['GET'])
+
+async def stream(req, inbox_id):
+	if req.method == 'GET':
+		try:
+			await _get_db(req).inbox_get_async(inbox_id)
+		except Exception as e:
+			return _backend_error(e)
+
+		return _stream_response(req, inbox_id)
+	else:
+		return HttpResponseNotAllowed(['GET'])
@@ -0,0 +1,327 @@
+from datetime import datetime
+import calendar
+import json
+import random
+import string
+import threading
+import time
+import zlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+def _setting(name, default):
+	v = getattr(settings, name, None)
+	if v is None:
+		return default
+	return v
+
+def _json_dumps(v):
+	if orjson is not None:
+		return orjson.dumps(v)
+	return json.dumps(v, separators=(',', ':')).encode('utf-8')
+
+def _json_loads(s):
+	if orjson is not None:
+		return orjson.loads(s)
+	return json.loads(s)
+
+# fields that are filled in per read rather than stored with the item
+_dynamic_fields = ('id', 'created', 'state', '_fields')
+
+# the item's stored fields as the inside of a json object, so that they
+#   can be spliced in after the dynamic ones. items that were rendered
+#   before carry the result in '_fields'
+def render_item_fields(item):
+	fields = item.get('_fields')
+	if fields is None:
+		fields = _json_dumps(dict((k, v) for k, v in item.items() if k not in _dynamic_fields)).decode('utf-8')[1:-1]
+	return fields
+
+class InvalidId(Exception):
+	pass
+
+class ObjectExists(Exception):
+	pass
+
+class ObjectDoesNotExist(Exception):
+	pass
+
+# storage operations used by the api. item ids and cursors are opaque
+#   strings whose format is up to the backend
+class Backend(object):
+	def __init__(self):
+		self.item_max = _setting('WHINBOX_ITEM_MAX', 100)
+		self.item_burst_time = _setting('WHINBOX_ITEM_BURST_TIME', 120)
+		self.item_burst_max = _setting('WHINBOX_ITEM_BURST_MAX', 1200)
+		self.expire_batch_size = _setting('WHINBOX_EXPIRE_BATCH_SIZE', 100)
+		self.expire_time_budget = _setting('WHINBOX_EXPIRE_TIME_BUDGET', 5)
+		# reads only refresh an inbox once no more than this fraction of
+		#   its ttl is left, so an inbox read at least every fraction * ttl
+		#   seconds never expires. with 0 a read would never refresh, so
+		#   it is kept to at least 0.1
+		self.refresh_fraction = min(max(_setting('WHINBOX_REFRESH_FRACTION', 0.9), 0.1), 1)
+		# deadlines are kept in this many schedules, split by a hash of the
+		#   inbox id, so that cleanup workers can share them out
+		self.partitions = _setting('WHINBOX_CLEANUP_PARTITIONS', 1)
+		# seconds a request to a wait-mode inbox is held for a response,
+		#   unless the inbox sets its own
+		self.wait_timeout = _setting('WHINBOX_WAIT_TIMEOUT', 20)
+
+	@staticmethod
+	def _gen_id():
+		return ''.join(random.choice(string.ascii_letters + string.digits) for n in range(8))
+
+	@staticmethod
+	def _validate_id(id):
+		for c in id:
+			if c not in string.ascii_letters and c not in string.digits and c not in '_-@':
+				raise InvalidId('id contains invalid character: %s' % c)
+
+	@staticmethod
+	def _timestamp_utcnow():
+		return calendar.timegm(datetime.utcnow().utctimetuple())
+
+	# request deadlines keep fractions of a second, so that held senders
+	#   are let go on time
+	@staticmethod
+	def _timestamp_precise():
+		return time.time()
+
+	# return the schedule partition of an inbox
+	def _partition(self, id):
+		if self.partitions <= 1:
+			return 0
+		return zlib.crc32(id.encode('utf-8')) % self.partitions
+
+	# return the partitions to work on: the one given, or all of them
+	def _partition_list(self, partition):
+		if partition is not None:
+			return [partition]
+		return range(0, self.partitions)
+
+	# calls take_batch(limit) until it comes up short or the time budget
+	#   is used up
+	# return list of batches
+	def _take_batches(self, take_batch, batch_size, time_budget):
+		if batch_size is None:
+			batch_size = self.expire_batch_size
+		if time_budget is None:
+			time_budget = self.expire_time_budget
+		deadline = time.monotonic() + time_budget
+		out = list()
+		while True:
+			batch = take_batch(batch_size)
+			if len(batch) > 0:
+				out.append(batch)
+			if len(batch) < batch_size or time.monotonic() >= deadline:
+				break
+		return out
+
+	# if id=None, then a random id will be used. body_max is an optional
+	#   cap on captured request bodies, in bytes, and wait_timeout an
+	#   optional hold time for requests awaiting a response, in seconds
+	# return the id used
+	def inbox_create(self, id, ttl, response_mode, body_max=None, wait_timeout=None):
+		raise NotImplementedError()
+
+	def inbox_delete(self, id):
+		raise NotImplementedError()
+
+	# return dict with ttl, response_mode, and body_max and wait_timeout if
+	#   set
+	def inbox_get(self, id):
+		raise NotImplementedError()
+
+	def inbox_refresh(self, id, newttl=None):
+		raise NotImplementedError()
+
+	# return dict of inbox cache counters, or None if there is no cache
+	def inbox_cache_stats(self):
+		return None
+
+	# the cleanup calls below work on one schedule partition, or on all of
+	#   them if partition is None
+
+	# return timestamp of the soonest inbox expiration, or None
+	def inbox_next_expiration(self, partition=None):
+		raise NotImplementedError()
+
+	# return list of batches, each a list of inbox values
+	def inbox_take_expired(self, batch_size=None, time_budget=None, partition=None):
+		raise NotImplementedError()
+
+	# return timestamp at which the first inbox left above item_max is due
+	#   to be trimmed, or None
+	def inbox_next_dirty(self, partition=None):
+		raise NotImplementedError()
+
+	# return ids of all inboxes
+	def inbox_get_all(self):
+		return set(self.inbox_iter_all())
+
+	# iterate over ids of all inboxes
+	def inbox_iter_all(self):
+		raise NotImplementedError()
+
+	# append an item without trimming. if body is set, it is stored apart
+	#   from the item and removed along with it
+	# return (item id, prev_id, created)
+	def inbox_append_item(self, id, item, body=None):
+		raise NotImplementedError()
+
+	# append an item and trim the inbox in one step
+	# return (item id, prev_id, created)
+	def inbox_ingest_item(self, id, item, body=None):
+		raise NotImplementedError()
+
+	# return the body stored apart from an item
+	def inbox_get_item_body(self, id, item_id):
+		raise NotImplementedError()
+
+	# fetch a page of items, optionally refreshing the inbox (subject to
+	#   refresh_fraction), in one step. if reverse is set, items are
+	#   returned newest first
+	# return (list, last_id, eof, set of pending item ids)
+	def inbox_read_items(self, id, item_id, item_max, reverse=False, refresh=True):
+		raise NotImplementedError()
+
+	# return (list, last_id)
+	def inbox_get_items_after(self, id, item_id, item_max):
+		items, last_id, _, _ = self.inbox_read_items(id, item_id, item_max, refresh=False)
+		return (items, last_id)
+
+	# return (list, last_id, eof)
+	def inbox_get_items_before(self, id, item_id, item_max):
+		items, last_id, eof, _ = self.inbox_read_items(id, item_id, item_max, reverse=True, refresh=False)
+		return (items, last_id, eof)
+
+	# return id of the newest item, or '' if the inbox is empty
+	def inbox_get_newest_id(self, id):
+		raise NotImplementedError()
+
+	# return (first id, last id) of the items created within [start, end],
+	#   or None if there are no such items
+	def inbox_get_item_range_by_time(self, id, start=None, end=None):
+		raise NotImplementedError()
+
+	# apply the item_max and burst policy to one inbox
+	# return number of items removed
+	def inbox_clear_expired_items(self, id):
+		raise NotImplementedError()
+
+	# apply the item policy to inboxes that were left above item_max
+	# return (items trimmed, inboxes visited)
+	def inbox_clear_dirty_items(self, batch_size=None, time_budget=None, partition=None):
+		raise NotImplementedError()
+
+	# timeout is in seconds, wait_timeout if None
+	def request_add_pending(self, inbox_id, item_id, timeout=None):
+		raise NotImplementedError()
+
+	def request_remove_pending(self, inbox_id, item_id):
+		raise NotImplementedError()
+
+	def request_is_pending(self, inbox_id, item_id):
+		return item_id in self.request_get_pending(inbox_id, [item_id])
+
+	# return the subset of item_ids that have pending requests
+	def request_get_pending(self, inbox_id, item_ids):
+		raise NotImplementedError()
+
+	# return list of batches, each a list((inbox_id, item_id))
+	def request_take_expired(self, batch_size=None, time_budget=None, partition=None):
+		raise NotImplementedError()
+
+	# return timestamp of the soonest request expiration, or None
+	def request_next_expiration(self, partition=None):
+		raise NotImplementedError()
+
+	# claim a fair share of the schedule partitions, given the other
+	#   workers claiming them. owner is unique to the worker. claims lapse
+	#   after lease_time seconds unless renewed by calling again, so the
+	#   partitions of a worker that died are taken over by the others
+	# return list of partitions held
+	def cleanup_claim_partitions(self, owner, lease_time):
+		return list(range(0, self.partitions))
+
+	def cleanup_release_partitions(self, owner):
+		pass
+
+	# move scheduled deadlines laid out for old_partitions partitions into
+	#   the current layout
+	# return number of deadlines moved
+	def cleanup_repartition(self, old_partitions):
+		return 0
+
+	# move scheduled deadlines into the current layout if they were laid
+	#   out for another partition count by the last cleanup run, and
+	#   record the current count
+	# return (previous partition count, number of deadlines moved)
+	def cleanup_migrate_layout(self):
+		return (self.partitions, 0)
+
+	# with keys that expire on their own, call on_expired(partition) from
+	#   a background thread whenever an inbox expires, so that cleanup can
+	#   act on it right away. notifications can be lost, so the schedules
+	#   still need sweeping now and then
+	# return True if the listener was started
+	def inbox_watch_expired(self, on_expired):
+		return False
+
+	# block until a deadline sooner than the earliest of its schedule is
+	#   added (inbox, dirty or request expiration), or the timeout passes
+	# return True if woken early
+	def schedule_wait(self, timeout):
+		time.sleep(timeout)
+		return False
+
+	# async forms of the calls made by the async views. unless a backend
+	#   has a native async client, the blocking call runs in a thread
+
+	async def inbox_create_async(self, id, ttl, response_mode, body_max=None, wait_timeout=None):
+		return await sync_to_async(self.inbox_create, thread_sensitive=False)(id, ttl, response_mode, body_max, wait_timeout)
+
+	async def inbox_get_async(self, id):
+		return await sync_to_async(self.inbox_get, thread_sensitive=False)(id)
+
+	async def inbox_ingest_item_async(self, id, item, body=None):
+		return await sync_to_async(self.inbox_ingest_item, thread_sensitive=False)(id, item, body)
+
+	async def inbox_read_items_async(self, id, item_id, item_max, reverse=False, refresh=True):
+		return await sync_to_async(self.inbox_read_items, thread_sensitive=False)(id, item_id, item_max, reverse, refresh)
+
+	async def request_add_pending_async(self, inbox_id, item_id, timeout=None):
+		return await sync_to_async(self.request_add_pending, thread_sensitive=False)(inbox_id, item_id, timeout)
+
+	async def request_remove_pending_async(self, inbox_id, item_id):
+		return await sync_to_async(self.request_remove_pending, thread_sensitive=False)(inbox_id, item_id)
+
+_backend = None
+_lock = threading.Lock()
+
+def _create_backend():
+	name = _setting('WHINBOX_BACKEND', 'redis')
+	if name == 'memory':
+		from . import memory_ops
+		return memory_ops.MemoryOps(cleanup=True)
+	elif name == 'redis':
+		from . import redis_ops
+		return redis_ops.get_ops()
+	else:
+		raise ValueError('unknown backend: %s' % name)
+
+# shared instance for views, util and management commands
+def get_backend():
+	global _backend
+	b = _backend
+	if b is None:
+		with _lock:
+			if _backend is None:
+				_backend = _create_backend()
+			b = _backend
+	return b
@@ -0,0 +1,80 @@
+import json
+import time
+import zlib
+from base64 import b64encode
+from django.core.management.base import BaseCommand
+from api import backend
+from api.backend import render_item_fields
+from api.redis_ops import encode_item, decode_item
+
+# headers of a typical webhook delivery
+_headers = [
+	['Accept', '*/*'],
+	['Content-Type', 'application/json'],
+	['Host', 'api.webhookinbox.com'],
+	['User-Agent', 'GitHub-Hookshot/5b6e2d4'],
+	['X-Forwarded-For', '203.0.113.7'],
+	['X-Github-Delivery', '72d3162e-cc78-11e3-81ab-4c9367dc0958'],
+	['X-Github-Event', 'push'],
+	['X-Hub-Signature-256', 'sha256=d57c68ca6f92289e6987922ff26938930f6e66a2d161ef06abdf1859230aa23c']
+]
+
+def _make_item(body, binary):
+	item = dict()
+	item['method'] = 'POST'
+	item['path'] = '/i/wHfZqg3u/in/'
+	item['headers'] = list(_headers) + [['Content-Length', str(len(body))]]
+	if binary:
+		item['body-bin'] = b64encode(body).decode('ascii')
+	else:
+		item['body'] = body.decode('utf-8')
+	item['ip_address'] = '203.0.113.7'
+	item['type'] = 'normal'
+	item['created'] = 1700000000
+	return item
+
+class Command(BaseCommand):
+	help = 'Compare stored item size and codec speed of the item encodings'
+
+	def add_arguments(self, parser):
+		parser.add_argument('file', help='File of sample request bodies, one per line (e.g. a .jsonl file)')
+		parser.add_argument('--rounds', type=int, default=20, help='Times to decode each item')
+
+	def handle(self, *args, **options):
+		with open(options['file'], 'rb') as f:
+			bodies = [line.rstrip(b'\n') for line in f if line.strip()]
+		if not bodies:
+			print('no sample bodies')
+			return
+
+		# each sample body as text, and compressed to stand in for a
+		#   binary payload
+		samples = [('text', [_make_item(b, False) for b in bodies])]
+		samples.append(('binary', [_make_item(zlib.compress(b), True) for b in bodies]))
+
+		rounds = options['rounds']
+		print('%d sample bodies, %d rounds, json library: %s' % (len(bodies), rounds, 'orjson' if backend.orjson is not None else 'json'))
+		for name, items in samples:
+			for encoding in ('json', 'compact', 'rendered'):
+				start = time.time()
+				data = [encode_item(i, encoding) for i in items]
+				encode_time = time.time() - start
+
+				# what a read does per item: decode, then render the fields
+				#   for the response
+				start = time.time()
+				for n in range(0, rounds):
+					for d in data:
+						render_item_fields(decode_item(d))
+				read_time = time.time() - start
+
+				# must round trip, though field order may differ
+				assert([json.loads('{%s}' % render_item_fields(decode_item(d))) for d in data] == [json.loads('{%s}' % render_item_fields(i)) for i in items])
+
+				size = sum(len(d) for d in data)
+				print('%-6s %-8s %8.1f bytes/item, encode %6.2fus/item, read %6.2fus/item' % (
+					name,
+					encoding,
+					size / float(len(data)),
+					encode_time * 1000000 / len(data),
+					read_time * 1000000 / (len(data) * rounds)))
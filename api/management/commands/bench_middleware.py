@@ -0,0 +1,48 @@
+import logging
+import time
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+def _start_response(status, headers, exc_info=None):
+	pass
+
+class Command(BaseCommand):
+	help = 'Compare per-request overhead of the lean api middleware against running the full stack'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--host', default='api.localhost', help='Host header to send')
+		parser.add_argument('--path', default='/', help='Path to request (the api root does no storage work)')
+		parser.add_argument('--requests', type=int, default=20000, help='Requests per run')
+
+	def handle(self, *args, **options):
+		# everything on every request, as before the website chain was split
+		#   out
+		full = list()
+		for path in settings.MIDDLEWARE:
+			if path == 'api.middleware.WebsiteMiddleware':
+				full.extend(settings.WEBSITE_MIDDLEWARE)
+			else:
+				full.append(path)
+		stacks = (('full', full), ('lean', settings.MIDDLEWARE))
+
+		# the api root answers 404, which would otherwise be logged each time
+		logging.getLogger('django.request').setLevel(logging.ERROR)
+
+		environ = RequestFactory(HTTP_HOST=options['host']).get(options['path']).environ
+		count = options['requests']
+		times = dict()
+		for name, middleware in stacks:
+			with override_settings(MIDDLEWARE=middleware):
+				handler = WSGIHandler()
+			# warm up
+			for n in range(0, 100):
+				handler(dict(environ), _start_response)
+			start = time.time()
+			for n in range(0, count):
+				handler(dict(environ), _start_response)
+			times[name] = (time.time() - start) * 1000000 / count
+			print('%-4s %2d middleware %8.1fus/request' % (name, len(middleware), times[name]))
+		print('saved %.1fus/request (%.0f%%)' % (times['full'] - times['lean'], (times['full'] - times['lean']) * 100 / times['full']))
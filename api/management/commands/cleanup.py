@@ -1,16 +1,169 @@
+import os
+import socket
+import threading
 import time
+import uuid
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from api.backend import get_backend
+from api.publisher import get_publisher
 from api.util import expire_inboxes, expire_items, expire_requests
 
+def _setting(name, default):
+	v = getattr(settings, name, None)
+	if v is None:
+		return default
+	return v
+
+def _rate(count, elapsed):
+	if elapsed > 0:
+		return count / elapsed
+	return 0.0
+
+# one of the daemon's schedules. run(partition) returns the number of
+#   objects expired, and next_due(partition) the timestamp of the earliest
+#   deadline or None
+class _Job(object):
+	def __init__(self, name, run, next_due):
+		self.name = name
+		self.run = run
+		self.next_due = next_due
+		# seconds to hold off a run past the deadline, for schedules that
+		#   are mostly worked off as expirations are reported
+		self.delay = 0
+		# partition -> due timestamp
+		self.due = dict()
+		self.runs = 0
+		self.count = 0
+		self.elapsed = 0.0
+
+# a cleanup worker works on the schedule partitions it holds a lease on,
+#   so that several of them, in this process or others, share the work.
+#   it sleeps until the earliest deadline of any job, or until the
+#   backend reports that a sooner one was added. the schedules are also
+#   looked at every idle_max seconds in case a wakeup was missed
+class _Worker(object):
+	def __init__(self, db, label):
+		self.db = db
+		self.label = label
+		self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+		self.idle_max = _setting('WHINBOX_CLEANUP_IDLE_MAX', 60)
+		self.lease_time = _setting('WHINBOX_CLEANUP_LEASE_TIME', 30)
+		self.partitions = list()
+		self.lock = threading.Lock()
+		self.jobs = [
+			_Job('inboxes', lambda p: expire_inboxes(p)[0], db.inbox_next_expiration),
+			_Job('items', lambda p: expire_items(partition=p)[0], db.inbox_next_dirty),
+			_Job('requests', lambda p: expire_requests(p)[0], db.request_next_expiration)
+		]
+
+	def log(self, message):
+		print(self.label + message)
+
+	def _next_due(self, job, p):
+		due = job.next_due(p)
+		if due is not None:
+			due += job.delay
+		return due
+
+	# expire the inboxes of a partition reported by the backend, if this
+	#   worker holds it
+	# return True if held
+	def expire_reported(self, partition):
+		with self.lock:
+			if partition not in self.partitions:
+				return False
+		start = time.monotonic()
+		count = expire_inboxes(partition)[0]
+		if count > 0:
+			self.log('inboxes/%d: expired %d on notification (%.3fs)' % (partition, count, time.monotonic() - start))
+		return True
+
+	def run(self):
+		# renew well before the lease lapses
+		renew_interval = self.lease_time / 3
+		claimed = None
+		reschedule = True
+		while True:
+			try:
+				if claimed is None or time.monotonic() - claimed >= renew_interval:
+					partitions = self.db.cleanup_claim_partitions(self.owner, self.lease_time)
+					claimed = time.monotonic()
+					if partitions != self.partitions:
+						with self.lock:
+							self.partitions = partitions
+						self.log('holding partitions %s' % ','.join(str(p) for p in partitions))
+						reschedule = True
+
+				if reschedule:
+					for job in self.jobs:
+						job.due = dict((p, self._next_due(job, p)) for p in self.partitions)
+					reschedule = False
+
+				for job in self.jobs:
+					for p, due in list(job.due.items()):
+						if due is None or due > time.time():
+							continue
+						late = time.time() - due
+						start = time.monotonic()
+						count = job.run(p)
+						elapsed = time.monotonic() - start
+						job.runs += 1
+						job.count += count
+						job.elapsed += elapsed
+						self.log('%s/%d: expired %d (%.3fs, %.0f/s, %.3fs late; %d runs, %d expired, %.3fs total)' % (job.name, p, count, elapsed, _rate(count, elapsed), late, job.runs, job.count, job.elapsed))
+						job.due[p] = self._next_due(job, p)
+
+				wait = min(self.idle_max, claimed + renew_interval - time.monotonic())
+				for job in self.jobs:
+					for due in job.due.values():
+						if due is not None:
+							wait = min(wait, due - time.time())
+				if wait > 0:
+					if self.db.schedule_wait(wait):
+						reschedule = True
+				if wait >= self.idle_max:
+					reschedule = True
+			except Exception as e:
+				self.log('cleanup failed: %s' % repr(e))
+				time.sleep(1)
+				reschedule = True
+
 class Command(BaseCommand):
 	help = 'Background cleanup task'
 
+	def add_arguments(self, parser):
+		parser.add_argument('--full-sweep', action='store_true', help='Trim items of every inbox, not just queued ones')
+		parser.add_argument('--daemon', action='store_true', help='Keep running, waking up whenever something is due')
+		parser.add_argument('--workers', type=int, default=1, help='Daemon worker threads sharing the schedule partitions')
+		parser.add_argument('--repartition', type=int, metavar='OLD_PARTITIONS', help='Move scheduled deadlines from an old WHINBOX_CLEANUP_PARTITIONS value to the current one, then exit')
+
 	def handle(self, *args, **options):
-		inboxes = expire_inboxes()
-		print('expired %d inboxes' % inboxes)
+		if _setting('WHINBOX_BACKEND', 'redis') == 'memory':
+			print('nothing to do: the memory backend is cleaned up by the api process')
+			return
+
+		if options['repartition'] is not None:
+			moved = get_backend().cleanup_repartition(options['repartition'])
+			print('moved %d deadlines' % moved)
+			return
+
+		# the web workers may already be on a new partition count. until the
+		#   deadlines are moved over, an inbox refreshed since would still be
+		#   expired at its stale deadline
+		old_partitions, moved = get_backend().cleanup_migrate_layout()
+		if moved > 0:
+			print('moved %d deadlines from %d partitions' % (moved, old_partitions))
+
+		if options['daemon']:
+			self._run_daemon(options)
+			return
+
+		inboxes, batches, elapsed = expire_inboxes()
+		print('expired %d inboxes in %d batches (%.3fs, %.0f/s)' % (inboxes, batches, elapsed, _rate(inboxes, elapsed)))
 
 		# expire items of remaining inboxes
-		items, inboxes = expire_items()
+		items, inboxes = expire_items(full=options['full_sweep'])
 		print('expired %d items in %d active inboxes' % (items, inboxes))
 
 		# we expect this command to run once per minute, so to achieve
@@ -19,5 +172,57 @@ class Command(BaseCommand):
 		for n in range(0, 6):
 			if n != 0:
 				time.sleep(10)
-			requests = expire_requests()
-			print('expired %d requests' % requests)
+			requests, batches, elapsed = expire_requests()
+			print('expired %d requests in %d batches (%.3fs, %.0f/s)' % (requests, batches, elapsed, _rate(requests, elapsed)))
+
+		self._print_publisher_stats()
+
+	def _print_publisher_stats(self):
+		publisher = get_publisher()
+		publisher.flush(10)
+		stats = publisher.stats()
+		print('published %d items in %d batches (%d queued, %d dropped, %d failed, %d retries)' % (stats['sent'], stats['batches'], stats['depth'], stats['dropped'], stats['failed'], stats['retries']))
+
+	def _run_daemon(self, options):
+		db = get_backend()
+		if options['full_sweep']:
+			items, inboxes = expire_items(full=True)
+			print('expired %d items in %d active inboxes' % (items, inboxes))
+
+		count = options['workers']
+		workers = list()
+		for n in range(0, count):
+			if count > 1:
+				label = 'worker %d: ' % n
+			else:
+				label = ''
+			workers.append(_Worker(db, label))
+
+		# with keys expiring on their own, inboxes are cleaned up as redis
+		#   reports them gone, and the sweep only catches what was missed
+		def on_expired(partition):
+			for worker in workers:
+				if worker.expire_reported(partition):
+					break
+		if db.inbox_watch_expired(on_expired):
+			sweep_delay = _setting('WHINBOX_CLEANUP_SWEEP_DELAY', 60)
+			for worker in workers:
+				worker.jobs[0].delay = sweep_delay
+			print('expiring inboxes on notification, sweeping %ds behind' % sweep_delay)
+		for worker in workers[1:]:
+			thread = threading.Thread(target=worker.run)
+			thread.daemon = True
+			thread.start()
+		try:
+			workers[0].run()
+		except KeyboardInterrupt:
+			pass
+
+		# hand the partitions over right away rather than when the leases
+		#   lapse
+		for worker in workers:
+			try:
+				db.cleanup_release_partitions(worker.owner)
+			except Exception:
+				pass
+		self._print_publisher_stats()
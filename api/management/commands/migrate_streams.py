@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from api.redis_ops import RedisStreamOps
+
+class Command(BaseCommand):
+	help = 'Move inbox items from list storage to stream storage'
+
+	def handle(self, *args, **options):
+		db = RedisStreamOps()
+		inboxes = 0
+		items = 0
+		skipped = 0
+		busy = 0
+		for inbox in db.inbox_iter_all():
+			count = db.inbox_migrate_to_stream(inbox)
+			if count is None:
+				skipped += 1
+				continue
+			if count < 0:
+				busy += 1
+				continue
+			inboxes += 1
+			items += count
+		print('migrated %d items in %d inboxes (%d already using streams)' % (items, inboxes, skipped))
+		if busy > 0:
+			print('%d inboxes have requests waiting on a response. run again once they are answered or time out' % busy)
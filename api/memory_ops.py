@@ -0,0 +1,445 @@
+import bisect
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from .backend import Backend, InvalidId, ObjectExists, ObjectDoesNotExist
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# all state lives in the process, so this backend is only suitable for a
+#   single worker (development, CI, benchmarks). the cleanup command runs
+#   in a process of its own and can't see it, so inboxes and requests are
+#   expired by a thread of the api process instead
+
+class _Inbox(object):
+	def __init__(self, ttl, response_mode, body_max, wait_timeout, exp_time, item_cap):
+		self.ttl = ttl
+		self.response_mode = response_mode
+		self.body_max = body_max
+		self.wait_timeout = wait_timeout
+		self.exp_time = exp_time
+		# ring buffer of (created, item, body). an item's id is baseindex
+		#   plus its position
+		self.items = collections.deque(maxlen=item_cap)
+		self.baseindex = 0
+		self.pending = set()
+		self.dirty_due = None
+
+class MemoryOps(Backend):
+	# cleanup is set for the shared instance, which then expires inboxes
+	#   and requests itself
+	def __init__(self, cleanup=False):
+		super(MemoryOps, self).__init__()
+		self.lock = threading.Lock()
+		self.inboxes = dict()
+		# heaps are never updated in place. stale entries are skipped when
+		#   they reach the top
+		self.inbox_exp = list()
+		self.dirty = list()
+		self.requests = dict()
+		self.request_exp = list()
+		# the buffer drops its head on overflow, which the item policy
+		#   would do anyway
+		self.item_cap = max(self.item_max, self.item_burst_max)
+		# there is only ever one cleanup worker
+		self.partitions = 1
+		# set when a deadline lands at the top of one of the heaps
+		self.wake = threading.Event()
+		self.cleanup = cleanup
+		self.idle_max = 60
+		self.cleanup_thread = None
+
+	def _schedule(self, heap, entry):
+		heapq.heappush(heap, entry)
+		if heap[0] is entry:
+			self.wake.set()
+
+	# an inbox past its expiration is gone, even if cleanup hasn't taken
+	#   it yet
+	def _get_inbox(self, id):
+		inbox = self.inboxes.get(id)
+		if inbox is None or inbox.exp_time <= MemoryOps._timestamp_utcnow():
+			raise ObjectDoesNotExist('No such inbox: %s' % id)
+		return inbox
+
+	def _set_expiration(self, id, inbox, exp_time):
+		inbox.exp_time = exp_time
+		self._schedule(self.inbox_exp, (exp_time, id))
+		# drop stale entries if refreshes have bloated the heap
+		if len(self.inbox_exp) > 2 * len(self.inboxes) + 64:
+			self.inbox_exp = [(t, i) for t, i in self.inbox_exp if i in self.inboxes and self.inboxes[i].exp_time == t]
+			heapq.heapify(self.inbox_exp)
+
+	# the inbox's pending requests keep their deadlines, so that their
+	#   senders are still answered when they time out
+	def _remove_inbox(self, id):
+		inbox = self.inboxes.pop(id)
+		val = dict()
+		val['ttl'] = inbox.ttl
+		val['response_mode'] = inbox.response_mode
+		return val
+
+	def _ensure_cleanup_thread(self):
+		if self.cleanup and self.cleanup_thread is None:
+			self.cleanup_thread = threading.Thread(target=self._run_cleanup)
+			self.cleanup_thread.daemon = True
+			self.cleanup_thread.start()
+
+	# the cleanup daemon's loop, for the one partition
+	def _run_cleanup(self):
+		from .util import expire_inboxes, expire_items, expire_requests
+		while True:
+			try:
+				expire_inboxes()
+				expire_items()
+				expire_requests()
+				wait = self.idle_max
+				for due in (self.inbox_next_expiration(), self.inbox_next_dirty(), self.request_next_expiration()):
+					if due is not None:
+						wait = min(wait, due - time.time())
+			except Exception:
+				logger.exception('memory cleanup failed')
+				wait = 1
+			if wait > 0:
+				self.schedule_wait(wait)
+
+	# apply the item policy to the head of the buffer
+	def _trim(self, id, inbox, now):
+		items = inbox.items
+		total = 0
+		while len(items) > 0:
+			if items[0][0] > now - self.item_burst_time:
+				limit = self.item_burst_max
+			else:
+				limit = self.item_max
+			if len(items) <= limit:
+				break
+			items.popleft()
+			total += 1
+		inbox.baseindex += total
+		if len(items) > self.item_max:
+			due = items[0][0] + self.item_burst_time
+			if inbox.dirty_due != due:
+				inbox.dirty_due = due
+				self._schedule(self.dirty, (due, id))
+		else:
+			inbox.dirty_due = None
+		return total
+
+	def _append(self, id, item, body):
+		inbox = self._get_inbox(id)
+		now = MemoryOps._timestamp_utcnow()
+		item = dict(item)
+		item['created'] = now
+		if len(inbox.items) == inbox.items.maxlen:
+			inbox.baseindex += 1
+			metrics.inc('whinbox_items_trimmed_total', 'where="ingest"')
+		inbox.items.append((now, item, body))
+		item_pos = inbox.baseindex + len(inbox.items) - 1
+		if item_pos > 0:
+			return (inbox, now, (str(item_pos), str(item_pos - 1), now))
+		else:
+			return (inbox, now, (str(item_pos), '', now))
+
+	def inbox_create(self, id, ttl, response_mode, body_max=None, wait_timeout=None):
+		if id is not None:
+			MemoryOps._validate_id(id)
+		assert(isinstance(ttl, int))
+		now = MemoryOps._timestamp_utcnow()
+		with self.lock:
+			if id is not None:
+				if id in self.inboxes:
+					raise ObjectExists()
+			else:
+				while True:
+					id = MemoryOps._gen_id()
+					if id not in self.inboxes:
+						break
+			inbox = _Inbox(ttl, response_mode, body_max, wait_timeout, now + ttl, self.item_cap)
+			self.inboxes[id] = inbox
+			self._set_expiration(id, inbox, now + ttl)
+			self._ensure_cleanup_thread()
+			return id
+
+	def inbox_delete(self, id):
+		MemoryOps._validate_id(id)
+		with self.lock:
+			self._get_inbox(id)
+			self._remove_inbox(id)
+
+	def inbox_get(self, id):
+		MemoryOps._validate_id(id)
+		with self.lock:
+			inbox = self._get_inbox(id)
+			val = dict()
+			val['ttl'] = inbox.ttl
+			val['response_mode'] = inbox.response_mode
+			if inbox.body_max is not None:
+				val['body_max'] = inbox.body_max
+			if inbox.wait_timeout is not None:
+				val['wait_timeout'] = inbox.wait_timeout
+			return val
+
+	def inbox_refresh(self, id, newttl=None):
+		assert(not newttl or isinstance(newttl, int))
+		MemoryOps._validate_id(id)
+		now = MemoryOps._timestamp_utcnow()
+		with self.lock:
+			inbox = self._get_inbox(id)
+			if newttl is not None:
+				inbox.ttl = newttl
+			self._set_expiration(id, inbox, now + inbox.ttl)
+
+	def inbox_next_expiration(self, partition=None):
+		with self.lock:
+			while len(self.inbox_exp) > 0:
+				exp_time, id = self.inbox_exp[0]
+				inbox = self.inboxes.get(id)
+				if inbox is not None and inbox.exp_time == exp_time:
+					return exp_time
+				heapq.heappop(self.inbox_exp)
+			return None
+
+	def inbox_take_expired(self, batch_size=None, time_budget=None, partition=None):
+		return self._take_batches(self._inbox_take_expired_batch, batch_size, time_budget)
+
+	def _inbox_take_expired_batch(self, limit):
+		out = list()
+		now = MemoryOps._timestamp_utcnow()
+		with self.lock:
+			while len(out) < limit and len(self.inbox_exp) > 0:
+				exp_time, id = self.inbox_exp[0]
+				inbox = self.inboxes.get(id)
+				if inbox is not None and inbox.exp_time == exp_time:
+					if exp_time > now:
+						break
+					val = self._remove_inbox(id)
+					val['id'] = id
+					out.append(val)
+				heapq.heappop(self.inbox_exp)
+		return out
+
+	def inbox_next_dirty(self, partition=None):
+		with self.lock:
+			while len(self.dirty) > 0:
+				due, id = self.dirty[0]
+				inbox = self.inboxes.get(id)
+				if inbox is not None and inbox.dirty_due == due:
+					return due
+				heapq.heappop(self.dirty)
+			return None
+
+	def inbox_iter_all(self):
+		with self.lock:
+			return iter(list(self.inboxes.keys()))
+
+	def inbox_append_item(self, id, item, body=None):
+		MemoryOps._validate_id(id)
+		with self.lock:
+			_, _, ret = self._append(id, item, body)
+			return ret
+
+	def inbox_ingest_item(self, id, item, body=None):
+		MemoryOps._validate_id(id)
+		with self.lock:
+			inbox, now, ret = self._append(id, item, body)
+			trimmed = self._trim(id, inbox, now)
+		if trimmed > 0:
+			metrics.inc('whinbox_items_trimmed_total', 'where="ingest"', trimmed)
+		return ret
+
+	def inbox_get_item_body(self, id, item_id):
+		MemoryOps._validate_id(id)
+		if not item_id.isdigit():
+			raise InvalidId('invalid item id: %s' % item_id)
+		with self.lock:
+			inbox = self._get_inbox(id)
+			pos = int(item_id) - inbox.baseindex
+			if pos < 0 or pos >= len(inbox.items) or inbox.items[pos][2] is None:
+				raise ObjectDoesNotExist('No stored body: %s' % item_id)
+			return inbox.items[pos][2]
+
+	def inbox_read_items(self, id, item_id, item_max, reverse=False, refresh=True):
+		MemoryOps._validate_id(id)
+		assert(not item_max or item_max > 0)
+		if item_id is not None and len(item_id) > 0:
+			if reverse:
+				item_pos = int(item_id) - 1
+				if item_pos < 0:
+					return (list(), '', True, set())
+			else:
+				item_pos = int(item_id) + 1
+		else:
+			item_pos = -1
+		now = MemoryOps._timestamp_utcnow()
+		with self.lock:
+			inbox = self._get_inbox(id)
+			if refresh and inbox.exp_time - now <= inbox.ttl * self.refresh_fraction:
+				self._set_expiration(id, inbox, now + inbox.ttl)
+			count = len(inbox.items)
+			if count == 0:
+				return (list(), '', True, set())
+			baseindex = inbox.baseindex
+			if not reverse:
+				if item_pos != -1:
+					start_pos = max(item_pos - baseindex, 0)
+				else:
+					start_pos = 0
+				end_pos = count - 1
+				if item_max:
+					end_pos = min(start_pos + item_max - 1, end_pos)
+				last_id = str(baseindex + end_pos)
+				eof = (end_pos == count - 1)
+			else:
+				if item_pos != -1:
+					end_pos = item_pos - baseindex
+				else:
+					end_pos = count - 1
+				start_pos = 0
+				if item_max:
+					start_pos = max(end_pos - (item_max - 1), 0)
+				last_id = str(baseindex + start_pos)
+				eof = (start_pos == 0)
+			if start_pos > end_pos:
+				return (list(), last_id, eof, set())
+			items = list()
+			pending = set()
+			for n, entry in enumerate(itertools.islice(inbox.items, start_pos, end_pos + 1)):
+				item = dict(entry[1])
+				item['id'] = str(baseindex + start_pos + n)
+				if item['id'] in inbox.pending:
+					pending.add(item['id'])
+				items.append(item)
+		if reverse:
+			items.reverse()
+		return (items, last_id, eof, pending)
+
+	def inbox_get_newest_id(self, id):
+		MemoryOps._validate_id(id)
+		with self.lock:
+			inbox = self._get_inbox(id)
+			if len(inbox.items) == 0:
+				return ''
+			return str(inbox.baseindex + len(inbox.items) - 1)
+
+	def inbox_get_item_range_by_time(self, id, start=None, end=None):
+		MemoryOps._validate_id(id)
+		with self.lock:
+			inbox = self._get_inbox(id)
+			created = [entry[0] for entry in inbox.items]
+			baseindex = inbox.baseindex
+		if start is not None:
+			start_pos = bisect.bisect_left(created, start)
+		else:
+			start_pos = 0
+		if end is not None:
+			end_pos = bisect.bisect_right(created, end) - 1
+		else:
+			end_pos = len(created) - 1
+		if start_pos > end_pos:
+			return None
+		return (str(baseindex + start_pos), str(baseindex + end_pos))
+
+	def inbox_clear_expired_items(self, id):
+		MemoryOps._validate_id(id)
+		now = MemoryOps._timestamp_utcnow()
+		with self.lock:
+			inbox = self.inboxes.get(id)
+			if inbox is None:
+				return 0
+			return self._trim(id, inbox, now)
+
+	def inbox_clear_dirty_items(self, batch_size=None, time_budget=None, partition=None):
+		batches = self._take_batches(self._inbox_clear_dirty_batch, batch_size, time_budget)
+		count = 0
+		inboxes = 0
+		for batch in batches:
+			count += sum(n for _, n in batch)
+			inboxes += len(batch)
+		return (count, inboxes)
+
+	# return list((inbox id, items trimmed))
+	def _inbox_clear_dirty_batch(self, limit):
+		out = list()
+		now = MemoryOps._timestamp_utcnow()
+		with self.lock:
+			while len(out) < limit and len(self.dirty) > 0:
+				due, id = self.dirty[0]
+				if due > now:
+					break
+				heapq.heappop(self.dirty)
+				inbox = self.inboxes.get(id)
+				if inbox is None or inbox.dirty_due != due:
+					continue
+				out.append((id, self._trim(id, inbox, now)))
+		return out
+
+	def request_add_pending(self, inbox_id, item_id, timeout=None):
+		if timeout is None:
+			timeout = self.wait_timeout
+		now = MemoryOps._timestamp_precise()
+		with self.lock:
+			req = (inbox_id, item_id)
+			if req in self.requests:
+				raise ObjectExists()
+			exp_time = now + timeout
+			self.requests[req] = exp_time
+			self._schedule(self.request_exp, (exp_time, req))
+			inbox = self.inboxes.get(inbox_id)
+			if inbox is not None:
+				inbox.pending.add(item_id)
+
+	def request_remove_pending(self, inbox_id, item_id):
+		with self.lock:
+			req = (inbox_id, item_id)
+			if req not in self.requests:
+				raise ObjectDoesNotExist()
+			del self.requests[req]
+			inbox = self.inboxes.get(inbox_id)
+			if inbox is not None:
+				inbox.pending.discard(item_id)
+
+	def request_get_pending(self, inbox_id, item_ids):
+		with self.lock:
+			inbox = self.inboxes.get(inbox_id)
+			if inbox is None:
+				return set()
+			return set(i for i in item_ids if i in inbox.pending)
+
+	def request_take_expired(self, batch_size=None, time_budget=None, partition=None):
+		return self._take_batches(self._request_take_expired_batch, batch_size, time_budget)
+
+	def request_next_expiration(self, partition=None):
+		with self.lock:
+			while len(self.request_exp) > 0:
+				exp_time, req = self.request_exp[0]
+				if self.requests.get(req) == exp_time:
+					return exp_time
+				heapq.heappop(self.request_exp)
+			return None
+
+	def schedule_wait(self, timeout):
+		woken = self.wake.wait(timeout)
+		self.wake.clear()
+		return woken
+
+	def _request_take_expired_batch(self, limit):
+		out = list()
+		now = MemoryOps._timestamp_precise()
+		with self.lock:
+			while len(out) < limit and len(self.request_exp) > 0:
+				exp_time, req = self.request_exp[0]
+				if self.requests.get(req) == exp_time:
+					if exp_time > now:
+						break
+					del self.requests[req]
+					inbox = self.inboxes.get(req[0])
+					if inbox is not None:
+						inbox.pending.discard(req[1])
+					out.append(req)
+				heapq.heappop(self.request_exp)
+		return out
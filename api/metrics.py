@@ -0,0 +1,397 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import math
+import os
+import socket
+import threading
+import time
+import weakref
+from django.conf import settings
+
+# counters and histograms for the api's hot paths, served in the
+#   prometheus text format at /metrics on the api host. enabled with
+#   WHINBOX_METRICS.
+#
+# each thread counts into its own shard, so recording takes no lock. the
+#   shards of threads that have ended are folded into a base total. a
+#   background thread sums the shards and adds what changed since its
+#   last pass to a hash in redis, shared by every worker, which is what
+#   /metrics reads. gauges are levels rather than totals, so each process
+#   reports its own under a key that lapses if it stops, and /metrics sums
+#   those. without redis (the memory backend) the process's own totals
+#   are served
+
+def _setting(name, default):
+	v = getattr(settings, name, None)
+	if v is None:
+		return default
+	return v
+
+enabled = _setting('WHINBOX_METRICS', False)
+flush_interval = _setting('WHINBOX_METRICS_FLUSH_INTERVAL', 5)
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name -> (type, help, buckets)
+_metrics = dict()
+
+def _define(name, type, help, buckets=None):
+	_metrics[name] = (type, help, buckets)
+
+_define('whinbox_view_requests_total', 'counter', 'API requests by view and status code.')
+_define('whinbox_view_seconds', 'histogram', 'Time spent in API views.', latency_buckets)
+_define('whinbox_redis_seconds', 'histogram', 'Time spent in storage calls, by method.', latency_buckets)
+_define('whinbox_redis_round_trips_total', 'counter', 'Redis round trips made by storage calls, by method.')
+_define('whinbox_redis_watch_retries_total', 'counter', 'Transactions retried after a WATCH conflict, by method.')
+_define('whinbox_publish_seconds', 'histogram', 'Time to send a batch of publishes to every proxy, retries included.', latency_buckets)
+_define('whinbox_publish_items_total', 'counter', 'Published items by outcome.')
+_define('whinbox_publish_retries_total', 'counter', 'Publish batches retried after a failure.')
+_define('whinbox_publish_queue_depth', 'gauge', 'Items queued for publishing or being sent, across processes.')
+_define('whinbox_item_body_bytes', 'histogram', 'Sizes of request bodies captured as items.', size_buckets)
+_define('whinbox_items_trimmed_total', 'counter', 'Items removed by the item policy, by where it ran.')
+_define('whinbox_inbox_cache_events_total', 'counter', 'Inbox cache lookups and removals, by event.')
+
+# a histogram is kept as counts per bucket, the +Inf bucket, then the sum
+class _Shard(object):
+	def __init__(self, thread=None):
+		self.counters = dict()
+		self.histograms = dict()
+		# the thread recording into it
+		if thread is not None:
+			self.thread = weakref.ref(thread)
+		else:
+			self.thread = None
+
+	def alive(self):
+		thread = self.thread()
+		return thread is not None and thread.is_alive()
+
+	def add(self, shard):
+		for key, value in shard.counters.items():
+			self.counters[key] = self.counters.get(key, 0) + value
+		for key, counts in shard.histograms.items():
+			total = self.histograms.get(key)
+			if total is None:
+				self.histograms[key] = list(counts)
+			else:
+				for n, value in enumerate(counts):
+					total[n] += value
+
+_local = threading.local()
+_shards = list()
+# counts of threads that have ended
+_base = _Shard()
+# number of shards at which to look for ended threads
+_reap_at = 64
+_lock = threading.Lock()
+_flusher = None
+_flusher_pid = None
+_flush_lock = threading.Lock()
+# field -> value as of the last flush
+_flushed = dict()
+_redis = None
+
+def _shard():
+	shard = getattr(_local, 'shard', None)
+	if shard is None:
+		shard = _Shard(threading.current_thread())
+		with _lock:
+			_shards.append(shard)
+			if len(_shards) >= _reap_at:
+				_reap()
+		_local.shard = shard
+	# a forked worker may keep recording in threads it already had, so
+	#   this is where the flusher is found missing
+	if _flusher_pid != os.getpid():
+		_ensure_flusher()
+	return shard
+
+# fold the shards of ended threads into the base total. call with _lock
+#   held
+def _reap():
+	global _reap_at
+	live = list()
+	for shard in _shards:
+		if shard.alive():
+			live.append(shard)
+		else:
+			_base.add(shard)
+	_shards[:] = live
+	_reap_at = max(64, len(live) * 2)
+
+def _use_redis():
+	return _setting('WHINBOX_BACKEND', 'redis') == 'redis'
+
+def _get_redis():
+	global _redis
+	if _redis is None:
+		import redis
+		from . import redis_ops
+		_redis = redis.Redis(connection_pool=redis_ops.get_connection_pool())
+	return _redis
+
+def _ensure_flusher():
+	global _flusher, _flusher_pid
+	with _lock:
+		# threads don't survive a fork
+		if _flusher_pid != os.getpid():
+			_flusher_pid = os.getpid()
+			if _use_redis():
+				_flusher = threading.Thread(target=_run_flusher)
+				_flusher.daemon = True
+				_flusher.start()
+
+# the locks may have been held by threads that don't exist in the child,
+#   and the counts it inherits are the parent's to flush
+def _after_fork():
+	global _lock, _flush_lock, _flushed
+	_lock = threading.Lock()
+	_flush_lock = threading.Lock()
+	_flushed = _collect_shards()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _run_flusher():
+	while True:
+		time.sleep(flush_interval)
+		try:
+			flush()
+		except Exception:
+			# the changes are picked up on the next pass
+			pass
+
+def inc(name, labels, value=1):
+	if not enabled:
+		return
+	counters = _shard().counters
+	key = (name, labels)
+	counters[key] = counters.get(key, 0) + value
+
+def observe(name, labels, value):
+	if not enabled:
+		return
+	histograms = _shard().histograms
+	key = (name, labels)
+	buckets = _metrics[name][2]
+	counts = histograms.get(key)
+	if counts is None:
+		counts = [0] * (len(buckets) + 2)
+		histograms[key] = counts
+	counts[bisect.bisect_left(buckets, value)] += 1
+	counts[-1] += value
+
+# round trips made by the storage call in progress, per thread or task
+_round_trips = contextvars.ContextVar('whinbox_round_trips', default=None)
+
+def round_trip():
+	counter = _round_trips.get()
+	if counter is not None:
+		counter[0] += 1
+
+def watch_retry(method):
+	inc('whinbox_redis_watch_retries_total', 'method="%s"' % method)
+
+def _measured_done(labels, counter, token, start):
+	observe('whinbox_redis_seconds', labels, time.perf_counter() - start)
+	inc('whinbox_redis_round_trips_total', labels, counter[0])
+	_round_trips.reset(token)
+	# round trips of a call made from within another count for both
+	outer = _round_trips.get()
+	if outer is not None:
+		outer[0] += counter[0]
+
+# decorator timing a storage method and counting its round trips
+def measured(f):
+	if not enabled:
+		return f
+	labels = 'method="%s"' % f.__name__
+	if asyncio.iscoroutinefunction(f):
+		async def wrapper(*args, **kwargs):
+			counter = [0]
+			token = _round_trips.set(counter)
+			start = time.perf_counter()
+			try:
+				return await f(*args, **kwargs)
+			finally:
+				_measured_done(labels, counter, token, start)
+	else:
+		def wrapper(*args, **kwargs):
+			counter = [0]
+			token = _round_trips.set(counter)
+			start = time.perf_counter()
+			try:
+				return f(*args, **kwargs)
+			finally:
+				_measured_done(labels, counter, token, start)
+	return functools.wraps(f)(wrapper)
+
+def _view_done(name, response, start):
+	observe('whinbox_view_seconds', 'view="%s"' % name, time.perf_counter() - start)
+	inc('whinbox_view_requests_total', 'view="%s",code="%d"' % (name, response.status_code))
+
+# wrap a view to count its requests and time them
+def timed_view(name, view):
+	if not enabled:
+		return view
+	if asyncio.iscoroutinefunction(view):
+		async def wrapper(request, *args, **kwargs):
+			start = time.perf_counter()
+			response = await view(request, *args, **kwargs)
+			_view_done(name, response, start)
+			return response
+	else:
+		def wrapper(request, *args, **kwargs):
+			start = time.perf_counter()
+			response = view(request, *args, **kwargs)
+			_view_done(name, response, start)
+			return response
+	return functools.wraps(view)(wrapper)
+
+# counters kept elsewhere as running totals, read when collecting
+def _sources():
+	from .backend import get_backend
+	from .publisher import get_publisher
+	out = dict()
+	stats = get_publisher().stats()
+	for outcome in ('sent', 'failed', 'dropped'):
+		out[('whinbox_publish_items_total', 'outcome="%s"' % outcome)] = stats[outcome]
+	out[('whinbox_publish_retries_total', '')] = stats['retries']
+	stats = get_backend().inbox_cache_stats()
+	if stats is not None:
+		for event in ('hits', 'misses', 'evictions', 'invalidations'):
+			out[('whinbox_inbox_cache_events_total', 'event="%s"' % event)] = stats[event]
+	return out
+
+# gauges kept elsewhere, read when collecting
+def _gauges():
+	from .publisher import get_publisher
+	out = dict()
+	out[('whinbox_publish_queue_depth', '')] = get_publisher().stats()['depth']
+	return out
+
+# return dict of field -> total of the shards. fields are the name and
+#   labels of a counter, plus the slot of a histogram, tab-separated
+def _collect_shards():
+	out = dict()
+	with _lock:
+		_reap()
+		# copied here, as the base only changes with the lock held
+		base = _Shard()
+		base.add(_base)
+		shards = [base] + _shards
+	for shard in shards:
+		# other threads may be adding keys, so copy before iterating
+		for (name, labels), value in list(shard.counters.items()):
+			field = name + '\t' + labels
+			out[field] = out.get(field, 0) + value
+		for (name, labels), counts in list(shard.histograms.items()):
+			for n, value in enumerate(list(counts)):
+				field = '%s\t%s\t%d' % (name, labels, n)
+				out[field] = out.get(field, 0) + value
+	return out
+
+# return dict of field -> total in this process
+def _collect():
+	out = _collect_shards()
+	for (name, labels), value in _sources().items():
+		field = name + '\t' + labels
+		out[field] = out.get(field, 0) + value
+	return out
+
+# processes that haven't reported their gauges for this long are left out
+def _gauge_ttl():
+	return max(flush_interval * 3, 10)
+
+# add what changed since the last flush to the shared totals, and report
+#   this process's gauges
+def flush():
+	global _flushed
+	prefix = _setting('WHINBOX_REDIS_PREFIX', 'wi-')
+	with _flush_lock:
+		current = _collect()
+		pipe = _get_redis().pipeline(transaction=False)
+		for field, value in current.items():
+			delta = value - _flushed.get(field, 0)
+			if delta != 0:
+				pipe.hincrbyfloat(prefix + 'metrics', field, delta)
+		process = '%s:%d' % (socket.gethostname(), os.getpid())
+		gauges_key = prefix + 'metrics-gauges:' + process
+		gauges = dict((name + '\t' + labels, value) for (name, labels), value in _gauges().items())
+		pipe.hset(gauges_key, mapping=gauges)
+		pipe.expire(gauges_key, int(math.ceil(_gauge_ttl())))
+		pipe.zadd(prefix + 'metrics-processes', {process: time.time()})
+		pipe.execute()
+		_flushed = current
+
+# return dict of field -> gauge value summed over the live processes
+def _read_gauges():
+	prefix = _setting('WHINBOX_REDIS_PREFIX', 'wi-')
+	r = _get_redis()
+	processes_key = prefix + 'metrics-processes'
+	r.zremrangebyscore(processes_key, '-inf', time.time() - _gauge_ttl())
+	with r.pipeline(transaction=False) as pipe:
+		for process in r.zrange(processes_key, 0, -1):
+			pipe.hgetall(prefix + 'metrics-gauges:' + process)
+		out = dict()
+		for gauges in pipe.execute():
+			for field, value in gauges.items():
+				out[field] = out.get(field, 0) + float(value)
+	return out
+
+def _format_value(v):
+	if v == int(v):
+		return '%d' % v
+	return repr(float(v))
+
+def _series(name, labels, value):
+	if labels:
+		return '%s{%s} %s' % (name, labels, _format_value(value))
+	return '%s %s' % (name, _format_value(value))
+
+# return the metrics in the prometheus text format
+def render():
+	if _use_redis():
+		flush()
+		values = dict((k, float(v)) for k, v in _get_redis().hgetall(_setting('WHINBOX_REDIS_PREFIX', 'wi-') + 'metrics').items())
+		values.update(_read_gauges())
+	else:
+		values = _collect()
+		for (name, labels), value in _gauges().items():
+			values[name + '\t' + labels] = value
+
+	# name -> labels -> value, or list of histogram slots
+	series = dict()
+	for field, value in values.items():
+		parts = field.split('\t')
+		if parts[0] not in _metrics:
+			continue
+		by_labels = series.setdefault(parts[0], dict())
+		if len(parts) == 2:
+			by_labels[parts[1]] = value
+		else:
+			buckets = _metrics[parts[0]][2]
+			counts = by_labels.setdefault(parts[1], [0] * (len(buckets) + 2))
+			counts[int(parts[2])] = value
+
+	lines = list()
+	for name in sorted(_metrics.keys()):
+		type, help, buckets = _metrics[name]
+		lines.append('# HELP %s %s' % (name, help))
+		lines.append('# TYPE %s %s' % (name, type))
+		for labels, value in sorted(series.get(name, dict()).items()):
+			if type == 'histogram':
+				total = 0
+				for n, bound in enumerate(buckets + ('+Inf',)):
+					total += value[n]
+					le = 'le="%s"' % bound
+					if labels:
+						le = labels + ',' + le
+					lines.append(_series(name + '_bucket', le, total))
+				lines.append(_series(name + '_sum', labels, value[-1]))
+				lines.append(_series(name + '_count', labels, total))
+			else:
+				lines.append(_series(name, labels, value))
+	return '\n'.join(lines) + '\n'
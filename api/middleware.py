@@ -1,7 +1,88 @@
+import re
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.handlers.exception import convert_exception_to_response
 from django.http import HttpResponse
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.module_loading import import_string
+
+def _setting(name, default):
+	v = getattr(settings, name, None)
+	if v is None:
+		return default
+	return v
 
 class OptionsMiddleware(MiddlewareMixin):
 	def process_request(self, request):
 		if request.method == 'OPTIONS':
 			return HttpResponse()
+
+# return True if the request is for the api, either on its own host or
+#   under /api/ of the website host
+def is_api_request(request):
+	host = getattr(request, 'host', None)
+	if host is not None and host.name == 'api':
+		return True
+	return request.path_info.startswith('/api/')
+
+# runs the WEBSITE_MIDDLEWARE chain (sessions, auth, static files, etc),
+#   except for api requests, which need none of it and go straight on to
+#   the view. must come after HostsRequestMiddleware. middleware in the
+#   chain only gets called, so process_view hooks are not run
+class WebsiteMiddleware(MiddlewareMixin):
+	def __init__(self, get_response):
+		super(WebsiteMiddleware, self).__init__(get_response)
+		# the website chain is sync. in async mode it runs in a thread
+		#   and calls back into the async handler
+		if self._is_coroutine:
+			handler = async_to_sync(get_response)
+		else:
+			handler = get_response
+		handler = convert_exception_to_response(handler)
+		for path in reversed(getattr(settings, 'WEBSITE_MIDDLEWARE', [])):
+			handler = convert_exception_to_response(import_string(path)(handler))
+		self.website_handler = handler
+
+	def __call__(self, request):
+		if self._is_coroutine:
+			return self.__acall__(request)
+		if is_api_request(request):
+			return self.get_response(request)
+		return self.website_handler(request)
+
+	async def __acall__(self, request):
+		if is_api_request(request):
+			return await self.get_response(request)
+		return await sync_to_async(self.website_handler, thread_sensitive=True)(request)
+
+_hit_path = re.compile(r'^(/api)?/i/[^/]+/in/')
+
+# asgi middleware. django's asgi handler receives the whole request body
+#   before the view runs, so the hit view's cap can't stop a large body
+#   from being buffered. this passes on no more of a hit body than
+#   WHINBOX_BODY_MAX_SIZE, plus a byte so the view can tell it was cut
+#   short, and discards the rest as it arrives
+class BodyLimitMiddleware(object):
+	def __init__(self, app):
+		self.app = app
+		self.limit = _setting('WHINBOX_BODY_MAX_SIZE', 2621440)
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http' or not _hit_path.match(scope['path']):
+			return await self.app(scope, receive, send)
+
+		left = self.limit + 1
+
+		async def limited_receive():
+			nonlocal left
+			while True:
+				message = await receive()
+				if message['type'] != 'http.request':
+					return message
+				more_body = message.get('more_body', False)
+				body = message.get('body', b'')[:left]
+				left -= len(body)
+				if len(body) > 0 or not more_body:
+					return {'type': 'http.request', 'body': body, 'more_body': more_body}
+
+		return await self.app(scope, limited_receive, send)
@@ -0,0 +1,283 @@
+import atexit
+import collections
+import json
+import threading
+import time
+from django.conf import settings
+from pubcontrol import Item, PubControlClient
+from django_grip import get_pubcontrol
+from . import metrics
+
+def _setting(name, default):
+	v = getattr(settings, name, None)
+	if v is None:
+		return default
+	return v
+
+# binary bodies are exported base64-encoded, but as bytes
+def _json_default(v):
+	if isinstance(v, bytes):
+		return v.decode('ascii')
+	raise TypeError('%r is not JSON serializable' % v)
+
+# publishes go through a bounded queue and are sent by a background
+#   thread, several items per control request, so that a slow or
+#   unreachable proxy never holds up the caller
+class Publisher(object):
+	def __init__(self):
+		self.queue_max = _setting('WHINBOX_PUBLISH_QUEUE_MAX', 10000)
+		self.batch_max = _setting('WHINBOX_PUBLISH_BATCH_MAX', 100)
+		self.interval = _setting('WHINBOX_PUBLISH_INTERVAL', 0.02)
+		self.retry_max = _setting('WHINBOX_PUBLISH_RETRY_MAX', 5)
+		self.backoff = _setting('WHINBOX_PUBLISH_BACKOFF', 0.1)
+		self.backoff_max = _setting('WHINBOX_PUBLISH_BACKOFF_MAX', 5)
+		self.coalesce_window = _setting('WHINBOX_PUBLISH_COALESCE_WINDOW', 0)
+		self.coalesce_max = _setting('WHINBOX_PUBLISH_COALESCE_MAX', 50)
+		self.prefix = getattr(settings, 'GRIP_PREFIX', '')
+		# with the builtin realtime engine, items go to redis pub/sub for
+		#   the workers holding requests, instead of to the proxies
+		self.realtime = _setting('WHINBOX_REALTIME', 'pushpin')
+		self.redis = None
+		self.cond = threading.Condition()
+		self.queue = collections.deque()
+		# channel -> [render, item jsons, prev id, last id] of items being
+		#   held back, and the runs in the order they are due
+		self.coalescing = dict()
+		self.coalesce_due = collections.deque()
+		self.sending = 0
+		self.thread = None
+		self.published = 0
+		self.sent = 0
+		self.batches = 0
+		self.dropped = 0
+		self.failed = 0
+		self.retries = 0
+		self.coalesced = 0
+
+	def _ensure_thread(self):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	# return False if the queue is full and the item was dropped
+	def publish(self, channel, formats, id=None, prev_id=None):
+		with self.cond:
+			self.published += 1
+			if len(self.queue) >= self.queue_max:
+				self.dropped += 1
+				return False
+			self.queue.append((self.prefix + channel, formats, id, prev_id))
+			self._ensure_thread()
+			self.cond.notify_all()
+			return True
+
+	# queue many publishes under one lock and one wakeup of the sender,
+	#   for bursts such as a batch of request timeouts. reqs is a list of
+	#   (channel, formats, id, prev_id)
+	# return number of publishes dropped because the queue was full
+	def publish_many(self, reqs):
+		with self.cond:
+			self.published += len(reqs)
+			room = max(self.queue_max - len(self.queue), 0)
+			for channel, formats, id, prev_id in reqs[:room]:
+				self.queue.append((self.prefix + channel, formats, id, prev_id))
+			dropped = max(len(reqs) - room, 0)
+			self.dropped += dropped
+			if len(reqs) > dropped:
+				self._ensure_thread()
+				self.cond.notify_all()
+			return dropped
+
+	# publish an item of a channel whose items form an id/prev_id chain.
+	#   with a coalescing window, consecutive items arriving within it go
+	#   out as one publish spanning from the first prev_id to the last id.
+	#   render(item_jsons, last_id) returns the formats
+	# return False if the queue is full and the item was dropped
+	def publish_item(self, channel, item_json, id, prev_id, render):
+		if self.coalesce_window <= 0:
+			return self.publish(channel, render([item_json], id), id=id, prev_id=prev_id)
+		channel = self.prefix + channel
+		with self.cond:
+			self.published += 1
+			run = self.coalescing.get(channel)
+			if run is not None and run[3] == prev_id and len(run[1]) < self.coalesce_max:
+				run[1].append(item_json)
+				run[3] = id
+				self.coalesced += 1
+				return True
+			# only a new run adds an entry. held runs are bound for the
+			#   queue, so they count against it
+			if len(self.queue) + len(self.coalescing) >= self.queue_max:
+				self.dropped += 1
+				return False
+			# anything held for the channel no longer continues the chain,
+			#   so it goes first
+			if run is not None:
+				self._release_run(channel, run)
+			run = [render, [item_json], prev_id, id]
+			self.coalescing[channel] = run
+			self.coalesce_due.append((time.monotonic() + self.coalesce_window, channel, run))
+			self._ensure_thread()
+			self.cond.notify_all()
+			return True
+
+	def _release_run(self, channel, run):
+		del self.coalescing[channel]
+		self.queue.append((channel, run[0](run[1], run[3]), run[3], run[2]))
+
+	# move runs whose window has passed to the queue
+	# return seconds until the next one is due, or None
+	def _release_due(self):
+		now = time.monotonic()
+		while len(self.coalesce_due) > 0:
+			due, channel, run = self.coalesce_due[0]
+			if due > now:
+				return due - now
+			self.coalesce_due.popleft()
+			if self.coalescing.get(channel) is run:
+				self._release_run(channel, run)
+		return None
+
+	# wait until everything queued so far has been sent or given up on
+	# return True if the queue drained within the timeout
+	def flush(self, timeout=None):
+		if timeout is not None:
+			deadline = time.monotonic() + timeout
+		with self.cond:
+			while len(self.queue) > 0 or self.sending > 0 or len(self.coalescing) > 0:
+				if timeout is not None:
+					left = deadline - time.monotonic()
+					if left <= 0:
+						return False
+					self.cond.wait(left)
+				else:
+					self.cond.wait()
+			return True
+
+	# return dict of counters
+	def stats(self):
+		with self.cond:
+			out = dict()
+			out['depth'] = len(self.queue) + self.sending
+			out['coalescing'] = len(self.coalescing)
+			out['published'] = self.published
+			out['sent'] = self.sent
+			out['batches'] = self.batches
+			out['dropped'] = self.dropped
+			out['failed'] = self.failed
+			out['retries'] = self.retries
+			out['coalesced'] = self.coalesced
+			return out
+
+	def _run(self):
+		while True:
+			with self.cond:
+				while True:
+					wait = self._release_due()
+					if len(self.queue) > 0:
+						break
+					self.cond.wait(wait)
+				# give the batch one interval to fill up
+				deadline = time.monotonic() + self.interval
+				while len(self.queue) < self.batch_max:
+					left = deadline - time.monotonic()
+					if left <= 0:
+						break
+					self.cond.wait(left)
+					self._release_due()
+				reqs = list()
+				while len(self.queue) > 0 and len(reqs) < self.batch_max:
+					reqs.append(self.queue.popleft())
+				self.sending = len(reqs)
+
+			start = time.perf_counter()
+			ok = self._send(reqs)
+			metrics.observe('whinbox_publish_seconds', '', time.perf_counter() - start)
+
+			with self.cond:
+				self.sending = 0
+				self.batches += 1
+				if ok:
+					self.sent += len(reqs)
+				else:
+					self.failed += len(reqs)
+				self.cond.notify_all()
+
+	# send a batch to each configured proxy, retrying with backoff
+	# return True if every proxy took it
+	def _send(self, reqs):
+		items = list()
+		for channel, formats, id, prev_id in reqs:
+			items.append((channel, Item(formats, id=id, prev_id=prev_id)))
+		if self.realtime == 'builtin':
+			pending = [self._get_redis()]
+		else:
+			pending = list(get_pubcontrol().clients)
+		attempt = 0
+		while True:
+			failed = list()
+			for client in pending:
+				try:
+					self._send_to_client(client, items)
+				except:
+					failed.append(client)
+			if len(failed) == 0:
+				return True
+			if attempt >= self.retry_max:
+				return False
+			time.sleep(min(self.backoff * (2 ** attempt), self.backoff_max))
+			attempt += 1
+			with self.cond:
+				self.retries += 1
+			pending = failed
+
+	def _get_redis(self):
+		if self.redis is None:
+			import redis
+			from . import redis_ops
+			self.redis = redis.Redis(connection_pool=redis_ops.get_connection_pool())
+		return self.redis
+
+	def _send_to_client(self, client, items):
+		if isinstance(client, PubControlClient):
+			out = list()
+			for channel, item in items:
+				i = item.export()
+				i['channel'] = channel
+				out.append(i)
+			client.http_call('/publish/', json.dumps({'items': out}, default=_json_default).encode('utf-8'), {'Content-Type': 'application/json'})
+		elif client is self.redis:
+			pipe = client.pipeline(transaction=False)
+			for channel, item in items:
+				pipe.publish(channel, json.dumps(item.export(), default=_json_default))
+			pipe.execute()
+		else:
+			for channel, item in items:
+				client.publish(channel, item, blocking=True)
+
+_publisher = None
+_lock = threading.Lock()
+
+def get_publisher():
+	global _publisher
+	p = _publisher
+	if p is None:
+		with _lock:
+			if _publisher is None:
+				_publisher = Publisher()
+				# give queued items a chance to go out when a management
+				#   command or worker exits
+				atexit.register(_publisher.flush, _setting('WHINBOX_PUBLISH_EXIT_TIMEOUT', 5))
+			p = _publisher
+	return p
+
+# drop-in for django_grip.publish
+def publish(channel, formats, id=None, prev_id=None):
+	return get_publisher().publish(channel, formats, id=id, prev_id=prev_id)
+
+def publish_many(reqs):
+	return get_publisher().publish_many(reqs)
+
+def publish_item(channel, item_json, id, prev_id, render):
+	return get_publisher().publish_item(channel, item_json, id, prev_id, render)
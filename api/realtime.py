@@ -0,0 +1,304 @@
+import asyncio
+import json
+import weakref
+from base64 import b64decode
+from django.conf import settings
+from . import redis_ops
+
+# a stand-in for pushpin, for single-node deployments served over asgi.
+#   it acts on the same grip hold headers pushpin would see: long-polls
+#   and streams are held in the worker, and items published to their
+#   channels arrive through redis pub/sub, so any worker can publish to
+#   requests held by another. enabled with WHINBOX_REALTIME=builtin
+
+def _setting(name, default):
+	v = getattr(settings, name, None)
+	if v is None:
+		return default
+	return v
+
+_safe_methods = ('GET', 'HEAD')
+
+# return dict of channel -> prev_id (or None) from a Grip-Channel header
+def _parse_channels(value):
+	out = dict()
+	for part in value.split(','):
+		params = [p.strip() for p in part.split(';')]
+		prev_id = None
+		for p in params[1:]:
+			if p.startswith('prev-id='):
+				prev_id = p[8:]
+		if params[0]:
+			out[params[0]] = prev_id
+	return out
+
+# subscriptions of the requests held by one event loop, sharing one pub/sub
+#   connection
+class _Hub(object):
+	def __init__(self):
+		self.lock = asyncio.Lock()
+		self.pubsub = None
+		self.listener = None
+		# channel -> set of queues of the requests waiting on it
+		self.waiters = dict()
+
+	async def subscribe(self, channels, queue):
+		async with self.lock:
+			if self.pubsub is None:
+				self.pubsub = redis_ops.get_async_redis().pubsub(ignore_subscribe_messages=True)
+			new = list()
+			for c in channels:
+				waiters = self.waiters.get(c)
+				if waiters is None:
+					waiters = set()
+					self.waiters[c] = waiters
+					new.append(c)
+				waiters.add(queue)
+			if len(new) > 0:
+				await self.pubsub.subscribe(*new)
+			if self.listener is None:
+				self.listener = asyncio.ensure_future(self._listen())
+
+	async def unsubscribe(self, channels, queue):
+		async with self.lock:
+			gone = list()
+			for c in channels:
+				waiters = self.waiters.get(c)
+				if waiters is None:
+					continue
+				waiters.discard(queue)
+				if len(waiters) == 0:
+					del self.waiters[c]
+					gone.append(c)
+			if len(gone) > 0 and self.pubsub is not None:
+				try:
+					await self.pubsub.unsubscribe(*gone)
+				except Exception:
+					pass
+
+	async def _listen(self):
+		while True:
+			try:
+				message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+			except Exception:
+				# held requests time out and are retried by their clients, so
+				#   just reconnect for whoever is still waiting
+				await asyncio.sleep(1)
+				async with self.lock:
+					try:
+						await self.pubsub.close()
+					except Exception:
+						pass
+					if len(self.waiters) == 0:
+						self.pubsub = None
+						self.listener = None
+						return
+					self.pubsub = redis_ops.get_async_redis().pubsub(ignore_subscribe_messages=True)
+					try:
+						await self.pubsub.subscribe(*self.waiters.keys())
+					except Exception:
+						pass
+				continue
+			if message is None or message['type'] != 'message':
+				continue
+			# the inbox-invalidate channel of the storage layer can share a
+			#   name with an inbox channel, so skip anything that isn't an
+			#   item
+			try:
+				item = json.loads(message['data'])
+			except ValueError:
+				continue
+			if not isinstance(item, dict):
+				continue
+			for queue in list(self.waiters.get(message['channel'], ())):
+				queue.put_nowait((message['channel'], item))
+
+_hubs = weakref.WeakKeyDictionary()
+
+def _get_hub():
+	loop = asyncio.get_running_loop()
+	hub = _hubs.get(loop)
+	if hub is None:
+		hub = _Hub()
+		_hubs[loop] = hub
+	return hub
+
+# a response from the app. it is passed straight on to send unless it
+#   carries hold instructions, in which case it's kept for later. with
+#   send=None, everything is kept
+class _Response(object):
+	def __init__(self, send=None):
+		self.send = send
+		self.start = None
+		self.body = list()
+		self.held = False
+
+	async def __call__(self, message):
+		if message['type'] == 'http.response.start':
+			self.start = message
+			self.held = (self.header('grip-hold') is not None)
+			if self.send is not None and not self.held:
+				await self.send(message)
+		elif message['type'] == 'http.response.body':
+			if self.send is not None and not self.held:
+				await self.send(message)
+			else:
+				self.body.append(message.get('body', b''))
+		elif self.send is not None:
+			await self.send(message)
+
+	def header(self, name):
+		name = name.encode('ascii')
+		for k, v in self.start['headers']:
+			if k.lower() == name:
+				return v.decode('latin1')
+		return None
+
+	# return (status, headers) without the grip instructions
+	def stripped_start(self, streaming=False):
+		status = self.start['status']
+		headers = list()
+		for k, v in self.start['headers']:
+			name = k.lower()
+			if name == b'grip-status':
+				status = int(v.decode('latin1').split(' ')[0])
+			elif name.startswith(b'grip-'):
+				continue
+			elif streaming and name == b'content-length':
+				continue
+			else:
+				headers.append((k, v))
+		return (status, headers)
+
+	async def replay(self, send):
+		status, headers = self.stripped_start()
+		await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+		await send({'type': 'http.response.body', 'body': b''.join(self.body)})
+
+async def _empty_receive():
+	return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+async def _wait_disconnect(receive):
+	while True:
+		message = await receive()
+		if message['type'] == 'http.disconnect':
+			return
+
+# asgi middleware wrapped around the django application
+class RealtimeMiddleware(object):
+	def __init__(self, app):
+		self.app = app
+		self.timeout = _setting('WHINBOX_REALTIME_TIMEOUT', 55)
+		self.retry_max = 3
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return await self.app(scope, receive, send)
+		response = _Response(send)
+		await self.app(scope, receive, response)
+		if not response.held:
+			return
+
+		channels = _parse_channels(response.header('grip-channel') or '')
+		queue = asyncio.Queue()
+		hub = _get_hub()
+		await hub.subscribe(channels.keys(), queue)
+		disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+		try:
+			if response.header('grip-hold') == 'stream':
+				await self._stream(send, response, queue, disconnect)
+			else:
+				await self._longpoll(scope, send, response, channels, queue, disconnect)
+		finally:
+			disconnect.cancel()
+			await hub.unsubscribe(channels.keys(), queue)
+
+	# run a safe request through the app again
+	async def _retry(self, scope):
+		response = _Response()
+		await self.app(scope, _empty_receive, response)
+		return response
+
+	async def _longpoll(self, scope, send, response, channels, queue, disconnect):
+		safe = scope['method'] in _safe_methods
+		retries = 0
+		# anything published between the app's answer and the subscription
+		#   would be missed, so safe requests are asked once more
+		if safe:
+			response = await self._retry(scope)
+			if not response.held:
+				await response.replay(send)
+				return
+			channels = _parse_channels(response.header('grip-channel') or '')
+
+		timeout = response.header('grip-timeout')
+		if timeout is not None:
+			timeout = int(timeout)
+		else:
+			timeout = self.timeout
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + timeout
+		while True:
+			left = deadline - loop.time()
+			if left <= 0:
+				await response.replay(send)
+				return
+			get = asyncio.ensure_future(queue.get())
+			done, _ = await asyncio.wait([get, disconnect], timeout=left, return_when=asyncio.FIRST_COMPLETED)
+			if get not in done:
+				get.cancel()
+				if disconnect in done:
+					return
+				continue
+			channel, item = get.result()
+			if 'http-response' not in item:
+				continue
+			# the item doesn't follow on from what the client has, so let
+			#   the app catch it up
+			prev_id = channels.get(channel)
+			if prev_id is not None and item.get('prev-id', '') != prev_id and safe and retries < self.retry_max:
+				retries += 1
+				response = await self._retry(scope)
+				if not response.held:
+					await response.replay(send)
+					return
+				channels = _parse_channels(response.header('grip-channel') or '')
+				continue
+			await self._send_published(send, item['http-response'])
+			return
+
+	async def _send_published(self, send, hr):
+		if 'body-bin' in hr:
+			body = b64decode(hr['body-bin'])
+		else:
+			body = hr.get('body', '').encode('utf-8')
+		headers = list()
+		for k, v in (hr.get('headers') or dict()).items():
+			if k.lower() != 'content-length':
+				headers.append((k.encode('latin1'), str(v).encode('latin1')))
+		headers.append((b'Content-Length', str(len(body)).encode('ascii')))
+		await send({'type': 'http.response.start', 'status': int(hr.get('code', 200)), 'headers': headers})
+		await send({'type': 'http.response.body', 'body': body})
+
+	async def _stream(self, send, response, queue, disconnect):
+		status, headers = response.stripped_start(streaming=True)
+		await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+		await send({'type': 'http.response.body', 'body': b''.join(response.body), 'more_body': True})
+		while True:
+			get = asyncio.ensure_future(queue.get())
+			done, _ = await asyncio.wait([get, disconnect], return_when=asyncio.FIRST_COMPLETED)
+			if get not in done:
+				get.cancel()
+				return
+			channel, item = get.result()
+			hs = item.get('http-stream')
+			if hs is None:
+				continue
+			if hs.get('action') == 'close':
+				break
+			if 'content-bin' in hs:
+				content = b64decode(hs['content-bin'])
+			else:
+				content = hs.get('content', '').encode('utf-8')
+			await send({'type': 'http.response.body', 'body': content, 'more_body': True})
+		await send({'type': 'http.response.body', 'body': b''})
@@ -1,11 +1,20 @@
-from datetime import datetime
-import calendar
-import random
-import string
+import asyncio
+import bisect
+import collections
+import functools
 import json
+import math
+import os
 import threading
+import time
+import weakref
+import zlib
+from base64 import b64encode, b64decode
 import redis
+import redis.asyncio
 from django.conf import settings
+from .backend import Backend, InvalidId, ObjectExists, ObjectDoesNotExist, render_item_fields, _json_dumps, _json_loads
+from . import metrics
 
 def _setting(name, default):
 	v = getattr(settings, name, None)
@@ -13,51 +22,1046 @@ def _setting(name, default):
 		return default
 	return v
 
-class InvalidId(Exception):
-	pass
+# stored items are either a legacy json object, or start with a version
+#   byte. json never starts with a control character, so the first byte
+#   tells the formats apart. version 1 (compact) is followed by a json
+#   array of the item fields, a newline, and the raw body. version 2
+#   (rendered) is followed by the creation time, a newline, and the
+#   output of render_item_fields, so reads can pass it through untouched
+ITEM_FORMAT_V1 = b'\x01'
+ITEM_FORMAT_V2 = b'\x02'
 
-class ObjectExists(Exception):
-	pass
+# array positions of the compact form. fields not listed here go in a
+#   trailing object
+_compact_fields = ('created', 'method', 'path', 'query', 'ip_address', 'type')
+_BODY_TYPE = len(_compact_fields)
+_HEADERS = _BODY_TYPE + 1
+_EXTRA = _HEADERS + 1
 
-class ObjectDoesNotExist(Exception):
-	pass
+# encoding is 'json', 'compact' or 'rendered'
+def encode_item(item, encoding='json'):
+	if encoding == 'rendered':
+		return ITEM_FORMAT_V2 + str(item['created']).encode('utf-8') + b'\n' + render_item_fields(item).encode('utf-8')
+	if '_fields' in item:
+		item = dict(item)
+		del item['_fields']
+	if encoding != 'compact':
+		return _json_dumps(item)
+	meta = [item.get(k) for k in _compact_fields]
+	extra = dict()
+	body_type = 0
+	body = b''
+	headers = None
+	for k, v in item.items():
+		if k == 'body':
+			body_type = 1
+			body = v.encode('utf-8')
+		elif k == 'body-bin':
+			body_type = 2
+			body = b64decode(v)
+		elif k == 'headers':
+			headers = v
+		elif k not in _compact_fields:
+			extra[k] = v
+	meta.append(body_type)
+	meta.append(headers)
+	if extra:
+		meta.append(extra)
+	return ITEM_FORMAT_V1 + _json_dumps(meta) + b'\n' + body
+
+# accepts any format and returns the item in its api form. rendered items
+#   only have 'created' and '_fields'
+def decode_item(data):
+	if data[:1] in ('\x02', ITEM_FORMAT_V2):
+		if isinstance(data, bytes):
+			data = data.decode('utf-8')
+		created_end = data.index('\n', 1)
+		item = dict()
+		item['created'] = int(data[1:created_end])
+		item['_fields'] = data[created_end + 1:]
+		return item
+	if isinstance(data, str):
+		data = data.encode('utf-8', 'surrogateescape')
+	if data[:1] != ITEM_FORMAT_V1:
+		return _json_loads(data)
+	meta_end = data.index(b'\n', 1)
+	meta = _json_loads(data[1:meta_end])
+	if len(meta) > _EXTRA:
+		item = meta[_EXTRA]
+	else:
+		item = dict()
+	for k, v in zip(_compact_fields, meta):
+		if v is not None:
+			item[k] = v
+	if meta[_HEADERS] is not None:
+		item['headers'] = meta[_HEADERS]
+	body_type = meta[_BODY_TYPE]
+	if body_type == 1:
+		item['body'] = data[meta_end + 1:].decode('utf-8')
+	elif body_type == 2:
+		item['body-bin'] = b64encode(data[meta_end + 1:]).decode('ascii')
+	return item
+
+# bodies stored apart from their items are compressed when that helps.
+#   the first byte says how
+def _pack_body(body):
+	packed = zlib.compress(body)
+	if len(packed) < len(body):
+		return b'z' + packed
+	return b'r' + body
+
+def _unpack_body(data):
+	if isinstance(data, str):
+		data = data.encode('utf-8', 'surrogateescape')
+	if data[:1] == b'z':
+		return zlib.decompress(data[1:])
+	return data[1:]
+
+# lua side of decode_item, for scripts that need an item's creation time
+_item_created_lua = """
+local function item_created(val)
+	local version = string.byte(val, 1)
+	if version == 1 then
+		local meta_end = string.find(val, '\\n', 2, true)
+		return cjson.decode(string.sub(val, 2, meta_end - 1))[1]
+	elseif version == 2 then
+		local created_end = string.find(val, '\\n', 2, true)
+		return tonumber(string.sub(val, 2, created_end - 1))
+	end
+	return cjson.decode(val)['created']
+end
+"""
+
+# queues an inbox in the dirty set. if it becomes due before everything
+#   already there, a cleanup daemon sleeping until then is told on
+#   wake_channel ('' for none)
+_queue_dirty_lua = """
+local function queue_dirty(dirty_key, due, id, wake_channel)
+	if wake_channel ~= '' then
+		local first = redis.call('zrange', dirty_key, 0, 0, 'WITHSCORES')
+		if #first == 0 or due < tonumber(first[2]) then
+			redis.call('publish', wake_channel, 'items')
+		end
+	end
+	redis.call('zadd', dirty_key, due, id)
+end
+"""
+
+# trims the head of an inbox's item list according to the item_max and
+#   burst policy, using the parallel list of item creation times to find
+#   the cut point. if items remain above item_max, the inbox is queued in
+#   the dirty set for the time its oldest item leaves the burst window.
+#   returns the number of items removed
+_trim_items_lua = _item_created_lua + _queue_dirty_lua + """
+-- drops stored bodies of items before baseindex
+local function prune_bodies(bodies_key, baseindex)
+	if redis.call('exists', bodies_key) == 1 then
+		for _, pos in ipairs(redis.call('hkeys', bodies_key)) do
+			if tonumber(pos) < baseindex then
+				redis.call('hdel', bodies_key, pos)
+			end
+		end
+	end
+end
+
+local function trim_items(items_key, baseindex_key, created_key, bodies_key, dirty_key, id, now, item_max, burst_time, burst_max, wake_channel)
+	local count = redis.call('llen', items_key)
+	local created_count = redis.call('llen', created_key)
+	if created_count < count then
+		-- items stored before the index existed. backfill once
+		local missing = redis.call('lrange', items_key, 0, count - created_count - 1)
+		for n = #missing, 1, -1 do
+			redis.call('lpush', created_key, item_created(missing[n]))
+		end
+	elseif created_count > count then
+		redis.call('ltrim', created_key, created_count - count, -1)
+	end
+	local cut = 0
+	if count > math.min(item_max, burst_max) then
+		-- number of items that have left the burst window
+		local cutoff = now - burst_time
+		local lo = 0
+		local hi = count
+		while lo < hi do
+			local mid = math.floor((lo + hi) / 2)
+			if tonumber(redis.call('lindex', created_key, mid)) <= cutoff then
+				lo = mid + 1
+			else
+				hi = mid
+			end
+		end
+		local old = lo
+		cut = math.min(old, math.max(count - item_max, 0))
+		if cut == old then
+			cut = cut + math.max(count - old - burst_max, 0)
+		end
+	end
+	if cut > 0 then
+		redis.call('ltrim', items_key, cut, -1)
+		redis.call('ltrim', created_key, cut, -1)
+		prune_bodies(bodies_key, redis.call('incrby', baseindex_key, cut))
+		count = count - cut
+	end
+	if count > item_max then
+		queue_dirty(dirty_key, tonumber(redis.call('lindex', created_key, 0)) + burst_time, id, wake_channel)
+	else
+		redis.call('zrem', dirty_key, id)
+	end
+	return cut
+end
+"""
+
+# with WHINBOX_REDIS_KEY_TTL, the keys holding an inbox's data carry its
+#   expiration as a redis ttl, so that redis reclaims them even if
+#   cleanup isn't running. key_prefix ('' when off) is the prefix of
+#   those keys
+_inbox_key_names = ('inbox-', 'inbox-items-', 'inbox-items-baseindex-', 'inbox-items-created-', 'inbox-stream-', 'inbox-bodies-', 'req-pending-')
+
+_inbox_key_ttl_lua = """
+local inbox_key_names = {""" + ', '.join("'%s'" % n for n in _inbox_key_names) + """}
+
+local function expire_inbox_keys(key_prefix, id, exp_time)
+	for _, name in ipairs(inbox_key_names) do
+		redis.call('expireat', key_prefix .. name .. id, exp_time)
+	end
+end
+
+-- gives keys created since the inbox was last refreshed its ttl
+local function expire_with_inbox(key_prefix, id)
+	local ttl = redis.call('pttl', key_prefix .. 'inbox-' .. id)
+	if ttl > 0 then
+		for _, name in ipairs(inbox_key_names) do
+			redis.call('pexpire', key_prefix .. name .. id, ttl)
+		end
+	end
+end
+"""
+
+# KEYS: inbox, items, baseindex, items-created, inbox-bodies, inbox-dirty
+# ARGV: item json, now, item_max, burst_time, burst_max, inbox id, body
+#   ('' for none), wake channel, key ttl prefix
+# returns nil if the inbox doesn't exist, else {item pos, trimmed}
+_append_item_lua = _trim_items_lua + _inbox_key_ttl_lua + """
+if redis.call('exists', KEYS[1]) == 0 then
+	return false
+end
+local count = redis.call('rpush', KEYS[2], ARGV[1])
+redis.call('rpush', KEYS[4], ARGV[2])
+local baseindex = tonumber(redis.call('get', KEYS[3]) or '0')
+if ARGV[7] ~= '' then
+	redis.call('hset', KEYS[5], baseindex + count - 1, ARGV[7])
+end
+local trimmed = trim_items(KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6], ARGV[6], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), ARGV[8])
+if ARGV[9] ~= '' then
+	expire_with_inbox(ARGV[9], ARGV[6])
+end
+return {baseindex + count - 1, trimmed}
+"""
+
+# KEYS: items, baseindex, items-created, inbox-bodies, inbox-dirty
+# ARGV: now, item_max, burst_time, burst_max, inbox id
+_clear_expired_items_lua = _trim_items_lua + """
+return trim_items(KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], ARGV[5], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), '')
+"""
+
+# pushes back an inbox's expiration, unless more than the given fraction
+#   of its ttl is still left. this turns most refreshes of a busy inbox
+#   into a read
+_refresh_inbox_lua = _inbox_key_ttl_lua + """
+local function refresh_inbox(exp_key, id, val, now, fraction, key_prefix)
+	local ttl = cjson.decode(val)['ttl']
+	local exp_time = redis.call('zscore', exp_key, id)
+	if not exp_time or tonumber(exp_time) - now <= ttl * fraction then
+		redis.call('zadd', exp_key, now + ttl, id)
+		if key_prefix ~= '' then
+			expire_inbox_keys(key_prefix, id, now + ttl)
+		end
+	end
+end
+"""
+
+# KEYS: inbox, items, baseindex, inbox-exp, pending requests
+# ARGV: reverse, item pos (-1 for none), item max (0 for none), now,
+#   refresh, inbox id, refresh fraction, key ttl prefix
+# returns nil if the inbox doesn't exist, else
+#   {last pos (-1 for none), eof, start pos, items, pending flags}
+_read_items_lua = _refresh_inbox_lua + """
+local val = redis.call('get', KEYS[1])
+if not val then
+	return false
+end
+if ARGV[5] == '1' then
+	refresh_inbox(KEYS[4], ARGV[6], val, tonumber(ARGV[4]), tonumber(ARGV[7]), ARGV[8])
+end
+local count = redis.call('llen', KEYS[2])
+if count == 0 then
+	return {-1, 1, 0, {}, {}}
+end
+local baseindex = tonumber(redis.call('get', KEYS[3]) or '0')
+local item_pos = tonumber(ARGV[2])
+local item_max = tonumber(ARGV[3])
+local start_pos
+local end_pos
+local last_pos
+local eof
+if ARGV[1] == '0' then
+	if item_pos ~= -1 then
+		start_pos = math.max(item_pos - baseindex, 0)
+	else
+		start_pos = 0
+	end
+	end_pos = count - 1
+	if item_max > 0 then
+		end_pos = math.min(start_pos + item_max - 1, end_pos)
+	end
+	last_pos = baseindex + end_pos
+	eof = (end_pos == count - 1)
+else
+	if item_pos ~= -1 then
+		end_pos = item_pos - baseindex
+	else
+		end_pos = count - 1
+	end
+	start_pos = 0
+	if item_max > 0 then
+		start_pos = math.max(end_pos - (item_max - 1), 0)
+	end
+	last_pos = baseindex + start_pos
+	eof = (start_pos == 0)
+end
+if eof then
+	eof = 1
+else
+	eof = 0
+end
+if start_pos > end_pos then
+	return {last_pos, eof, baseindex + start_pos, {}, {}}
+end
+local items = redis.call('lrange', KEYS[2], start_pos, end_pos)
+local pending = {}
+for n = 1, #items do
+	pending[n] = redis.call('sismember', KEYS[5], tostring(baseindex + start_pos + n - 1))
+end
+return {last_pos, eof, baseindex + start_pos, items, pending}
+"""
+
+# keys of the expired objects are derived from the prefix rather than passed
+#   in, so these scripts assume a single redis node
+
+# KEYS: inbox-dirty
+# ARGV: now, limit, prefix, item_max, burst_time, burst_max
+# returns flat list of inbox id, items trimmed
+_clear_dirty_items_lua = _trim_items_lua + """
+local now = tonumber(ARGV[1])
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local out = {}
+for _, id in ipairs(ids) do
+	local trimmed = trim_items(
+		ARGV[3] .. 'inbox-items-' .. id,
+		ARGV[3] .. 'inbox-items-baseindex-' .. id,
+		ARGV[3] .. 'inbox-items-created-' .. id,
+		ARGV[3] .. 'inbox-bodies-' .. id,
+		KEYS[1], id, now, tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), '')
+	table.insert(out, id)
+	table.insert(out, trimmed)
+end
+return out
+"""
+
+# KEYS: inbox-exp, inbox set, inbox-dirty
+# ARGV: now, limit, prefix
+# returns flat list of inbox id, inbox value. each id is also published
+#   to the inbox-invalidate channel
+_take_expired_inboxes_lua = """
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local out = {}
+for _, id in ipairs(ids) do
+	local key = ARGV[3] .. 'inbox-' .. id
+	local val = redis.call('get', key)
+	redis.call('del', key,
+		ARGV[3] .. 'inbox-items-' .. id,
+		ARGV[3] .. 'inbox-items-baseindex-' .. id,
+		ARGV[3] .. 'inbox-items-created-' .. id,
+		ARGV[3] .. 'inbox-stream-' .. id,
+		ARGV[3] .. 'inbox-bodies-' .. id,
+		ARGV[3] .. 'req-pending-' .. id)
+	redis.call('srem', KEYS[2], id)
+	redis.call('zrem', KEYS[1], id)
+	redis.call('zrem', KEYS[3], id)
+	redis.call('publish', ARGV[3] .. 'inbox-invalidate', id)
+	table.insert(out, id)
+	table.insert(out, val or '')
+end
+return out
+"""
+
+# KEYS: req-exp
+# ARGV: now, limit, prefix
+# returns list of request values
+_take_expired_requests_lua = """
+local req_ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local out = {}
+for _, req_id in ipairs(req_ids) do
+	local req_key = ARGV[3] .. 'req-item-' .. req_id
+	local val = redis.call('get', req_key)
+	redis.call('zrem', KEYS[1], req_id)
+	if val then
+		local req = cjson.decode(val)
+		redis.call('del', req_key)
+		redis.call('srem', ARGV[3] .. 'req-pending-' .. req[1], req[2])
+		table.insert(out, val)
+	end
+end
+return out
+"""
+
+# KEYS: cleanup-workers
+# ARGV: owner, now (ms), lease time (ms), partitions, prefix
+# returns list of partitions held by the owner. each worker takes up to an
+#   even share, counting the workers whose claims haven't lapsed, and
+#   gives back whatever it holds above that
+_claim_partitions_lua = """
+local now = tonumber(ARGV[2])
+local lease = tonumber(ARGV[3])
+local partitions = tonumber(ARGV[4])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+redis.call('zadd', KEYS[1], now + lease, ARGV[1])
+local share = math.ceil(partitions / redis.call('zcard', KEYS[1]))
+local held = {}
+local free = {}
+for p = 0, partitions - 1 do
+	local holder = redis.call('get', ARGV[5] .. 'cleanup-lease:' .. p)
+	if holder == ARGV[1] then
+		table.insert(held, p)
+	elseif not holder then
+		table.insert(free, p)
+	end
+end
+while #held > share do
+	redis.call('del', ARGV[5] .. 'cleanup-lease:' .. table.remove(held))
+end
+for _, p in ipairs(held) do
+	redis.call('pexpire', ARGV[5] .. 'cleanup-lease:' .. p, lease)
+end
+for _, p in ipairs(free) do
+	if #held >= share then
+		break
+	end
+	redis.call('set', ARGV[5] .. 'cleanup-lease:' .. p, ARGV[1], 'PX', lease)
+	table.insert(held, p)
+end
+return held
+"""
+
+# KEYS: cleanup-workers
+# ARGV: owner, partitions, prefix
+_release_partitions_lua = """
+redis.call('zrem', KEYS[1], ARGV[1])
+for p = 0, tonumber(ARGV[2]) - 1 do
+	local key = ARGV[3] .. 'cleanup-lease:' .. p
+	if redis.call('get', key) == ARGV[1] then
+		redis.call('del', key)
+	end
+end
+return 0
+"""
+
+# the stream storage engine keeps each inbox's items in a redis stream.
+#   entry ids are used as item ids and carry the creation time, and the
+#   item policy is applied with XTRIM. needs redis 6.2 or later
+
+# trims the oldest entries of an inbox stream according to the item_max
+#   and burst policy, and queues the inbox in the dirty set like
+#   trim_items does. returns the number of entries removed
+_trim_stream_lua = _queue_dirty_lua + """
+local function entry_time(entry_id)
+	return tonumber(string.match(entry_id, '^(%d+)'))
+end
+
+local function first_entry_time(stream_key)
+	local first = redis.call('xrange', stream_key, '-', '+', 'COUNT', 1)
+	return entry_time(first[1][1])
+end
+
+-- drops stored bodies of entries before the head of the stream. bodies
+--   keyed by list position, of items not yet migrated, are left alone
+local function prune_stream_bodies(bodies_key, stream_key)
+	if redis.call('exists', bodies_key) == 0 then
+		return
+	end
+	local first = redis.call('xrange', stream_key, '-', '+', 'COUNT', 1)
+	if #first == 0 then
+		redis.call('del', bodies_key)
+		return
+	end
+	local head_ms, head_seq = string.match(first[1][1], '^(%d+)-(%d+)$')
+	head_ms = tonumber(head_ms)
+	head_seq = tonumber(head_seq)
+	for _, entry_id in ipairs(redis.call('hkeys', bodies_key)) do
+		local ms, seq = string.match(entry_id, '^(%d+)-(%d+)$')
+		ms = tonumber(ms)
+		if ms and (ms < head_ms or (ms == head_ms and tonumber(seq) < head_seq)) then
+			redis.call('hdel', bodies_key, entry_id)
+		end
+	end
+end
+
+local function trim_stream(stream_key, bodies_key, dirty_key, id, now, item_max, burst_time, burst_max, wake_channel)
+	local count = redis.call('xlen', stream_key)
+	local cut = 0
+	local head_ms = nil
+	if count > math.min(item_max, burst_max) then
+		-- entries from this time on are within the burst window
+		local new_ms = (now - burst_time + 1) * 1000
+		head_ms = first_entry_time(stream_key)
+		if head_ms < new_ms then
+			if count > item_max then
+				local newer = redis.call('xrange', stream_key, new_ms, '+', 'COUNT', item_max)
+				if #newer < item_max then
+					cut = redis.call('xtrim', stream_key, 'MAXLEN', item_max)
+					head_ms = nil
+				else
+					cut = redis.call('xtrim', stream_key, 'MINID', new_ms)
+					head_ms = entry_time(newer[1][1])
+				end
+				count = count - cut
+			else
+				head_ms = nil
+			end
+		end
+		if head_ms and count > burst_max then
+			local n = redis.call('xtrim', stream_key, 'MAXLEN', burst_max)
+			cut = cut + n
+			count = count - n
+			head_ms = first_entry_time(stream_key)
+		end
+	end
+	if count > item_max then
+		if not head_ms then
+			head_ms = first_entry_time(stream_key)
+		end
+		queue_dirty(dirty_key, math.floor(head_ms / 1000) + burst_time, id, wake_channel)
+	else
+		redis.call('zrem', dirty_key, id)
+	end
+	if cut > 0 then
+		prune_stream_bodies(bodies_key, stream_key)
+	end
+	return cut
+end
+"""
+
+# KEYS: inbox, stream, inbox-bodies, inbox-dirty
+# ARGV: item json, now, item_max, burst_time, burst_max, inbox id, body
+#   ('' for none), wake channel, key ttl prefix
+# returns nil if the inbox doesn't exist, else {item id, prev id, trimmed}
+_stream_append_item_lua = _trim_stream_lua + _inbox_key_ttl_lua + """
+if redis.call('exists', KEYS[1]) == 0 then
+	return false
+end
+local prev_id = ''
+local prev = redis.call('xrevrange', KEYS[2], '+', '-', 'COUNT', 1)
+if #prev > 0 then
+	prev_id = prev[1][1]
+end
+local item_id = redis.call('xadd', KEYS[2], '*', 'item', ARGV[1])
+if ARGV[7] ~= '' then
+	redis.call('hset', KEYS[3], item_id, ARGV[7])
+end
+local trimmed = trim_stream(KEYS[2], KEYS[3], KEYS[4], ARGV[6], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), ARGV[8])
+if ARGV[9] ~= '' then
+	expire_with_inbox(ARGV[9], ARGV[6])
+end
+return {item_id, prev_id, trimmed}
+"""
+
+# KEYS: stream, inbox-bodies, inbox-dirty
+# ARGV: now, item_max, burst_time, burst_max, inbox id
+_stream_clear_expired_items_lua = _trim_stream_lua + """
+return trim_stream(KEYS[1], KEYS[2], KEYS[3], ARGV[5], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), '')
+"""
+
+# KEYS: inbox-dirty
+# ARGV: now, limit, prefix, item_max, burst_time, burst_max
+# returns flat list of inbox id, items trimmed
+_stream_clear_dirty_items_lua = _trim_stream_lua + """
+local now = tonumber(ARGV[1])
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local out = {}
+for _, id in ipairs(ids) do
+	local trimmed = trim_stream(ARGV[3] .. 'inbox-stream-' .. id, ARGV[3] .. 'inbox-bodies-' .. id, KEYS[1], id,
+		now, tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), '')
+	table.insert(out, id)
+	table.insert(out, trimmed)
+end
+return out
+"""
+
+# KEYS: inbox, stream, inbox-exp, pending requests
+# ARGV: reverse, item id ('' for none), item max (0 for none), now,
+#   refresh, inbox id, refresh fraction, key ttl prefix
+# returns nil if the inbox doesn't exist, else
+#   {last id, eof, item ids, items, pending flags}
+_stream_read_items_lua = _refresh_inbox_lua + """
+local val = redis.call('get', KEYS[1])
+if not val then
+	return false
+end
+if ARGV[5] == '1' then
+	refresh_inbox(KEYS[3], ARGV[6], val, tonumber(ARGV[4]), tonumber(ARGV[7]), ARGV[8])
+end
+local item_max = tonumber(ARGV[3])
+local entries
+local eof = 0
+if ARGV[1] == '0' then
+	local start = '-'
+	if ARGV[2] ~= '' then
+		start = '(' .. ARGV[2]
+	end
+	if item_max > 0 then
+		entries = redis.call('xrange', KEYS[2], start, '+', 'COUNT', item_max)
+		if #entries < item_max then
+			eof = 1
+		end
+	else
+		entries = redis.call('xrange', KEYS[2], start, '+')
+		eof = 1
+	end
+else
+	local start = '+'
+	if ARGV[2] ~= '' then
+		start = '(' .. ARGV[2]
+	end
+	if item_max > 0 then
+		-- fetch one extra to learn whether older items remain
+		entries = redis.call('xrevrange', KEYS[2], start, '-', 'COUNT', item_max + 1)
+		if #entries > item_max then
+			table.remove(entries)
+		else
+			eof = 1
+		end
+	else
+		entries = redis.call('xrevrange', KEYS[2], start, '-')
+		eof = 1
+	end
+end
+local last_id = ''
+if #entries > 0 then
+	last_id = entries[#entries][1]
+elseif ARGV[1] == '0' then
+	local newest = redis.call('xrevrange', KEYS[2], '+', '-', 'COUNT', 1)
+	if #newest > 0 then
+		last_id = newest[1][1]
+	end
+end
+local ids = {}
+local items = {}
+local pending = {}
+for n, entry in ipairs(entries) do
+	ids[n] = entry[1]
+	items[n] = entry[2][2]
+	pending[n] = redis.call('sismember', KEYS[4], entry[1])
+end
+return {last_id, eof, ids, items, pending}
+"""
+
+# moves list items to the end of the stream, so it can be run again to
+#   pick up items that workers still on list storage appended after the
+#   stream was made. a held request waits on a channel named after its
+#   item's list position, so items with requests pending are left alone
+# KEYS: items, baseindex, items-created, stream, inbox-bodies, pending
+#   requests
+# returns the number of items moved, -1 if the inbox already has a
+#   stream and no list items, or -2 if requests are pending
+_migrate_list_to_stream_lua = _item_created_lua + """
+local items = redis.call('lrange', KEYS[1], 0, -1)
+if #items == 0 and redis.call('exists', KEYS[4]) == 1 then
+	return -1
+end
+local baseindex = tonumber(redis.call('get', KEYS[2]) or '0')
+for n = 1, #items do
+	if redis.call('sismember', KEYS[6], tostring(baseindex + n - 1)) == 1 then
+		return -2
+	end
+end
+local last_ms = 0
+local seq = 0
+local newest = redis.call('xrevrange', KEYS[4], '+', '-', 'COUNT', 1)
+if #newest > 0 then
+	local ms, newest_seq = string.match(newest[1][1], '^(%d+)-(%d+)$')
+	last_ms = tonumber(ms)
+	seq = tonumber(newest_seq)
+end
+for n, item in ipairs(items) do
+	local ms = item_created(item) * 1000
+	if ms <= last_ms then
+		seq = seq + 1
+	else
+		last_ms = ms
+		seq = 0
+	end
+	local entry_id = redis.call('xadd', KEYS[4], last_ms .. '-' .. seq, 'item', item)
+	-- stored bodies are keyed by item id
+	local pos = tostring(baseindex + n - 1)
+	local body = redis.call('hget', KEYS[5], pos)
+	if body then
+		redis.call('hset', KEYS[5], entry_id, body)
+		redis.call('hdel', KEYS[5], pos)
+	end
+end
+redis.call('del', KEYS[1], KEYS[2], KEYS[3])
+return #items
+"""
+
+_pool = None
+_ops = None
+_lock = threading.RLock()
+
+# client is the redis or redis.asyncio module
+def _create_connection_pool(client=redis):
+	kwargs = dict()
+	kwargs['db'] = _setting('REDIS_DB', 0)
+	kwargs['decode_responses'] = True
+	# compact items carry raw bodies. keep undecodable bytes so
+	#   decode_item can restore them
+	kwargs['encoding_errors'] = 'surrogateescape'
+	kwargs['socket_timeout'] = _setting('REDIS_SOCKET_TIMEOUT', None)
+	kwargs['health_check_interval'] = _setting('REDIS_HEALTH_CHECK_INTERVAL', 0)
+	unix_socket_path = _setting('REDIS_UNIX_SOCKET_PATH', None)
+	if unix_socket_path:
+		kwargs['connection_class'] = client.UnixDomainSocketConnection
+		kwargs['path'] = unix_socket_path
+	else:
+		kwargs['host'] = _setting('REDIS_HOST', 'localhost')
+		kwargs['port'] = _setting('REDIS_PORT', 6379)
+		kwargs['socket_connect_timeout'] = _setting('REDIS_SOCKET_CONNECT_TIMEOUT', None)
+	max_connections = _setting('REDIS_MAX_CONNECTIONS', 50)
+	# by default, callers past max_connections wait for a connection to
+	#   be returned rather than fail
+	if _setting('REDIS_POOL_BLOCKING', True):
+		return client.BlockingConnectionPool(
+			max_connections=max_connections,
+			timeout=_setting('REDIS_POOL_TIMEOUT', 20),
+			**kwargs)
+	else:
+		return client.ConnectionPool(max_connections=max_connections, **kwargs)
+
+# the pool is created once per process. it checks the owning pid whenever a
+#   connection is taken, so workers forked after creation get fresh sockets
+def get_connection_pool():
+	global _pool
+	pool = _pool
+	if pool is None:
+		with _lock:
+			if _pool is None:
+				_pool = _create_connection_pool()
+			pool = _pool
+	return pool
+
+# shared instance for views, util and management commands
+def get_ops():
+	global _ops
+	ops = _ops
+	if ops is None:
+		with _lock:
+			if _ops is None:
+				if _setting('WHINBOX_REDIS_STORAGE', 'list') == 'stream':
+					_ops = RedisStreamOps()
+				else:
+					_ops = RedisOps()
+			ops = _ops
+	return ops
+
+# return the async client of the shared instance for the running event loop
+def get_async_redis():
+	return get_ops()._get_async().redis
+
+# instances whose threads and locks need resetting in a forked child
+_instances = weakref.WeakSet()
+
+def _after_fork():
+	global _lock
+	_lock = threading.RLock()
+	for ops in list(_instances):
+		ops._after_fork()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+# bounded lru cache of inbox values. entries are dropped when their ids
+#   are published to the inbox-invalidate channel, and also age out in
+#   case a message is lost. the cache is bypassed while the listener is
+#   not subscribed
+class _InboxCache(object):
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.active = False
+		# bumped on every invalidation, so that a value read from redis
+		#   before an invalidation arrived is not cached after it
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	# return (value or None, generation)
+	def get(self, id):
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(id)
+			if entry is not None and entry[1] > now:
+				self.entries.move_to_end(id)
+				self.hits += 1
+				return (dict(entry[0]), self.generation)
+			self.misses += 1
+			return (None, self.generation)
+
+	def put(self, id, val, generation):
+		with self.lock:
+			if not self.active or generation != self.generation:
+				return
+			self.entries[id] = (dict(val), time.monotonic() + self.ttl)
+			self.entries.move_to_end(id)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, id):
+		with self.lock:
+			self.generation += 1
+			if self.entries.pop(id, None) is not None:
+				self.invalidations += 1
+
+	def set_active(self, active):
+		with self.lock:
+			self.active = active
+			self.generation += 1
+			self.entries.clear()
+
+	def stats(self):
+		with self.lock:
+			out = dict()
+			out['size'] = len(self.entries)
+			out['hits'] = self.hits
+			out['misses'] = self.misses
+			out['evictions'] = self.evictions
+			out['invalidations'] = self.invalidations
+			return out
+
+# clients that count their round trips for metrics: each command sent on
+#   its own, and each pipeline sent as a whole
+class _CountingPipeline(redis.client.Pipeline):
+	def immediate_execute_command(self, *args, **options):
+		metrics.round_trip()
+		return super(_CountingPipeline, self).immediate_execute_command(*args, **options)
+
+	def execute(self, raise_on_error=True):
+		if len(self.command_stack) > 0:
+			metrics.round_trip()
+		return super(_CountingPipeline, self).execute(raise_on_error)
+
+class _CountingRedis(redis.Redis):
+	def execute_command(self, *args, **options):
+		metrics.round_trip()
+		return super(_CountingRedis, self).execute_command(*args, **options)
+
+	def pipeline(self, transaction=True, shard_hint=None):
+		return _CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class _AsyncCountingPipeline(redis.asyncio.client.Pipeline):
+	async def immediate_execute_command(self, *args, **options):
+		metrics.round_trip()
+		return await super(_AsyncCountingPipeline, self).immediate_execute_command(*args, **options)
+
+	async def execute(self, raise_on_error=True):
+		if len(self.command_stack) > 0:
+			metrics.round_trip()
+		return await super(_AsyncCountingPipeline, self).execute(raise_on_error)
+
+class _AsyncCountingRedis(redis.asyncio.Redis):
+	async def execute_command(self, *args, **options):
+		metrics.round_trip()
+		return await super(_AsyncCountingRedis, self).execute_command(*args, **options)
+
+	def pipeline(self, transaction=True, shard_hint=None):
+		return _AsyncCountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+# asyncio connections belong to the event loop that made them, so each
+#   loop gets its own pool and scripts
+class _AsyncClient(object):
+	def __init__(self, scripts):
+		if metrics.enabled:
+			client = _AsyncCountingRedis
+		else:
+			client = redis.asyncio.Redis
+		self.redis = client(connection_pool=_create_connection_pool(redis.asyncio))
+		for name, lua in scripts:
+			setattr(self, name, self.redis.register_script(lua))
+
+class RedisOps(Backend):
+	# scripts used by the async methods, registered with each loop's client
+	_async_scripts = (
+		('append_item_script', _append_item_lua),
+		('read_items_script', _read_items_lua)
+	)
 
-class RedisOps(object):
 	def __init__(self):
-		self.host = _setting('REDIS_HOST', 'localhost')
-		self.port = _setting('REDIS_PORT', 6379)
-		self.db = _setting('REDIS_DB', 0)
+		super(RedisOps, self).__init__()
 		self.prefix = _setting('WHINBOX_REDIS_PREFIX', 'wi-')
-		self.item_max = _setting('WHINBOX_ITEM_MAX', 100)
-		self.item_burst_time = _setting('WHINBOX_ITEM_BURST_TIME', 120)
-		self.item_burst_max = _setting('WHINBOX_ITEM_BURST_MAX', 1200)
-		self.lock = threading.Lock()
-		self.redis = None
+		self.use_scripts = _setting('WHINBOX_REDIS_SCRIPTS', True)
+		# rendered items are read back without parsing. reads accept every
+		#   format, so items stored under another setting still work
+		self.item_encoding = _setting('WHINBOX_ITEM_ENCODING', 'rendered')
+		# clients are cheap wrappers around the shared pool and don't
+		#   connect until used
+		if metrics.enabled:
+			self.redis = _CountingRedis(connection_pool=get_connection_pool())
+		else:
+			self.redis = redis.Redis(connection_pool=get_connection_pool())
+		self.append_item_script = self.redis.register_script(_append_item_lua)
+		self.clear_expired_items_script = self.redis.register_script(_clear_expired_items_lua)
+		self.read_items_script = self.redis.register_script(_read_items_lua)
+		self.take_expired_inboxes_script = self.redis.register_script(_take_expired_inboxes_lua)
+		self.clear_dirty_items_script = self.redis.register_script(_clear_dirty_items_lua)
+		self.take_expired_requests_script = self.redis.register_script(_take_expired_requests_lua)
+		self.claim_partitions_script = self.redis.register_script(_claim_partitions_lua)
+		self.release_partitions_script = self.redis.register_script(_release_partitions_lua)
+		cache_size = _setting('WHINBOX_INBOX_CACHE_SIZE', 10000)
+		if cache_size > 0:
+			self.inbox_cache = _InboxCache(cache_size, _setting('WHINBOX_INBOX_CACHE_TTL', 60))
+		else:
+			self.inbox_cache = None
+		self.invalidation_listener = None
+		_instances.add(self)
+		# the cleanup daemon sleeps until the earliest deadline of each of
+		#   its schedules, and is told on this channel about sooner ones
+		self.wake_channel = self.prefix + 'cleanup-wake'
+		self.wake_local = threading.local()
+		self.key_ttl = _setting('WHINBOX_REDIS_KEY_TTL', False)
+		if self.key_ttl:
+			self.key_ttl_prefix = self.prefix
+		else:
+			self.key_ttl_prefix = ''
+		self.refresh_window = _setting('WHINBOX_REFRESH_WINDOW', 1)
+		self.refresh_lock = threading.Lock()
+		self.recent_refreshes = collections.OrderedDict()
+		self.async_clients = weakref.WeakKeyDictionary()
 
 	def _get_redis(self):
-		self.lock.acquire()
-		if not self.redis:
-			self.redis = redis.Redis(host=self.host, port=self.port, db=self.db, decode_responses=True)
-		self.lock.release()
 		return self.redis
 
-	@staticmethod
-	def _gen_id():
-		return ''.join(random.choice(string.ascii_letters + string.digits) for n in range(8))
+	def _get_async(self):
+		loop = asyncio.get_running_loop()
+		client = self.async_clients.get(loop)
+		if client is None:
+			with _lock:
+				client = self.async_clients.get(loop)
+				if client is None:
+					client = _AsyncClient(self._async_scripts)
+					self.async_clients[loop] = client
+		return client
+
+	# return True if this process already refreshed the inbox within the
+	#   coalescing window, else note the refresh about to be made
+	def _refresh_coalesced(self, id):
+		now = time.monotonic()
+		with self.refresh_lock:
+			last = self.recent_refreshes.get(id)
+			if last is not None and now - last < self.refresh_window:
+				return True
+			self.recent_refreshes[id] = now
+			self.recent_refreshes.move_to_end(id)
+			while len(self.recent_refreshes) > 10000:
+				self.recent_refreshes.popitem(last=False)
+			return False
+
+	# refresh on read, skipping it if enough of the ttl is left
+	def _refresh_lazily(self, id):
+		r = self._get_redis()
+		exp_key = self._schedule_key('inbox-exp', self._partition(id))
+		now = RedisOps._timestamp_utcnow()
+		exp_time = r.zscore(exp_key, id)
+		ttl = self.inbox_get(id)['ttl']
+		if exp_time is None or exp_time - now <= ttl * self.refresh_fraction:
+			self.inbox_refresh(id)
+
+	# a forked child has none of the parent's threads, event loops or held
+	#   locks. without the listener the cache would never be invalidated,
+	#   so it stays off until the child starts its own
+	def _after_fork(self):
+		self.invalidation_listener = None
+		if self.inbox_cache is not None:
+			self.inbox_cache.lock = threading.Lock()
+			self.inbox_cache.set_active(False)
+		self.refresh_lock = threading.Lock()
+		self.async_clients = weakref.WeakKeyDictionary()
+
+	def _start_invalidation_listener(self):
+		with _lock:
+			if self.invalidation_listener is None:
+				self.invalidation_listener = threading.Thread(target=self._listen_invalidations, daemon=True)
+				self.invalidation_listener.start()
+
+	# keeps the inbox cache in step with changes made by other workers.
+	#   if the subscription drops, the cache is cleared and bypassed until
+	#   it's back
+	def _listen_invalidations(self):
+		channel = self.prefix + 'inbox-invalidate'
+		while True:
+			pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+			try:
+				pubsub.subscribe(channel)
+				self.inbox_cache.set_active(True)
+				while True:
+					message = pubsub.get_message(timeout=1.0)
+					if message is not None and message['type'] == 'message':
+						self.inbox_cache.invalidate(message['data'])
+			except Exception:
+				pass
+			finally:
+				self.inbox_cache.set_active(False)
+				try:
+					pubsub.close()
+				except Exception:
+					pass
+			time.sleep(1)
 
+	# first is the earliest entry of a schedule, from zrange 0 0 withscores
+	#   before adding deadline
+	# return True if a cleanup daemon should be woken for it
 	@staticmethod
-	def _validate_id(id):
-		for c in id:
-			if c not in string.ascii_letters and c not in string.digits and c not in '_-@':
-				raise InvalidId('id contains invalid character: %s' % c)
+	def _is_sooner(first, deadline):
+		return len(first) == 0 or deadline < first[0][1]
 
 	@staticmethod
-	def _timestamp_utcnow():
-		return calendar.timegm(datetime.utcnow().utctimetuple())
+	def _validate_item_id(item_id):
+		if not item_id.isdigit():
+			raise InvalidId('invalid item id: %s' % item_id)
+
+	# queue an expireat of every key of the inbox, if keys carry ttls
+	def _expire_inbox_keys(self, pipe, id, exp_time):
+		if self.key_ttl:
+			for name in _inbox_key_names:
+				pipe.expireat(self.prefix + name + id, exp_time)
+
+	# give keys created since the inbox was last refreshed its ttl
+	def _expire_with_inbox(self, id):
+		if not self.key_ttl:
+			return
+		r = self._get_redis()
+		ttl = r.pttl(self.prefix + 'inbox-' + id)
+		if ttl > 0:
+			with r.pipeline(transaction=False) as pipe:
+				for name in _inbox_key_names:
+					pipe.pexpire(self.prefix + name + id, ttl)
+				pipe.execute()
 
 	# if id=None, then a random id will be used
 	# return the id used
-	def inbox_create(self, id, ttl, response_mode):
+	@metrics.measured
+	def inbox_create(self, id, ttl, response_mode, body_max=None, wait_timeout=None):
 		if id is not None:
 			RedisOps._validate_id(id)
 		assert(isinstance(ttl, int))
@@ -65,8 +1069,11 @@ class RedisOps(object):
 		val = dict()
 		val['ttl'] = ttl
 		val['response_mode'] = response_mode
+		if body_max is not None:
+			val['body_max'] = body_max
+		if wait_timeout is not None:
+			val['wait_timeout'] = wait_timeout
 		set_key = self.prefix + 'inbox'
-		exp_key = self.prefix + 'inbox-exp'
 		now = RedisOps._timestamp_utcnow()
 		while True:
 			with r.pipeline() as pipe:
@@ -76,6 +1083,7 @@ class RedisOps(object):
 					else:
 						try_id = RedisOps._gen_id()
 					key = self.prefix + 'inbox-' + try_id
+					exp_key = self._schedule_key('inbox-exp', self._partition(try_id))
 					pipe.watch(key)
 					pipe.watch(exp_key)
 					if pipe.exists(key):
@@ -86,22 +1094,33 @@ class RedisOps(object):
 							continue
 					exp_time = now + ttl
 					pipe.multi()
+					pipe.zrange(exp_key, 0, 0, withscores=True)
 					pipe.set(key, json.dumps(val))
 					pipe.sadd(set_key, try_id)
 					pipe.zadd(exp_key, {try_id: exp_time})
-					pipe.execute()
+					self._expire_inbox_keys(pipe, try_id, exp_time)
+					ret = pipe.execute()
+					if RedisOps._is_sooner(ret[0], exp_time):
+						r.publish(self.wake_channel, 'inboxes')
 					return try_id
 				except redis.WatchError:
+					metrics.watch_retry('inbox_create')
 					continue
 
+	@metrics.measured
 	def inbox_delete(self, id):
 		RedisOps._validate_id(id)
 		r = self._get_redis()
 		key = self.prefix + 'inbox-' + id
 		set_key = self.prefix + 'inbox'
-		exp_key = self.prefix + 'inbox-exp'
+		exp_key = self._schedule_key('inbox-exp', self._partition(id))
 		items_key = self.prefix + 'inbox-items-' + id
 		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		items_created_key = self.prefix + 'inbox-items-created-' + id
+		stream_key = self.prefix + 'inbox-stream-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		req_pending_key = self.prefix + 'req-pending-' + id
+		dirty_key = self._schedule_key('inbox-dirty', self._partition(id))
 		while True:
 			with r.pipeline() as pipe:
 				try:
@@ -112,28 +1131,52 @@ class RedisOps(object):
 					pipe.delete(key)
 					pipe.srem(set_key, id)
 					pipe.zrem(exp_key, id)
+					pipe.zrem(dirty_key, id)
 					pipe.delete(items_key)
 					pipe.delete(items_baseindex_key)
+					pipe.delete(items_created_key)
+					pipe.delete(stream_key)
+					pipe.delete(bodies_key)
+					pipe.delete(req_pending_key)
+					pipe.publish(self.prefix + 'inbox-invalidate', id)
 					pipe.execute()
 					break
 				except redis.WatchError:
+					metrics.watch_retry('inbox_delete')
 					continue
 
+	@metrics.measured
 	def inbox_get(self, id):
 		RedisOps._validate_id(id)
+		if self.inbox_cache is not None:
+			if self.invalidation_listener is None:
+				self._start_invalidation_listener()
+			val, generation = self.inbox_cache.get(id)
+			if val is not None:
+				return val
 		r = self._get_redis()
 		key = self.prefix + 'inbox-' + id
 		val_json = r.get(key)
 		if val_json is None:
 			raise ObjectDoesNotExist('No such inbox: %s' + id)
-		return json.loads(val_json)
+		val = json.loads(val_json)
+		if self.inbox_cache is not None:
+			self.inbox_cache.put(id, val, generation)
+		return val
+
+	# return dict of inbox cache counters, or None if there is no cache
+	def inbox_cache_stats(self):
+		if self.inbox_cache is None:
+			return None
+		return self.inbox_cache.stats()
 
+	@metrics.measured
 	def inbox_refresh(self, id, newttl=None):
 		assert(not newttl or isinstance(newttl, int))
 		RedisOps._validate_id(id)
 		r = self._get_redis()
 		key = self.prefix + 'inbox-' + id
-		exp_key = self.prefix + 'inbox-exp'
+		exp_key = self._schedule_key('inbox-exp', self._partition(id))
 		now = RedisOps._timestamp_utcnow()
 		while True:
 			with r.pipeline() as pipe:
@@ -150,27 +1193,75 @@ class RedisOps(object):
 					pipe.multi()
 					pipe.set(key, json.dumps(val))
 					pipe.zadd(exp_key, {id: exp_time})
+					self._expire_inbox_keys(pipe, id, exp_time)
+					if newttl is not None:
+						pipe.publish(self.prefix + 'inbox-invalidate', id)
 					pipe.execute()
 					break
 				except redis.WatchError:
+					metrics.watch_retry('inbox_refresh')
 					continue
 
-	def inbox_next_expiration(self):
+	# partition 0 keeps the key names from before schedules were
+	#   partitioned
+	def _schedule_key(self, name, partition):
+		if partition == 0:
+			return self.prefix + name
+		return self.prefix + name + ':' + str(partition)
+
+	# return the earliest score of the named schedule across partitions, or
+	#   None
+	def _schedule_next(self, name, partition):
 		r = self._get_redis()
-		exp_key = self.prefix + 'inbox-exp'
-		items = r.zrange(exp_key, 0, 0, withscores=True)
-		if len(items) > 0:
-			return int(items[0][1])
-		else:
-			return None
+		with r.pipeline(transaction=False) as pipe:
+			for p in self._partition_list(partition):
+				pipe.zrange(self._schedule_key(name, p), 0, 0, withscores=True)
+			out = None
+			for items in pipe.execute():
+				if len(items) > 0 and (out is None or items[0][1] < out):
+					out = items[0][1]
+		return out
 
-	def inbox_take_expired(self):
+	# return batches of take_batch(limit, partition) across partitions
+	def _take_partition_batches(self, take_batch, batch_size, time_budget, partition):
+		out = list()
+		for p in self._partition_list(partition):
+			out.extend(self._take_batches(functools.partial(take_batch, partition=p), batch_size, time_budget))
+		return out
+
+	@metrics.measured
+	def inbox_next_expiration(self, partition=None):
+		return self._schedule_next('inbox-exp', partition)
+
+	# return list of batches, each a list of inbox values
+	@metrics.measured
+	def inbox_take_expired(self, batch_size=None, time_budget=None, partition=None):
+		return self._take_partition_batches(self._inbox_take_expired_batch, batch_size, time_budget, partition)
+
+	@metrics.measured
+	def inbox_next_dirty(self, partition=None):
+		return self._schedule_next('inbox-dirty', partition)
+
+	def _inbox_take_expired_batch(self, limit, partition):
 		out = list()
 		r = self._get_redis()
 		set_key = self.prefix + 'inbox'
-		exp_key = self.prefix + 'inbox-exp'
+		exp_key = self._schedule_key('inbox-exp', partition)
+		dirty_key = self._schedule_key('inbox-dirty', partition)
 		now = RedisOps._timestamp_utcnow()
-		while True:
+		if self.use_scripts:
+			ret = self.take_expired_inboxes_script(
+				keys=[exp_key, set_key, dirty_key],
+				args=[now, limit, self.prefix])
+			for n in range(0, len(ret), 2):
+				if ret[n + 1]:
+					val = json.loads(ret[n + 1])
+				else:
+					val = dict()
+				val['id'] = ret[n]
+				out.append(val)
+			return out
+		while len(out) < limit:
 			with r.pipeline() as pipe:
 				try:
 					pipe.watch(exp_key)
@@ -185,37 +1276,56 @@ class RedisOps(object):
 					key = self.prefix + 'inbox-' + id
 					items_key = self.prefix + 'inbox-items-' + id
 					items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+					items_created_key = self.prefix + 'inbox-items-created-' + id
+					stream_key = self.prefix + 'inbox-stream-' + id
+					bodies_key = self.prefix + 'inbox-bodies-' + id
+					req_pending_key = self.prefix + 'req-pending-' + id
 
-					val = json.loads(pipe.get(key))
+					# the key is gone already if it carried a ttl
+					val_json = pipe.get(key)
+					if val_json is not None:
+						val = json.loads(val_json)
+					else:
+						val = dict()
 
 					pipe.multi()
 					pipe.delete(key)
 					pipe.srem(set_key, id)
 					pipe.zrem(exp_key, id)
+					pipe.zrem(dirty_key, id)
 					pipe.delete(items_key)
 					pipe.delete(items_baseindex_key)
+					pipe.delete(items_created_key)
+					pipe.delete(stream_key)
+					pipe.delete(bodies_key)
+					pipe.delete(req_pending_key)
+					pipe.publish(self.prefix + 'inbox-invalidate', id)
 					pipe.execute()
 
 					val['id'] = id
 					out.append(val)
 					# note: don't break on success
 				except redis.WatchError:
+					metrics.watch_retry('inbox_take_expired')
 					continue
 		return out
 
-	# return ids of all inboxes
-	def inbox_get_all(self):
+	# iterate over ids of all inboxes without loading the whole set
+	def inbox_iter_all(self, count=1000):
 		r = self._get_redis()
 		set_key = self.prefix + 'inbox'
-		return set(r.smembers(set_key))
+		return r.sscan_iter(set_key, count=count)
 
 	# return (item id, prev_id, created)
-	def inbox_append_item(self, id, item):
+	@metrics.measured
+	def inbox_append_item(self, id, item, body=None):
 		RedisOps._validate_id(id)
 		r = self._get_redis()
 		key = self.prefix + 'inbox-' + id
 		items_key = self.prefix + 'inbox-items-' + id
 		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		items_created_key = self.prefix + 'inbox-items-created-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
 		while True:
 			with r.pipeline() as pipe:
 				try:
@@ -232,7 +1342,10 @@ class RedisOps(object):
 						baseindex = 0
 					item['created'] = RedisOps._timestamp_utcnow()
 					pipe.multi()
-					pipe.rpush(items_key, json.dumps(item))
+					pipe.rpush(items_key, encode_item(item, self.item_encoding))
+					pipe.rpush(items_created_key, item['created'])
+					if body:
+						pipe.hset(bodies_key, baseindex + end_pos, _pack_body(body))
 					pipe.execute()
 					prev_pos = baseindex + end_pos - 1
 					if prev_pos != -1:
@@ -240,9 +1353,53 @@ class RedisOps(object):
 					else:
 						return (str(baseindex + end_pos), '', item['created'])
 				except redis.WatchError:
+					metrics.watch_retry('inbox_append_item')
 					continue
 
+	# append an item and trim the inbox in one step
+	# return (item id, prev_id, created)
+	@metrics.measured
+	def inbox_ingest_item(self, id, item, body=None):
+		if not self.use_scripts:
+			ret = self.inbox_append_item(id, item, body)
+			trimmed = self.inbox_clear_expired_items(id)
+			if trimmed > 0:
+				metrics.inc('whinbox_items_trimmed_total', 'where="ingest"', trimmed)
+			self._expire_with_inbox(id)
+			return ret
+
+		keys, args, now = self._ingest_call(id, item, body)
+		return self._ingest_result(id, self.append_item_script(keys=keys, args=args), now)
+
+	# return (keys, args, now) of the append script
+	def _ingest_call(self, id, item, body):
+		RedisOps._validate_id(id)
+		key = self.prefix + 'inbox-' + id
+		items_key = self.prefix + 'inbox-items-' + id
+		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		items_created_key = self.prefix + 'inbox-items-created-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		dirty_key = self._schedule_key('inbox-dirty', self._partition(id))
+		now = RedisOps._timestamp_utcnow()
+		item['created'] = now
+		keys = [key, items_key, items_baseindex_key, items_created_key, bodies_key, dirty_key]
+		args = [encode_item(item, self.item_encoding), now, self.item_max, self.item_burst_time, self.item_burst_max, id, _pack_body(body) if body else '', self.wake_channel, self.key_ttl_prefix]
+		return (keys, args, now)
+
+	# return (item id, prev_id, created)
+	def _ingest_result(self, id, ret, now):
+		if ret is None:
+			raise ObjectDoesNotExist('No such inbox: %s' + id)
+		if int(ret[1]) > 0:
+			metrics.inc('whinbox_items_trimmed_total', 'where="ingest"', int(ret[1]))
+		item_pos = int(ret[0])
+		if item_pos > 0:
+			return (str(item_pos), str(item_pos - 1), now)
+		else:
+			return (str(item_pos), '', now)
+
 	# return (list, last_id)
+	@metrics.measured
 	def inbox_get_items_after(self, id, item_id, item_max):
 		RedisOps._validate_id(id)
 		assert(not item_max or item_max > 0)
@@ -288,14 +1445,16 @@ class RedisOps(object):
 					items_json = ret[0]
 					items = list()
 					for n, i in enumerate(items_json):
-						item = json.loads(i)
+						item = decode_item(i)
 						item['id'] = str(baseindex + start_pos + n)
 						items.append(item)
 					return (items, str(baseindex + end_pos))
 				except redis.WatchError:
+					metrics.watch_retry('inbox_get_items_after')
 					continue
 
 	# return (list, last_id, eof)
+	@metrics.measured
 	def inbox_get_items_before(self, id, item_id, item_max):
 		RedisOps._validate_id(id)
 		assert(not item_max or item_max > 0)
@@ -343,13 +1502,132 @@ class RedisOps(object):
 					items_json = ret[0]
 					items = list()
 					for n, i in enumerate(items_json):
-						item = json.loads(i)
+						item = decode_item(i)
 						item['id'] = str(baseindex + start_pos + n)
 						items.insert(0, item)
 					return (items, str(baseindex + start_pos), start_pos == 0)
 				except redis.WatchError:
+					metrics.watch_retry('inbox_get_items_before')
 					continue
 
+	# the index of creation times is aligned with the end of the item list.
+	#   items stored before the index existed are missing from its start
+	# return (first id, last id) of the items created within [start, end],
+	#   or None if there are no such items
+	@metrics.measured
+	def inbox_get_item_range_by_time(self, id, start=None, end=None):
+		RedisOps._validate_id(id)
+		r = self._get_redis()
+		key = self.prefix + 'inbox-' + id
+		items_key = self.prefix + 'inbox-items-' + id
+		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		items_created_key = self.prefix + 'inbox-items-created-' + id
+		with r.pipeline() as pipe:
+			pipe.exists(key)
+			pipe.llen(items_key)
+			pipe.get(items_baseindex_key)
+			pipe.lrange(items_created_key, 0, -1)
+			exists, count, baseindex, created = pipe.execute()
+		if not exists:
+			raise ObjectDoesNotExist('No such inbox: %s' + id)
+		if baseindex is not None:
+			baseindex = int(baseindex)
+		else:
+			baseindex = 0
+		created = [int(t) for t in created[-count:]] if count > 0 else []
+		offset = count - len(created)
+		if start is not None:
+			start_pos = bisect.bisect_left(created, start)
+		else:
+			start_pos = 0
+		if end is not None:
+			end_pos = bisect.bisect_right(created, end) - 1
+		else:
+			end_pos = len(created) - 1
+		if start_pos > end_pos:
+			return None
+		return (str(baseindex + offset + start_pos), str(baseindex + offset + end_pos))
+
+	# fetch a page of items, optionally refreshing the inbox, in one step.
+	#   if reverse is set, items are returned newest first
+	# return (list, last_id, eof, set of pending item ids)
+	@metrics.measured
+	def inbox_read_items(self, id, item_id, item_max, reverse=False, refresh=True):
+		if refresh and self._refresh_coalesced(id):
+			refresh = False
+		if not self.use_scripts:
+			if refresh:
+				self._refresh_lazily(id)
+			if reverse:
+				items, last_id, eof = self.inbox_get_items_before(id, item_id, item_max)
+			else:
+				items, last_id = self.inbox_get_items_after(id, item_id, item_max)
+				eof = False
+			pending = self.request_get_pending(id, [i['id'] for i in items])
+			return (items, last_id, eof, pending)
+
+		call = self._read_call(id, item_id, item_max, reverse, refresh)
+		if call is None:
+			return (list(), '', True, set())
+		return self._read_result(id, self.read_items_script(keys=call[0], args=call[1]), reverse)
+
+	# return (keys, args) of the read script, or None if there is nothing
+	#   to read
+	def _read_call(self, id, item_id, item_max, reverse, refresh):
+		RedisOps._validate_id(id)
+		assert(not item_max or item_max > 0)
+		if item_id is not None and len(item_id) > 0:
+			if reverse:
+				item_pos = int(item_id) - 1
+				if item_pos < 0:
+					return None
+			else:
+				item_pos = int(item_id) + 1
+		else:
+			item_pos = -1
+		key = self.prefix + 'inbox-' + id
+		items_key = self.prefix + 'inbox-items-' + id
+		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		exp_key = self._schedule_key('inbox-exp', self._partition(id))
+		req_pending_key = self.prefix + 'req-pending-' + id
+		now = RedisOps._timestamp_utcnow()
+		keys = [key, items_key, items_baseindex_key, exp_key, req_pending_key]
+		args = ['1' if reverse else '0', item_pos, item_max or 0, now, '1' if refresh else '0', id, self.refresh_fraction, self.key_ttl_prefix]
+		return (keys, args)
+
+	# return (list, last_id, eof, set of pending item ids)
+	def _read_result(self, id, ret, reverse):
+		if ret is None:
+			raise ObjectDoesNotExist('No such inbox: %s' + id)
+		last_pos, eof, start_pos, items_json, pending_flags = ret
+		items = list()
+		pending = set()
+		for n, i in enumerate(items_json):
+			item = decode_item(i)
+			item['id'] = str(start_pos + n)
+			if pending_flags[n]:
+				pending.add(item['id'])
+			items.append(item)
+		if reverse:
+			items.reverse()
+		if last_pos != -1:
+			last_id = str(last_pos)
+		else:
+			last_id = ''
+		return (items, last_id, eof == 1, pending)
+
+	@metrics.measured
+	def inbox_get_item_body(self, id, item_id):
+		RedisOps._validate_id(id)
+		self._validate_item_id(item_id)
+		r = self._get_redis()
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		body = r.hget(bodies_key, item_id)
+		if body is None:
+			raise ObjectDoesNotExist('No stored body: %s' % item_id)
+		return _unpack_body(body)
+
+	@metrics.measured
 	def inbox_get_newest_id(self, id):
 		RedisOps._validate_id(id)
 		r = self._get_redis()
@@ -377,28 +1655,41 @@ class RedisOps(object):
 					pipe.execute()
 					return str(baseindex + last_pos)
 				except redis.WatchError:
+					metrics.watch_retry('inbox_get_newest_id')
 					continue
 
+	@metrics.measured
 	def inbox_clear_expired_items(self, id):
 		RedisOps._validate_id(id)
 		r = self._get_redis()
 		items_key = self.prefix + 'inbox-items-' + id
 		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		items_created_key = self.prefix + 'inbox-items-created-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		dirty_key = self._schedule_key('inbox-dirty', self._partition(id))
 		now = RedisOps._timestamp_utcnow()
+		if self.use_scripts:
+			return self.clear_expired_items_script(
+				keys=[items_key, items_baseindex_key, items_created_key, bodies_key, dirty_key],
+				args=[now, self.item_max, self.item_burst_time, self.item_burst_max, id])
 		total = 0
+		due = None
 		while True:
 			with r.pipeline() as pipe:
 				try:
 					pipe.watch(items_key)
 					pipe.watch(items_baseindex_key)
+					pipe.watch(items_created_key)
 
 					items = pipe.lrange(items_key, 0, 0)
 					if not items:
 						break
 
-					item = json.loads(items[0])
+					item = decode_item(items[0])
 
 					count = pipe.llen(items_key)
+					created_count = pipe.llen(items_created_key)
+					baseindex = int(pipe.get(items_baseindex_key) or 0)
 
 					item_pos = 0
 					item_time = item['created']
@@ -412,10 +1703,15 @@ class RedisOps(object):
 							expire = True
 
 					if not expire:
+						if count > self.item_max:
+							due = item_time + self.item_burst_time
 						break
 
 					pipe.multi()
 					pipe.lpop(items_key)
+					if created_count >= count:
+						pipe.lpop(items_created_key)
+					pipe.hdel(bodies_key, baseindex)
 					pipe.incr(items_baseindex_key)
 					pipe.execute()
 
@@ -423,15 +1719,63 @@ class RedisOps(object):
 
 					# note: don't break on success
 				except redis.WatchError:
+					metrics.watch_retry('inbox_clear_expired_items')
 					continue
+		if due is not None:
+			first = r.zrange(dirty_key, 0, 0, withscores=True)
+			r.zadd(dirty_key, {id: due})
+			if RedisOps._is_sooner(first, due):
+				r.publish(self.wake_channel, 'items')
+		else:
+			r.zrem(dirty_key, id)
 		return total
 
-	def request_add_pending(self, inbox_id, item_id):
+	# trim inboxes queued in the dirty set whose oldest items have left the
+	#   burst window
+	# return (items trimmed, inboxes visited)
+	@metrics.measured
+	def inbox_clear_dirty_items(self, batch_size=None, time_budget=None, partition=None):
+		batches = self._take_partition_batches(self._inbox_clear_dirty_batch, batch_size, time_budget, partition)
+		count = 0
+		inboxes = 0
+		for batch in batches:
+			count += sum(n for _, n in batch)
+			inboxes += len(batch)
+		return (count, inboxes)
+
+	# return list((inbox id, items trimmed))
+	def _inbox_clear_dirty_batch(self, limit, partition):
+		r = self._get_redis()
+		dirty_key = self._schedule_key('inbox-dirty', partition)
+		now = RedisOps._timestamp_utcnow()
+		if self.use_scripts:
+			ret = self.clear_dirty_items_script(
+				keys=[dirty_key],
+				args=[now, limit, self.prefix, self.item_max, self.item_burst_time, self.item_burst_max])
+			return [(ret[n], ret[n + 1]) for n in range(0, len(ret), 2)]
+		out = list()
+		for id in r.zrangebyscore(dirty_key, '-inf', now, start=0, num=limit):
+			out.append((id, self.inbox_clear_expired_items(id)))
+		return out
+
+	# a pending request's key outlives its deadline by a grace period, so
+	#   that cleanup can still find the inbox to answer it
+	# return ttl in seconds for the key, or None
+	def _request_key_ttl(self, timeout):
+		if not self.key_ttl:
+			return None
+		return int(math.ceil(timeout)) + 60
+
+	@metrics.measured
+	def request_add_pending(self, inbox_id, item_id, timeout=None):
+		if timeout is None:
+			timeout = self.wait_timeout
 		r = self._get_redis()
 		req_id = inbox_id + '-' + item_id
 		req_key = self.prefix + 'req-item-' + req_id
-		req_exp_key = self.prefix + 'req-exp'
-		now = RedisOps._timestamp_utcnow()
+		req_exp_key = self._schedule_key('req-exp', self._partition(inbox_id))
+		req_pending_key = self.prefix + 'req-pending-' + inbox_id
+		now = RedisOps._timestamp_precise()
 		while True:
 			with r.pipeline() as pipe:
 				try:
@@ -439,20 +1783,30 @@ class RedisOps(object):
 					pipe.watch(req_exp_key)
 					if pipe.exists(req_key):
 						raise ObjectExists()
-					exp_time = now + 20
+					exp_time = now + timeout
 					pipe.multi()
-					pipe.set(req_key, json.dumps([inbox_id, item_id]))
+					pipe.zrange(req_exp_key, 0, 0, withscores=True)
+					pipe.set(req_key, json.dumps([inbox_id, item_id]), ex=self._request_key_ttl(timeout))
 					pipe.zadd(req_exp_key, {req_id: exp_time})
-					pipe.execute()
+					pipe.sadd(req_pending_key, item_id)
+					pipe.pttl(self.prefix + 'inbox-' + inbox_id)
+					ret = pipe.execute()
+					if RedisOps._is_sooner(ret[0], exp_time):
+						r.publish(self.wake_channel, 'requests')
+					if self.key_ttl and ret[4] > 0:
+						r.pexpire(req_pending_key, ret[4])
 					break
 				except redis.WatchError:
+					metrics.watch_retry('request_add_pending')
 					continue
 
+	@metrics.measured
 	def request_remove_pending(self, inbox_id, item_id):
 		r = self._get_redis()
 		req_id = inbox_id + '-' + item_id
 		req_key = self.prefix + 'req-item-' + req_id
-		req_exp_key = self.prefix + 'req-exp'
+		req_exp_key = self._schedule_key('req-exp', self._partition(inbox_id))
+		req_pending_key = self.prefix + 'req-pending-' + inbox_id
 		while True:
 			with r.pipeline() as pipe:
 				try:
@@ -463,24 +1817,192 @@ class RedisOps(object):
 					pipe.multi()
 					pipe.delete(req_key)
 					pipe.zrem(req_exp_key, req_id)
+					pipe.srem(req_pending_key, item_id)
 					pipe.execute()
 					break
 				except redis.WatchError:
+					metrics.watch_retry('request_remove_pending')
 					continue
 
+	@metrics.measured
 	def request_is_pending(self, inbox_id, item_id):
 		r = self._get_redis()
-		req_id = inbox_id + '-' + item_id
-		req_key = self.prefix + 'req-item-' + req_id
-		return r.exists(req_key)
+		req_pending_key = self.prefix + 'req-pending-' + inbox_id
+		return r.sismember(req_pending_key, item_id)
 
-	# return list((inbox_id, item_id))
-	def request_take_expired(self):
-		out = list()
+	# return the subset of item_ids that have pending requests
+	@metrics.measured
+	def request_get_pending(self, inbox_id, item_ids):
+		if not item_ids:
+			return set()
 		r = self._get_redis()
-		req_exp_key = self.prefix + 'req-exp'
-		now = RedisOps._timestamp_utcnow()
+		req_pending_key = self.prefix + 'req-pending-' + inbox_id
+		flags = r.smismember(req_pending_key, item_ids)
+		return set(i for i, f in zip(item_ids, flags) if f)
+
+	# return list of batches, each a list((inbox_id, item_id))
+	@metrics.measured
+	def request_take_expired(self, batch_size=None, time_budget=None, partition=None):
+		return self._take_partition_batches(self._request_take_expired_batch, batch_size, time_budget, partition)
+
+	@metrics.measured
+	def request_next_expiration(self, partition=None):
+		return self._schedule_next('req-exp', partition)
+
+	# return True if woken early
+	def schedule_wait(self, timeout):
+		# one subscription per cleanup worker thread
+		pubsub = getattr(self.wake_local, 'pubsub', None)
+		if pubsub is None:
+			pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+			pubsub.subscribe(self.wake_channel)
+			self.wake_local.pubsub = pubsub
+		deadline = time.monotonic() + timeout
+		try:
+			while True:
+				left = deadline - time.monotonic()
+				if left <= 0:
+					return False
+				message = pubsub.get_message(timeout=left)
+				if message is not None and message['type'] == 'message':
+					# a burst of inserts needs only one wakeup
+					while pubsub.get_message() is not None:
+						pass
+					return True
+		except Exception:
+			# resubscribe on the next call
+			try:
+				pubsub.close()
+			except Exception:
+				pass
+			self.wake_local.pubsub = None
+			raise
+
+	# return True if the listener was started
+	def inbox_watch_expired(self, on_expired):
+		if not self.key_ttl:
+			return False
+		r = self._get_redis()
+		try:
+			events = r.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+			# 'A' covers every class of event, 'x' just expirations
+			if 'E' not in events or ('x' not in events and 'A' not in events):
+				r.config_set('notify-keyspace-events', events + 'Ex')
+		except Exception:
+			# managed redis services often refuse config commands. the
+			#   setting can be made there instead
+			return False
+		thread = threading.Thread(target=self._listen_expired, args=(on_expired,), daemon=True)
+		thread.start()
+		return True
+
+	# sub-keys of an inbox share its key's prefix and expire with it
+	_inbox_sub_key_names = tuple(n[len('inbox-'):] for n in _inbox_key_names if n.startswith('inbox-') and n != 'inbox-')
+
+	def _listen_expired(self, on_expired):
+		db = self.redis.connection_pool.connection_kwargs.get('db', 0)
+		channel = '__keyevent@%d__:expired' % db
+		inbox_prefix = self.prefix + 'inbox-'
 		while True:
+			pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+			try:
+				pubsub.subscribe(channel)
+				while True:
+					message = pubsub.get_message(timeout=1.0)
+					if message is None or message['type'] != 'message':
+						continue
+					key = message['data']
+					if not key.startswith(inbox_prefix):
+						continue
+					id = key[len(inbox_prefix):]
+					partition = self._partition(id)
+					# ids may contain dashes, so inbox-items-abc is either a
+					#   sub-key of inbox abc or the key of inbox items-abc.
+					#   only the latter is still on the schedule
+					if id.startswith(self._inbox_sub_key_names):
+						if self.redis.zscore(self._schedule_key('inbox-exp', partition), id) is None:
+							continue
+					on_expired(partition)
+			except Exception:
+				pass
+			finally:
+				try:
+					pubsub.close()
+				except Exception:
+					pass
+			time.sleep(1)
+
+	@metrics.measured
+	def cleanup_claim_partitions(self, owner, lease_time):
+		ret = self.claim_partitions_script(
+			keys=[self.prefix + 'cleanup-workers'],
+			args=[owner, int(time.time() * 1000), int(lease_time * 1000), self.partitions, self.prefix])
+		return [int(p) for p in ret]
+
+	@metrics.measured
+	def cleanup_release_partitions(self, owner):
+		self.release_partitions_script(
+			keys=[self.prefix + 'cleanup-workers'],
+			args=[owner, self.partitions, self.prefix])
+
+	# meant to be run with the web workers already on the new layout
+	@metrics.measured
+	def cleanup_repartition(self, old_partitions):
+		r = self._get_redis()
+		moved = 0
+		for name in ('inbox-exp', 'inbox-dirty', 'req-exp'):
+			for p in range(0, old_partitions):
+				src = self._schedule_key(name, p)
+				for member, score in list(r.zscan_iter(src)):
+					if name == 'req-exp':
+						# request ids can't be split reliably, so look up
+						#   the inbox
+						val = r.get(self.prefix + 'req-item-' + member)
+						if val is None:
+							continue
+						inbox_id = json.loads(val)[0]
+					else:
+						inbox_id = member
+					dest = self._schedule_key(name, self._partition(inbox_id))
+					if dest == src:
+						continue
+					# a deadline already in the new layout was set since
+					with r.pipeline() as pipe:
+						pipe.zadd(dest, {member: score}, nx=True)
+						pipe.zrem(src, member)
+						pipe.execute()
+					moved += 1
+		r.set(self.prefix + 'cleanup-partitions', self.partitions)
+		return moved
+
+	@metrics.measured
+	def cleanup_migrate_layout(self):
+		r = self._get_redis()
+		old_partitions = r.get(self.prefix + 'cleanup-partitions')
+		# deadlines from before the count was recorded are unpartitioned
+		if old_partitions is None:
+			old_partitions = 1
+		else:
+			old_partitions = int(old_partitions)
+		moved = 0
+		if old_partitions != self.partitions:
+			moved = self.cleanup_repartition(old_partitions)
+		return (old_partitions, moved)
+
+	def _request_take_expired_batch(self, limit, partition):
+		out = list()
+		r = self._get_redis()
+		req_exp_key = self._schedule_key('req-exp', partition)
+		now = RedisOps._timestamp_precise()
+		if self.use_scripts:
+			ret = self.take_expired_requests_script(
+				keys=[req_exp_key],
+				args=[now, limit, self.prefix])
+			for val_raw in ret:
+				val = json.loads(val_raw)
+				out.append((val[0], val[1]))
+			return out
+		while len(out) < limit:
 			with r.pipeline() as pipe:
 				try:
 					pipe.watch(req_exp_key)
@@ -488,7 +2010,7 @@ class RedisOps(object):
 					items = pipe.zrange(req_exp_key, 0, 0, withscores=True)
 					if len(items) == 0:
 						break
-					if int(items[0][1]) > now:
+					if items[0][1] > now:
 						break
 					req_id = items[0][0]
 
@@ -496,19 +2018,354 @@ class RedisOps(object):
 					pipe.watch(req_key)
 					val_raw = pipe.get(req_key)
 					if not val_raw:
+						# the key expired on its own
+						pipe.multi()
+						pipe.zrem(req_exp_key, req_id)
+						pipe.execute()
 						continue
 
 					val = json.loads(val_raw)
 					inbox_id = val[0]
 					item_id = val[1]
 
+					req_pending_key = self.prefix + 'req-pending-' + inbox_id
+
 					pipe.multi()
 					pipe.delete(req_key)
 					pipe.zrem(req_exp_key, req_id)
+					pipe.srem(req_pending_key, item_id)
 					pipe.execute()
 
 					out.append((inbox_id, item_id))
 					# note: don't break on success
 				except redis.WatchError:
+					metrics.watch_retry('request_take_expired')
 					continue
 		return out
+
+	# the calls of the async views, on the running loop's client. they
+	#   share the inbox cache and refresh coalescing with the blocking
+	#   calls. without scripts, the blocking calls run in a thread
+
+	@metrics.measured
+	async def inbox_create_async(self, id, ttl, response_mode, body_max=None, wait_timeout=None):
+		if id is not None:
+			RedisOps._validate_id(id)
+		assert(isinstance(ttl, int))
+		r = self._get_async().redis
+		val = dict()
+		val['ttl'] = ttl
+		val['response_mode'] = response_mode
+		if body_max is not None:
+			val['body_max'] = body_max
+		if wait_timeout is not None:
+			val['wait_timeout'] = wait_timeout
+		set_key = self.prefix + 'inbox'
+		now = RedisOps._timestamp_utcnow()
+		while True:
+			async with r.pipeline() as pipe:
+				try:
+					if id is not None:
+						try_id = id
+					else:
+						try_id = RedisOps._gen_id()
+					key = self.prefix + 'inbox-' + try_id
+					exp_key = self._schedule_key('inbox-exp', self._partition(try_id))
+					await pipe.watch(key, exp_key)
+					if await pipe.exists(key):
+						if id is not None:
+							raise ObjectExists()
+						else:
+							# try another random value
+							continue
+					pipe.multi()
+					pipe.zrange(exp_key, 0, 0, withscores=True)
+					pipe.set(key, json.dumps(val))
+					pipe.sadd(set_key, try_id)
+					pipe.zadd(exp_key, {try_id: now + ttl})
+					self._expire_inbox_keys(pipe, try_id, now + ttl)
+					ret = await pipe.execute()
+					if RedisOps._is_sooner(ret[0], now + ttl):
+						await r.publish(self.wake_channel, 'inboxes')
+					return try_id
+				except redis.WatchError:
+					metrics.watch_retry('inbox_create_async')
+					continue
+
+	@metrics.measured
+	async def inbox_get_async(self, id):
+		RedisOps._validate_id(id)
+		if self.inbox_cache is not None:
+			if self.invalidation_listener is None:
+				self._start_invalidation_listener()
+			val, generation = self.inbox_cache.get(id)
+			if val is not None:
+				return val
+		val_json = await self._get_async().redis.get(self.prefix + 'inbox-' + id)
+		if val_json is None:
+			raise ObjectDoesNotExist('No such inbox: %s' % id)
+		val = json.loads(val_json)
+		if self.inbox_cache is not None:
+			self.inbox_cache.put(id, val, generation)
+		return val
+
+	@metrics.measured
+	async def inbox_ingest_item_async(self, id, item, body=None):
+		if not self.use_scripts:
+			return await super(RedisOps, self).inbox_ingest_item_async(id, item, body)
+		keys, args, now = self._ingest_call(id, item, body)
+		ret = await self._get_async().append_item_script(keys=keys, args=args)
+		return self._ingest_result(id, ret, now)
+
+	@metrics.measured
+	async def inbox_read_items_async(self, id, item_id, item_max, reverse=False, refresh=True):
+		if not self.use_scripts:
+			return await super(RedisOps, self).inbox_read_items_async(id, item_id, item_max, reverse, refresh)
+		if refresh and self._refresh_coalesced(id):
+			refresh = False
+		call = self._read_call(id, item_id, item_max, reverse, refresh)
+		if call is None:
+			return (list(), '', True, set())
+		ret = await self._get_async().read_items_script(keys=call[0], args=call[1])
+		return self._read_result(id, ret, reverse)
+
+	@metrics.measured
+	async def request_add_pending_async(self, inbox_id, item_id, timeout=None):
+		if timeout is None:
+			timeout = self.wait_timeout
+		r = self._get_async().redis
+		req_id = inbox_id + '-' + item_id
+		req_key = self.prefix + 'req-item-' + req_id
+		req_exp_key = self._schedule_key('req-exp', self._partition(inbox_id))
+		req_pending_key = self.prefix + 'req-pending-' + inbox_id
+		now = RedisOps._timestamp_precise()
+		while True:
+			async with r.pipeline() as pipe:
+				try:
+					await pipe.watch(req_key, req_exp_key)
+					if await pipe.exists(req_key):
+						raise ObjectExists()
+					exp_time = now + timeout
+					pipe.multi()
+					pipe.zrange(req_exp_key, 0, 0, withscores=True)
+					pipe.set(req_key, json.dumps([inbox_id, item_id]), ex=self._request_key_ttl(timeout))
+					pipe.zadd(req_exp_key, {req_id: exp_time})
+					pipe.sadd(req_pending_key, item_id)
+					pipe.pttl(self.prefix + 'inbox-' + inbox_id)
+					ret = await pipe.execute()
+					if RedisOps._is_sooner(ret[0], exp_time):
+						await r.publish(self.wake_channel, 'requests')
+					if self.key_ttl and ret[4] > 0:
+						await r.pexpire(req_pending_key, ret[4])
+					break
+				except redis.WatchError:
+					metrics.watch_retry('request_add_pending_async')
+					continue
+
+	@metrics.measured
+	async def request_remove_pending_async(self, inbox_id, item_id):
+		r = self._get_async().redis
+		req_id = inbox_id + '-' + item_id
+		req_key = self.prefix + 'req-item-' + req_id
+		req_exp_key = self._schedule_key('req-exp', self._partition(inbox_id))
+		req_pending_key = self.prefix + 'req-pending-' + inbox_id
+		while True:
+			async with r.pipeline() as pipe:
+				try:
+					await pipe.watch(req_key, req_exp_key)
+					if not await pipe.exists(req_key):
+						raise ObjectDoesNotExist()
+					pipe.multi()
+					pipe.delete(req_key)
+					pipe.zrem(req_exp_key, req_id)
+					pipe.srem(req_pending_key, item_id)
+					await pipe.execute()
+					break
+				except redis.WatchError:
+					metrics.watch_retry('request_remove_pending_async')
+					continue
+
+class RedisStreamOps(RedisOps):
+	_async_scripts = (
+		('append_item_script', _stream_append_item_lua),
+		('read_items_script', _stream_read_items_lua)
+	)
+
+	def __init__(self):
+		super(RedisStreamOps, self).__init__()
+		self.stream_append_item_script = self.redis.register_script(_stream_append_item_lua)
+		self.stream_clear_expired_items_script = self.redis.register_script(_stream_clear_expired_items_lua)
+		self.stream_clear_dirty_items_script = self.redis.register_script(_stream_clear_dirty_items_lua)
+		self.stream_read_items_script = self.redis.register_script(_stream_read_items_lua)
+		self.migrate_list_to_stream_script = self.redis.register_script(_migrate_list_to_stream_lua)
+
+	@staticmethod
+	def _validate_item_id(item_id):
+		parts = item_id.split('-')
+		if len(parts) > 2 or not all(p.isdigit() for p in parts):
+			raise InvalidId('invalid item id: %s' % item_id)
+
+	@staticmethod
+	def _entry_time(entry_id):
+		return int(entry_id.split('-')[0]) // 1000
+
+	# return (item id, prev_id, created)
+	@metrics.measured
+	def inbox_ingest_item(self, id, item, body=None):
+		keys, args, now = self._ingest_call(id, item, body)
+		return self._ingest_result(id, self.stream_append_item_script(keys=keys, args=args), now)
+
+	def _ingest_call(self, id, item, body):
+		RedisOps._validate_id(id)
+		key = self.prefix + 'inbox-' + id
+		stream_key = self.prefix + 'inbox-stream-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		dirty_key = self._schedule_key('inbox-dirty', self._partition(id))
+		now = RedisOps._timestamp_utcnow()
+		item['created'] = now
+		keys = [key, stream_key, bodies_key, dirty_key]
+		args = [encode_item(item, self.item_encoding), now, self.item_max, self.item_burst_time, self.item_burst_max, id, _pack_body(body) if body else '', self.wake_channel, self.key_ttl_prefix]
+		return (keys, args, now)
+
+	def _ingest_result(self, id, ret, now):
+		if ret is None:
+			raise ObjectDoesNotExist('No such inbox: %s' % id)
+		item_id, prev_id, trimmed = ret
+		if int(trimmed) > 0:
+			metrics.inc('whinbox_items_trimmed_total', 'where="ingest"', int(trimmed))
+		return (item_id, prev_id, RedisStreamOps._entry_time(item_id))
+
+	# stream appends are always trimmed
+	@metrics.measured
+	def inbox_append_item(self, id, item, body=None):
+		return self.inbox_ingest_item(id, item, body)
+
+	# return (list, last_id, eof, set of pending item ids)
+	@metrics.measured
+	def inbox_read_items(self, id, item_id, item_max, reverse=False, refresh=True):
+		if refresh and self._refresh_coalesced(id):
+			refresh = False
+		call = self._read_call(id, item_id, item_max, reverse, refresh)
+		return self._read_result(id, self.stream_read_items_script(keys=call[0], args=call[1]), reverse)
+
+	def _read_call(self, id, item_id, item_max, reverse, refresh):
+		RedisOps._validate_id(id)
+		assert(not item_max or item_max > 0)
+		if item_id:
+			RedisStreamOps._validate_item_id(item_id)
+		else:
+			item_id = ''
+		key = self.prefix + 'inbox-' + id
+		stream_key = self.prefix + 'inbox-stream-' + id
+		exp_key = self._schedule_key('inbox-exp', self._partition(id))
+		req_pending_key = self.prefix + 'req-pending-' + id
+		now = RedisOps._timestamp_utcnow()
+		keys = [key, stream_key, exp_key, req_pending_key]
+		args = ['1' if reverse else '0', item_id, item_max or 0, now, '1' if refresh else '0', id, self.refresh_fraction, self.key_ttl_prefix]
+		return (keys, args)
+
+	def _read_result(self, id, ret, reverse):
+		if ret is None:
+			raise ObjectDoesNotExist('No such inbox: %s' % id)
+		last_id, eof, ids, items_json, pending_flags = ret
+		items = list()
+		pending = set()
+		for n, i in enumerate(items_json):
+			item = decode_item(i)
+			item['id'] = ids[n]
+			item['created'] = RedisStreamOps._entry_time(ids[n])
+			if pending_flags[n]:
+				pending.add(ids[n])
+			items.append(item)
+		return (items, last_id, eof == 1, pending)
+
+	# the stream engine has no separate read path
+	inbox_get_items_after = Backend.inbox_get_items_after
+	inbox_get_items_before = Backend.inbox_get_items_before
+
+	@metrics.measured
+	def inbox_get_newest_id(self, id):
+		RedisOps._validate_id(id)
+		r = self._get_redis()
+		key = self.prefix + 'inbox-' + id
+		stream_key = self.prefix + 'inbox-stream-' + id
+		with r.pipeline() as pipe:
+			pipe.exists(key)
+			pipe.xrevrange(stream_key, count=1)
+			exists, newest = pipe.execute()
+		if not exists:
+			raise ObjectDoesNotExist('No such inbox: %s' % id)
+		if len(newest) > 0:
+			return newest[0][0]
+		return ''
+
+	# return (first id, last id) of the items created within [start, end],
+	#   or None if there are no such items
+	@metrics.measured
+	def inbox_get_item_range_by_time(self, id, start=None, end=None):
+		RedisOps._validate_id(id)
+		r = self._get_redis()
+		key = self.prefix + 'inbox-' + id
+		stream_key = self.prefix + 'inbox-stream-' + id
+		if start is not None:
+			min_id = str(start * 1000)
+		else:
+			min_id = '-'
+		if end is not None:
+			max_id = str((end + 1) * 1000 - 1)
+		else:
+			max_id = '+'
+		with r.pipeline() as pipe:
+			pipe.exists(key)
+			pipe.xrange(stream_key, min=min_id, max=max_id, count=1)
+			pipe.xrevrange(stream_key, max=max_id, min=min_id, count=1)
+			exists, first, last = pipe.execute()
+		if not exists:
+			raise ObjectDoesNotExist('No such inbox: %s' % id)
+		if len(first) == 0:
+			return None
+		return (first[0][0], last[0][0])
+
+	@metrics.measured
+	def inbox_clear_expired_items(self, id):
+		RedisOps._validate_id(id)
+		stream_key = self.prefix + 'inbox-stream-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		dirty_key = self._schedule_key('inbox-dirty', self._partition(id))
+		now = RedisOps._timestamp_utcnow()
+		return self.stream_clear_expired_items_script(
+			keys=[stream_key, bodies_key, dirty_key],
+			args=[now, self.item_max, self.item_burst_time, self.item_burst_max, id])
+
+	# return list((inbox id, items trimmed))
+	def _inbox_clear_dirty_batch(self, limit, partition):
+		dirty_key = self._schedule_key('inbox-dirty', partition)
+		now = RedisOps._timestamp_utcnow()
+		ret = self.stream_clear_dirty_items_script(
+			keys=[dirty_key],
+			args=[now, limit, self.prefix, self.item_max, self.item_burst_time, self.item_burst_max])
+		return [(ret[n], ret[n + 1]) for n in range(0, len(ret), 2)]
+
+	# move the items of a list-based inbox into its stream, after any it
+	#   already has. item ids are derived from the creation times, so
+	#   cursors held by clients from before the move are not preserved
+	# return the number of items moved, None if the inbox already has a
+	#   stream and nothing is left in its list, or -1 if some of the items
+	#   have requests pending, in which case nothing is moved
+	@metrics.measured
+	def inbox_migrate_to_stream(self, id):
+		RedisOps._validate_id(id)
+		items_key = self.prefix + 'inbox-items-' + id
+		items_baseindex_key = self.prefix + 'inbox-items-baseindex-' + id
+		items_created_key = self.prefix + 'inbox-items-created-' + id
+		stream_key = self.prefix + 'inbox-stream-' + id
+		bodies_key = self.prefix + 'inbox-bodies-' + id
+		req_pending_key = self.prefix + 'req-pending-' + id
+		ret = self.migrate_list_to_stream_script(
+			keys=[items_key, items_baseindex_key, items_created_key, stream_key, bodies_key, req_pending_key])
+		if ret == -1:
+			return None
+		if ret == -2:
+			return -1
+		self._expire_with_inbox(id)
+		return ret
@@ -1,6 +1,630 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-#from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from unittest import mock, skipIf
+from asgiref.sync import async_to_sync, sync_to_async
+import redis
+import redis.asyncio
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+from django.urls import resolve
+from django_grip import GripMiddleware
+from . import async_views, backend, memory_ops, metrics, redis_ops, util, views
+from .publisher import Publisher
+from .middleware import BodyLimitMiddleware
 
-# Create your tests here.
+try:
+	import fakeredis
+except ImportError:
+	fakeredis = None
+
+# the api views and cleanup, run against each backend. publishes go
+#   nowhere, as there is no grip proxy
+class _ApiTests(object):
+	def setUp(self):
+		self.db = self.create_backend()
+		for module in (views, util):
+			patcher = mock.patch.object(module, 'db', self.db)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def create_backend(self):
+		raise NotImplementedError()
+
+	# move the clock of the backend forward
+	def advance(self, seconds):
+		now = time.time() + seconds
+		return mock.patch.multiple(
+			backend.Backend,
+			_timestamp_utcnow=staticmethod(lambda: int(now)),
+			_timestamp_precise=staticmethod(lambda: now))
+
+	def request(self, method, path, **kwargs):
+		return getattr(self.client, method)(path, HTTP_HOST='api.localhost', **kwargs)
+
+	def create(self, **params):
+		resp = self.request('post', '/create/', data=params)
+		self.assertEqual(resp.status_code, 200)
+		return json.loads(resp.content)['id']
+
+	def get_items(self, inbox_id):
+		resp = self.request('get', '/i/%s/items/' % inbox_id)
+		self.assertEqual(resp.status_code, 200)
+		return json.loads(resp.content)['items']
+
+	def test_create_hit_items(self):
+		inbox_id = self.create(ttl=60)
+		resp = self.request('get', '/i/%s/' % inbox_id)
+		self.assertEqual(json.loads(resp.content)['ttl'], 60)
+
+		for n in range(0, 3):
+			resp = self.request('post', '/i/%s/in/?n=%d' % (inbox_id, n), data='hello %d' % n, content_type='text/plain')
+			self.assertEqual(resp.status_code, 200)
+
+		items = self.get_items(inbox_id)
+		self.assertEqual([i['query'] for i in items], ['n=0', 'n=1', 'n=2'])
+		self.assertEqual(items[2]['body'], 'hello 2')
+		self.assertEqual(items[2]['state'], 'responded')
+
+		resp = self.request('get', '/i/%s/items/?since=id:%s' % (inbox_id, items[1]['id']))
+		self.assertEqual([i['id'] for i in json.loads(resp.content)['items']], [items[2]['id']])
+
+	def test_body_offload(self):
+		inbox_id = self.create()
+		large = b'\xff\x00' + b'x' * 100
+		with mock.patch.object(views, 'body_offload_size', 64):
+			for body in (large, b'small'):
+				resp = self.request('post', '/i/%s/in/' % inbox_id, data=body, content_type='application/octet-stream')
+				self.assertEqual(resp.status_code, 200)
+		offloaded, inline = self.get_items(inbox_id)
+		self.assertEqual(offloaded['body-size'], len(large))
+		self.assertEqual(offloaded['body-sha256'], hashlib.sha256(large).hexdigest())
+		self.assertNotIn('body', offloaded)
+		self.assertNotIn('body-bin', offloaded)
+		self.assertEqual(inline['body'], 'small')
+
+		resp = self.request('get', '/i/%s/items/%s/body/' % (inbox_id, offloaded['id']))
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(resp.content, large)
+		# bodies kept in the item are not served apart
+		self.assertEqual(self.request('get', '/i/%s/items/%s/body/' % (inbox_id, inline['id'])).status_code, 404)
+
+	def test_bad_content_length(self):
+		inbox_id = self.create()
+		for value in ('bogus', '-1'):
+			resp = self.request('post', '/i/%s/in/' % inbox_id, data='x', content_type='text/plain', CONTENT_LENGTH=value)
+			self.assertEqual(resp.status_code, 200)
+
+	def test_respond(self):
+		inbox_id = self.create(response_mode='wait')
+		resp = self.request('post', '/i/%s/in/' % inbox_id, data='ping', content_type='text/plain')
+		self.assertEqual(resp['Grip-Hold'], 'response')
+		item = self.get_items(inbox_id)[0]
+		self.assertEqual(item['state'], 'response-pending')
+		self.assertTrue(self.db.request_is_pending(inbox_id, item['id']))
+
+		path = '/i/%s/respond/%s/' % (inbox_id, item['id'])
+		resp = self.request('post', path, data=json.dumps({'code': 201, 'body': 'pong'}), content_type='application/json')
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(self.get_items(inbox_id)[0]['state'], 'responded')
+
+		# only one response per request
+		resp = self.request('post', path, data=json.dumps({'body': 'pong'}), content_type='application/json')
+		self.assertEqual(resp.status_code, 404)
+
+	def test_expire_request(self):
+		inbox_id = self.create(response_mode='wait', wait_timeout='0.5')
+		self.request('post', '/i/%s/in/' % inbox_id, data='ping', content_type='text/plain')
+		item_id = self.get_items(inbox_id)[0]['id']
+
+		with self.advance(1):
+			util.expire_requests()
+			self.assertFalse(self.db.request_is_pending(inbox_id, item_id))
+
+		path = '/i/%s/respond/%s/' % (inbox_id, item_id)
+		resp = self.request('post', path, data=json.dumps({'body': 'late'}), content_type='application/json')
+		self.assertEqual(resp.status_code, 404)
+
+	# return the channels expire_requests answered on
+	def expire_requests(self):
+		with mock.patch.object(util, 'publish_many') as publish_many:
+			util.expire_requests()
+		return [c for call in publish_many.call_args_list for c, _, _, _ in call[0][0]]
+
+	def test_pending_answered_after_delete(self):
+		inbox_id = self.create(response_mode='wait', wait_timeout=10)
+		self.request('post', '/i/%s/in/' % inbox_id, data='ping', content_type='text/plain')
+		item_id = self.get_items(inbox_id)[0]['id']
+		self.assertEqual(self.request('delete', '/i/%s/' % inbox_id).status_code, 200)
+		with self.advance(11):
+			self.assertEqual(self.expire_requests(), [util.grip_prefix + 'wait-%s-%s' % (inbox_id, item_id)])
+
+	def test_pending_answered_after_expire(self):
+		inbox_id = self.create(ttl=60, response_mode='wait', wait_timeout=100)
+		self.request('post', '/i/%s/in/' % inbox_id, data='ping', content_type='text/plain')
+		item_id = self.get_items(inbox_id)[0]['id']
+		with self.advance(61):
+			util.expire_inboxes()
+			self.assertEqual(self.expire_requests(), [])
+		with self.advance(101):
+			self.assertEqual(self.expire_requests(), [util.grip_prefix + 'wait-%s-%s' % (inbox_id, item_id)])
+
+	def test_expire_inbox(self):
+		inbox_id = self.create(ttl=60)
+		with self.advance(30):
+			util.expire_inboxes()
+			self.assertEqual(self.request('get', '/i/%s/' % inbox_id).status_code, 200)
+		with self.advance(61):
+			util.expire_inboxes()
+			self.assertEqual(self.request('get', '/i/%s/' % inbox_id).status_code, 404)
+			self.assertEqual(self.request('post', '/i/%s/in/' % inbox_id, data='x', content_type='text/plain').status_code, 404)
+
+	def test_reads_keep_inbox(self):
+		self.db.refresh_fraction = 0.2
+		self.db.refresh_window = 0
+		inbox_id = self.create(ttl=100)
+		# reads no further apart than fraction * ttl, the first few of
+		#   which are too early to refresh
+		for n in range(1, 7):
+			with self.advance(n * 19):
+				self.get_items(inbox_id)
+		with self.advance(6 * 19 + 1):
+			util.expire_inboxes()
+			self.assertEqual(self.request('get', '/i/%s/' % inbox_id).status_code, 200)
+
+# the same, through the async views as an asgi server would run them
+class _AsyncApiTests(_ApiTests):
+	def request(self, method, path, data=None, content_type=None, **meta):
+		kwargs = dict()
+		if data is not None:
+			kwargs['data'] = data
+		if content_type is not None:
+			kwargs['content_type'] = content_type
+		req = getattr(AsyncRequestFactory(), method)(path, **kwargs)
+		# the asgi handler hands over the body as a file, which unlike the
+		#   test payload can be read past its end
+		req._stream = io.BytesIO(req._stream.read())
+		req.META['HTTP_HOST'] = 'api.localhost'
+		req.META.update(meta)
+		match = resolve(path.split('?')[0], urlconf='api.urls')
+		view = getattr(async_views, match.url_name, None)
+		if view is None:
+			view = sync_to_async(match.func)
+
+		async def get_response(req):
+			return await view(req, **match.kwargs)
+
+		return async_to_sync(GripMiddleware(get_response))(req)
+
+def _memory_backend(self):
+	return memory_ops.MemoryOps()
+
+def _redis_backend(self, ops_class=None):
+	server = fakeredis.FakeServer()
+	kwargs = dict(server=server, decode_responses=True, encoding_errors='surrogateescape')
+	pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, **kwargs)
+	# each event loop gets a pool of its own
+	async_pool = lambda client: redis.asyncio.ConnectionPool(connection_class=fakeredis.aioredis.FakeConnection, **kwargs)
+	patcher = mock.patch.object(redis_ops, '_create_connection_pool', async_pool)
+	patcher.start()
+	self.addCleanup(patcher.stop)
+	# cache invalidations arrive asynchronously, so leave the cache out
+	with mock.patch.object(redis_ops, '_pool', pool), override_settings(WHINBOX_INBOX_CACHE_SIZE=0):
+		return (ops_class or redis_ops.RedisOps)()
+
+def _redis_stream_backend(self):
+	return _redis_backend(self, redis_ops.RedisStreamOps)
+
+@override_settings(GRIP_PROXY_REQUIRED=False)
+class MemoryApiTests(_ApiTests, SimpleTestCase):
+	create_backend = _memory_backend
+
+	def test_expired_inbox_gone_before_cleanup(self):
+		inbox_id = self.create(ttl=60)
+		with self.advance(61):
+			self.assertEqual(self.request('get', '/i/%s/items/' % inbox_id).status_code, 404)
+
+	def test_refresh_fraction_bounds(self):
+		for value, expected in ((0, 0.1), (0.5, 0.5), (2, 1)):
+			with override_settings(WHINBOX_REFRESH_FRACTION=value):
+				self.assertEqual(backend.Backend().refresh_fraction, expected)
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(GRIP_PROXY_REQUIRED=False)
+class RedisApiTests(_ApiTests, SimpleTestCase):
+	create_backend = _redis_backend
+
+	def test_async_views_over_wsgi(self):
+		inbox_id = self.create()
+		self.request('post', '/i/%s/in/' % inbox_id, data='x', content_type='text/plain')
+		req = RequestFactory().get('/i/%s/items/' % inbox_id, HTTP_HOST='api.localhost')
+		resp = async_to_sync(async_views.items)(req, inbox_id)
+		self.assertEqual(len(json.loads(resp.content)['items']), 1)
+		# no client made for the request's own event loop
+		self.assertEqual(len(self.db.async_clients), 0)
+
+	def test_partition_layout_migrated(self):
+		inbox_ids = [self.create(ttl=60) for n in range(0, 8)]
+		self.assertEqual(self.db.cleanup_migrate_layout(), (1, 0))
+		self.db.partitions = 4
+		# refreshed on the new layout before cleanup moves the rest over
+		refreshed = [i for i in inbox_ids if self.db._partition(i) != 0][0]
+		with self.advance(30):
+			self.assertEqual(self.request('post', '/i/%s/refresh/' % refreshed).status_code, 200)
+		old_partitions, moved = self.db.cleanup_migrate_layout()
+		self.assertEqual(old_partitions, 1)
+		self.assertGreater(moved, 0)
+		r = self.db._get_redis()
+		for inbox_id in inbox_ids:
+			homes = [p for p in range(0, 4) if r.zscore(self.db._schedule_key('inbox-exp', p), inbox_id) is not None]
+			self.assertEqual(homes, [self.db._partition(inbox_id)])
+		key = self.db._schedule_key('inbox-exp', self.db._partition(refreshed))
+		self.assertGreater(r.zscore(key, refreshed), time.time() + 60)
+		self.assertEqual(self.db.cleanup_migrate_layout(), (4, 0))
+
+	def test_expired_keys_of_dashed_ids(self):
+		self.db.partitions = 4
+		inbox_id = self.create(id='items-abc', ttl=60)
+		keys = [self.db.prefix + 'inbox-' + inbox_id, self.db.prefix + 'inbox-items-abc2']
+		messages = [{'type': 'message', 'data': k} for k in keys]
+
+		# hands over the expirations, then stops the listener
+		def get_message(timeout):
+			if not messages:
+				raise KeyboardInterrupt()
+			return messages.pop(0)
+
+		pubsub = mock.Mock(get_message=get_message)
+		expired = list()
+		with mock.patch.object(self.db.redis, 'pubsub', lambda **kwargs: pubsub):
+			with self.assertRaises(KeyboardInterrupt):
+				self.db._listen_expired(expired.append)
+		# the items sub-key of inbox abc2 is passed over
+		self.assertEqual(expired, [self.db._partition(inbox_id)])
+
+	def test_cache_reset_after_fork(self):
+		with mock.patch.object(redis_ops, '_pool', self.db.redis.connection_pool), override_settings(WHINBOX_INBOX_CACHE_SIZE=10):
+			db = redis_ops.RedisOps()
+		inbox_id = self.create()
+
+		# stands in for the listener thread, which turns the cache on
+		def start_listener():
+			db.invalidation_listener = mock.Mock()
+			db.inbox_cache.set_active(True)
+
+		with mock.patch.object(db, '_start_invalidation_listener', side_effect=start_listener) as start:
+			db.inbox_get(inbox_id)
+			db.inbox_get(inbox_id)
+			self.assertEqual(db.inbox_cache.stats()['hits'], 1)
+			redis_ops._after_fork()
+			# the child's cache is off until it has a listener of its own
+			self.assertIsNone(db.invalidation_listener)
+			self.assertEqual(db.inbox_cache.stats()['size'], 0)
+			db.inbox_get(inbox_id)
+			self.assertEqual(start.call_count, 2)
+
+	def test_mixed_encodings(self):
+		inbox_id = self.create()
+		for encoding in ('json', 'compact', 'rendered'):
+			self.db.item_encoding = encoding
+			self.request('post', '/i/%s/in/?e=%s' % (inbox_id, encoding), data='\u00e9', content_type='text/plain')
+		items = self.get_items(inbox_id)
+		self.assertEqual([i['query'] for i in items], ['e=json', 'e=compact', 'e=rendered'])
+		self.assertEqual([i['body'] for i in items], ['\u00e9'] * 3)
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(GRIP_PROXY_REQUIRED=False)
+class RedisStreamApiTests(_ApiTests, SimpleTestCase):
+	create_backend = _redis_stream_backend
+
+	def hit(self, inbox_id, n, body=None):
+		if body is None:
+			body = 'hello %d' % n
+		return self.request('post', '/i/%s/in/?n=%d' % (inbox_id, n), data=body, content_type='text/plain')
+
+	def test_trim(self):
+		self.db.item_max = 2
+		self.db.item_burst_max = 3
+		inbox_id = self.create()
+		for n in range(0, 5):
+			self.hit(inbox_id, n)
+		# a burst keeps up to burst_max
+		self.assertEqual([i['query'] for i in self.get_items(inbox_id)], ['n=2', 'n=3', 'n=4'])
+		r = self.db._get_redis()
+		dirty_key = self.db._schedule_key('inbox-dirty', 0)
+		self.assertIsNotNone(r.zscore(dirty_key, inbox_id))
+
+		# and is cut down to item_max once the burst window has passed
+		with self.advance(self.db.item_burst_time + 1):
+			util.expire_items()
+		self.assertEqual([i['query'] for i in self.get_items(inbox_id)], ['n=3', 'n=4'])
+		self.assertIsNone(r.zscore(dirty_key, inbox_id))
+
+	def test_paging(self):
+		inbox_id = self.create()
+		for n in range(0, 5):
+			self.hit(inbox_id, n)
+		path = '/i/%s/items/' % inbox_id
+
+		resp = json.loads(self.request('get', path + '?max=2').content)
+		self.assertEqual([i['query'] for i in resp['items']], ['n=0', 'n=1'])
+		resp = json.loads(self.request('get', path + '?max=2&since=cursor:%s' % resp['last_cursor']).content)
+		self.assertEqual([i['query'] for i in resp['items']], ['n=2', 'n=3'])
+
+		resp = json.loads(self.request('get', path + '?order=-created&max=2').content)
+		self.assertEqual([i['query'] for i in resp['items']], ['n=4', 'n=3'])
+		resp = json.loads(self.request('get', path + '?order=-created&max=2&since=cursor:%s' % resp['last_cursor']).content)
+		self.assertEqual([i['query'] for i in resp['items']], ['n=2', 'n=1'])
+		resp = json.loads(self.request('get', path + '?order=-created&max=2&since=cursor:%s' % resp['last_cursor']).content)
+		self.assertEqual([i['query'] for i in resp['items']], ['n=0'])
+		self.assertNotIn('last_cursor', resp)
+
+		self.assertEqual(self.request('get', path + '?since=id:bogus').status_code, 400)
+
+	def test_trim_drops_bodies(self):
+		self.db.item_max = 1
+		self.db.item_burst_max = 1
+		inbox_id = self.create()
+		with mock.patch.object(views, 'body_offload_size', 4):
+			self.hit(inbox_id, 0, 'large body 0')
+			first_id = self.get_items(inbox_id)[0]['id']
+			self.hit(inbox_id, 1, 'large body 1')
+		item = self.get_items(inbox_id)[0]
+		resp = self.request('get', '/i/%s/items/%s/body/' % (inbox_id, item['id']))
+		self.assertEqual(resp.content, b'large body 1')
+		self.assertEqual(self.request('get', '/i/%s/items/%s/body/' % (inbox_id, first_id)).status_code, 404)
+		self.assertEqual(self.db._get_redis().hkeys(self.db.prefix + 'inbox-bodies-' + inbox_id), [item['id']])
+
+	def test_migrate(self):
+		with mock.patch.object(redis_ops, '_pool', self.db.redis.connection_pool), override_settings(WHINBOX_INBOX_CACHE_SIZE=0):
+			list_db = redis_ops.RedisOps()
+		with mock.patch.object(views, 'db', list_db):
+			inbox_id = self.create(response_mode='wait')
+			self.hit(inbox_id, 0)
+			with mock.patch.object(views, 'body_offload_size', 4):
+				self.hit(inbox_id, 1, 'large body')
+
+		# a held request can only be answered by its list position
+		self.assertEqual(self.db.inbox_migrate_to_stream(inbox_id), -1)
+		with mock.patch.object(views, 'db', list_db):
+			for item_id in ('0', '1'):
+				path = '/i/%s/respond/%s/' % (inbox_id, item_id)
+				resp = self.request('post', path, data=json.dumps({'body': 'pong'}), content_type='application/json')
+				self.assertEqual(resp.status_code, 200)
+
+		self.assertEqual(self.db.inbox_migrate_to_stream(inbox_id), 2)
+		self.assertIsNone(self.db.inbox_migrate_to_stream(inbox_id))
+		items = self.get_items(inbox_id)
+		self.assertEqual([i['query'] for i in items], ['n=0', 'n=1'])
+		resp = self.request('get', '/i/%s/items/%s/body/' % (inbox_id, items[1]['id']))
+		self.assertEqual(resp.content, b'large body')
+
+		# appended by a worker still on lists, then picked up by a later run
+		with mock.patch.object(views, 'db', list_db):
+			self.hit(inbox_id, 2)
+			item = self.get_items(inbox_id)[0]
+			self.assertEqual(item['query'], 'n=2')
+			self.assertEqual(self.db.inbox_migrate_to_stream(inbox_id), -1)
+			path = '/i/%s/respond/%s/' % (inbox_id, item['id'])
+			self.request('post', path, data=json.dumps({'body': 'pong'}), content_type='application/json')
+		self.assertEqual(self.db.inbox_migrate_to_stream(inbox_id), 1)
+		items = self.get_items(inbox_id)
+		self.assertEqual([i['query'] for i in items], ['n=0', 'n=1', 'n=2'])
+		self.assertLess(items[1]['id'].split('-'), items[2]['id'].split('-'))
+
+@override_settings(GRIP_PROXY_REQUIRED=False)
+class AsyncMemoryApiTests(_AsyncApiTests, SimpleTestCase):
+	create_backend = _memory_backend
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(GRIP_PROXY_REQUIRED=False)
+class AsyncRedisApiTests(_AsyncApiTests, SimpleTestCase):
+	create_backend = _redis_backend
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(GRIP_PROXY_REQUIRED=False)
+class AsyncRedisStreamApiTests(_AsyncApiTests, SimpleTestCase):
+	create_backend = _redis_stream_backend
+
+# the item policy as applied by the lua scripts, by the transactions used
+#   without scripts and by the memory backend, over the same timelines
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TrimTests(SimpleTestCase):
+	# (item_max, burst_time, burst_max, offsets of the items in seconds,
+	#   offset of the trim)
+	timelines = [
+		(3, 10, 5, [0, 0, 0, 0, 0, 0, 0], 5),
+		(3, 10, 5, [0, 1, 2, 3, 4], 11),
+		(3, 10, 5, [0, 1, 2, 20, 21, 22, 23], 25),
+		(2, 10, 2, [0, 5, 10, 15], 30),
+		(5, 10, 3, [0, 0, 1, 30, 30, 30, 30], 31),
+		(1, 60, 100, list(range(0, 120, 3)), 150),
+		(3, 10, 5, [0, 0], 0),
+	]
+
+	def setUp(self):
+		self.base = int(time.time())
+
+	def random_timelines(self, count):
+		rng = random.Random(0)
+		out = list()
+		for n in range(0, count):
+			offsets = sorted(rng.randint(0, 40) for i in range(0, rng.randint(1, 15)))
+			out.append((rng.randint(1, 6), rng.randint(1, 20), rng.randint(1, 10), offsets, offsets[-1] + rng.randint(0, 30)))
+		return out
+
+	def at(self, offset):
+		now = self.base + offset
+		return mock.patch.multiple(
+			backend.Backend,
+			_timestamp_utcnow=staticmethod(lambda: now),
+			_timestamp_precise=staticmethod(lambda: float(now)))
+
+	def backends(self, item_max, burst_time, burst_max):
+		with override_settings(WHINBOX_ITEM_MAX=item_max, WHINBOX_ITEM_BURST_TIME=burst_time, WHINBOX_ITEM_BURST_MAX=burst_max):
+			scripts = _redis_backend(self)
+			transactions = _redis_backend(self)
+			transactions.use_scripts = False
+			return [('scripts', scripts), ('transactions', transactions), ('memory', memory_ops.MemoryOps())]
+
+	# add the items of a timeline, then trim at its end
+	# return the ids of the items left, which are their positions
+	def run_timeline(self, db, offsets, end):
+		with self.at(0):
+			db.inbox_create('trim', 3600, 'auto')
+		for n, offset in enumerate(offsets):
+			with self.at(offset):
+				db.inbox_ingest_item('trim', dict(method='POST', path='/', query='n=%d' % n, headers=[]))
+		with self.at(end):
+			db.inbox_clear_expired_items('trim')
+			items = db.inbox_read_items('trim', None, None, refresh=False)[0]
+		return [i['id'] for i in items]
+
+	def test_trim_agrees(self):
+		for timeline in self.timelines + self.random_timelines(30):
+			item_max, burst_time, burst_max, offsets, end = timeline
+			results = dict()
+			for name, db in self.backends(item_max, burst_time, burst_max):
+				results[name] = self.run_timeline(db, offsets, end)
+			with self.subTest(timeline=timeline):
+				self.assertEqual(results['scripts'], results['transactions'])
+				self.assertEqual(results['scripts'], results['memory'])
+				self.assertLessEqual(len(results['memory']), max(item_max, burst_max))
+
+	# the inbox is queued for when its oldest item leaves the burst window,
+	#   as long as it holds more than item_max, and is trimmed again then
+	def test_dirty_queue_agrees(self):
+		for timeline in self.timelines + self.random_timelines(30):
+			item_max, burst_time, burst_max, offsets, end = timeline
+			results = dict()
+			for name, db in self.backends(item_max, burst_time, burst_max):
+				ids = self.run_timeline(db, offsets, end)
+				due = db.inbox_next_dirty()
+				left = None
+				if due is not None:
+					with self.at(due - self.base):
+						db.inbox_clear_dirty_items()
+						left = [i['id'] for i in db.inbox_read_items('trim', None, None, refresh=False)[0]]
+				results[name] = (due, left)
+			with self.subTest(timeline=timeline):
+				if len(ids) > item_max:
+					self.assertEqual(results['memory'][0], self.base + offsets[int(ids[0])] + burst_time)
+					self.assertLess(len(results['memory'][1]), len(ids))
+				else:
+					self.assertIsNone(results['memory'][0])
+				self.assertEqual(results['scripts'], results['memory'])
+				self.assertEqual(results['transactions'], results['memory'])
+
+class BodyLimitMiddlewareTests(SimpleTestCase):
+	# return (bodies the app received, more_body of the last)
+	def run_app(self, path, chunks):
+		messages = [{'type': 'http.request', 'body': c, 'more_body': n < len(chunks) - 1} for n, c in enumerate(chunks)]
+		received = list()
+
+		async def app(scope, receive, send):
+			while True:
+				message = await receive()
+				received.append(message)
+				if not message.get('more_body'):
+					return
+
+		async def receive():
+			return messages.pop(0)
+
+		middleware = BodyLimitMiddleware(app)
+		middleware.limit = 10
+		asyncio.run(middleware({'type': 'http', 'path': path}, receive, None))
+		self.assertEqual(len(messages), 0)
+		return (b''.join(m['body'] for m in received), received[-1]['more_body'])
+
+	def test_hit_body_capped(self):
+		self.assertEqual(self.run_app('/i/abc/in/', [b'0123456', b'789abcdef', b'ghi']), (b'0123456789a', False))
+		self.assertEqual(self.run_app('/api/i/abc/in/x', [b'0123456789abcdef']), (b'0123456789a', False))
+
+	def test_other_paths_untouched(self):
+		self.assertEqual(self.run_app('/i/abc/items/', [b'0123456', b'789abcdef']), (b'0123456789abcdef', False))
+		self.assertEqual(self.run_app('/i/abc/in/', [b'0123', b'456']), (b'0123456', False))
+
+class PublisherTests(SimpleTestCase):
+	def setUp(self):
+		# keep everything queued
+		patcher = mock.patch.object(Publisher, '_ensure_thread')
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_coalesce_when_queue_full(self):
+		publisher = Publisher()
+		publisher.coalesce_window = 60
+		publisher.queue_max = 2
+		render = lambda item_jsons, last_id: item_jsons
+		self.assertTrue(publisher.publish_item('a', '1', '1', '0', render))
+		self.assertTrue(publisher.publish('b', []))
+		# continues the held run, so it takes no room in the queue
+		self.assertTrue(publisher.publish_item('a', '2', '2', '1', render))
+		self.assertFalse(publisher.publish_item('c', '1', '1', '0', render))
+		self.assertEqual(publisher.coalescing['a'][1], ['1', '2'])
+		self.assertEqual(publisher.dropped, 1)
+
+@override_settings(WHINBOX_BACKEND='memory')
+class MetricsTests(SimpleTestCase):
+	def setUp(self):
+		for name, value in (('enabled', True), ('_shards', list()), ('_base', metrics._Shard())):
+			patcher = mock.patch.object(metrics, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def test_ended_threads_folded(self):
+		def record():
+			metrics.inc('whinbox_items_trimmed_total', 'where="ingest"')
+			metrics.observe('whinbox_item_body_bytes', '', 100)
+		for n in range(0, 3):
+			thread = threading.Thread(target=record)
+			thread.start()
+			thread.join()
+		values = metrics._collect_shards()
+		self.assertEqual(len(metrics._shards), 0)
+		self.assertEqual(values['whinbox_items_trimmed_total\twhere="ingest"'], 3)
+		self.assertEqual(values['whinbox_item_body_bytes\t\t1'], 3)
+
+	def test_flusher_started_after_fork(self):
+		metrics.inc('whinbox_items_trimmed_total', 'where="ingest"')
+		with mock.patch.object(metrics, '_flusher_pid', -1), mock.patch.object(metrics, '_ensure_flusher') as ensure:
+			metrics.inc('whinbox_items_trimmed_total', 'where="ingest"')
+		self.assertEqual(ensure.call_count, 1)
+
+	def test_queue_depth(self):
+		publisher = mock.Mock()
+		publisher.stats.return_value = dict(depth=3, sent=0, failed=0, dropped=0, retries=0)
+		with mock.patch('api.publisher.get_publisher', lambda: publisher):
+			self.assertIn('\nwhinbox_publish_queue_depth 3\n', metrics.render())
+
+	@skipIf(fakeredis is None, 'fakeredis is not installed')
+	def test_queue_depth_across_processes(self):
+		publisher = mock.Mock()
+		publisher.stats.return_value = dict(depth=3)
+		r = fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+		field = 'whinbox_publish_queue_depth\t'
+		# a live process, and one that stopped reporting
+		for process, depth, age in (('live:1', 2, 0), ('gone:1', 5, 600)):
+			r.hset('wi-metrics-gauges:' + process, field, depth)
+			r.zadd('wi-metrics-processes', {process: time.time() - age})
+		with override_settings(WHINBOX_BACKEND='redis'), mock.patch.object(metrics, '_redis', r), mock.patch.object(metrics, '_sources', dict), mock.patch('api.publisher.get_publisher', lambda: publisher):
+			self.assertIn('\nwhinbox_publish_queue_depth 5\n', metrics.render())
+		self.assertNotIn('gone:1', r.zrange('wi-metrics-processes', 0, -1))
+
+	def test_token_required(self):
+		client = self.client_class()
+		with mock.patch.object(metrics, 'render', lambda: ''):
+			self.assertEqual(client.get('/metrics', HTTP_HOST='api.localhost').status_code, 404)
+			with override_settings(WHINBOX_METRICS_TOKEN='secret'):
+				self.assertEqual(client.get('/metrics', HTTP_HOST='api.localhost').status_code, 401)
+				resp = client.get('/metrics', HTTP_HOST='api.localhost', HTTP_AUTHORIZATION='Bearer wrong')
+				self.assertEqual(resp.status_code, 401)
+				resp = client.get('/metrics', HTTP_HOST='api.localhost', HTTP_AUTHORIZATION='Bearer secret')
+				self.assertEqual(resp.status_code, 200)
@@ -1,13 +1,23 @@
+from django.conf import settings
 from django.urls import re_path
-from . import views
+from . import metrics, views
 
+# ingest and polling views. the async ones need an asgi server
+if getattr(settings, 'WHINBOX_ASYNC_VIEWS', False):
+	from . import async_views as io_views
+else:
+	io_views = views
+
+# the hot paths are counted and timed when WHINBOX_METRICS is set
 urlpatterns = [
 	re_path(r'^$', views.root, name='root'),
-	re_path(r'^create/$', views.create, name='create'),
+	re_path(r'^metrics$', views.metrics_view, name='metrics'),
+	re_path(r'^create/$', metrics.timed_view('create', io_views.create), name='create'),
 	re_path(r'^i/(?P<inbox_id>[^/]+)/$', views.inbox, name='inbox'),
 	re_path(r'^i/(?P<inbox_id>[^/]+)/refresh/$', views.refresh, name='refresh'),
-	re_path(r'^i/(?P<inbox_id>[^/]+)/respond/(?P<item_id>[^/]+)/$', views.respond, name='respond'),
-	re_path(r'^i/(?P<inbox_id>[^/]+)/in/', views.hit, name='hit'),
-	re_path(r'^i/(?P<inbox_id>[^/]+)/items/$', views.items, name='items'),
-	re_path(r'^i/(?P<inbox_id>[^/]+)/stream/$', views.stream, name='stream')
+	re_path(r'^i/(?P<inbox_id>[^/]+)/respond/(?P<item_id>[^/]+)/$', metrics.timed_view('respond', io_views.respond), name='respond'),
+	re_path(r'^i/(?P<inbox_id>[^/]+)/in/', metrics.timed_view('hit', io_views.hit), name='hit'),
+	re_path(r'^i/(?P<inbox_id>[^/]+)/items/$', metrics.timed_view('items', io_views.items), name='items'),
+	re_path(r'^i/(?P<inbox_id>[^/]+)/items/(?P<item_id>[^/]+)/body/$', views.item_body, name='item_body'),
+	re_path(r'^i/(?P<inbox_id>[^/]+)/stream/$', metrics.timed_view('stream', io_views.stream), name='stream')
 ]
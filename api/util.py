@@ -1,7 +1,8 @@
+import time
 from django.conf import settings
-from gripcontrol import HttpResponseFormat
-from django_grip import publish
-from . import redis_ops
+from gripcontrol import HttpResponseFormat, HttpStreamFormat
+from . import backend, metrics
+from .publisher import publish, publish_many
 
 def _setting(name, default):
 	v = getattr(settings, name, None)
@@ -9,24 +10,53 @@ def _setting(name, default):
 		return default
 	return v
 
-db = redis_ops.RedisOps()
+db = backend.get_backend()
 grip_prefix = _setting('WHINBOX_GRIP_PREFIX', 'wi-')
 
-def expire_inboxes():
-	return len(db.inbox_take_expired())
+# the expire functions work on one schedule partition, or on all of them
+#   if partition is None
 
-def expire_items():
-	inboxes = db.inbox_get_all()
-	count = 0
-	for inbox in inboxes:
-		count += db.inbox_clear_expired_items(inbox)
-	return (count, len(inboxes))
+# return (count, batches, elapsed seconds)
+def expire_inboxes(partition=None):
+	start = time.monotonic()
+	batches = db.inbox_take_expired(partition=partition)
+	# let go of anyone still polling or streaming the inbox
+	headers = dict()
+	headers['Content-Type'] = 'text/html'
+	body = 'Not Found\n'
+	for inboxes in batches:
+		for inbox in inboxes:
+			publish(grip_prefix + 'inbox-%s' % inbox['id'], [HttpResponseFormat(code=404, headers=headers, body=body), HttpStreamFormat(close=True)])
+	return (sum(len(b) for b in batches), len(batches), time.monotonic() - start)
 
-def expire_requests():
-	reqs = db.request_take_expired()
+# trims inboxes queued at append time. a full sweep visits every inbox,
+#   which is only needed for inboxes written before the queue existed
+# return (count, inboxes)
+def expire_items(full=False, partition=None):
+	if not full:
+		count, inboxes = db.inbox_clear_dirty_items(partition=partition)
+	else:
+		count = 0
+		inboxes = 0
+		for inbox in db.inbox_iter_all():
+			count += db.inbox_clear_expired_items(inbox)
+			inboxes += 1
+	if count > 0:
+		metrics.inc('whinbox_items_trimmed_total', 'where="cleanup"', count)
+	return (count, inboxes)
+
+# return (count, batches, elapsed seconds)
+def expire_requests(partition=None):
+	start = time.monotonic()
+	batches = db.request_take_expired(partition=partition)
 	headers = dict()
 	headers['Content-Type'] = 'text/html'
-	body = 'Service Unavailable\n'
-	for r in reqs:
-		publish(grip_prefix + 'wait-%s-%s' % (r[0], r[1]), HttpResponseFormat(code=503, headers=headers, body=body), id='1', prev_id='0')
-	return len(reqs)
+	# the same response goes to every held sender
+	formats = HttpResponseFormat(code=503, headers=headers, body='Service Unavailable\n')
+	count = 0
+	for reqs in batches:
+		# a whole batch is queued at once and goes out in as few control
+		#   requests as the publisher's batch size allows
+		publish_many([(grip_prefix + 'wait-%s-%s' % (r[0], r[1]), formats, '1', '0') for r in reqs])
+		count += len(reqs)
+	return (count, len(batches), time.monotonic() - start)
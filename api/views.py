@@ -3,13 +3,17 @@ from __future__ import unicode_literals
 
 from base64 import b64encode, b64decode
 import datetime
-import copy
+import functools
+import hashlib
+import hmac
 import json
+import math
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed
 from gripcontrol import Channel, HttpResponseFormat, HttpStreamFormat
-from django_grip import set_hold_longpoll, set_hold_stream, publish
-from . import redis_ops
+from django_grip import set_hold_longpoll, set_hold_stream
+from . import backend, metrics
+from .publisher import publish, publish_item
 
 def _setting(name, default):
 	v = getattr(settings, name, None)
@@ -17,9 +21,14 @@ def _setting(name, default):
 		return default
 	return v
 
-db = redis_ops.RedisOps()
+db = backend.get_backend()
 grip_prefix = _setting('WHINBOX_GRIP_PREFIX', 'wi-')
 orig_headers = _setting('WHINBOX_ORIG_HEADERS', False)
+body_offload_size = _setting('WHINBOX_BODY_OFFLOAD_SIZE', 65536)
+body_max_size = _setting('WHINBOX_BODY_MAX_SIZE', 2621440)
+# 'truncate' or 'reject'
+body_oversize = _setting('WHINBOX_BODY_OVERSIZE', 'truncate')
+wait_timeout_max = 300
 
 # useful list derived from requestbin
 ignore_headers = """
@@ -38,6 +47,24 @@ Grip-Feature
 Grip-Last
 """.split("\n")[1:-1]
 
+# return seconds, or None if not given
+def _parse_wait_timeout(value):
+	if value is None:
+		return None
+	timeout = float(value)
+	if not (0 < timeout <= wait_timeout_max):
+		raise ValueError('wait_timeout out of range')
+	if timeout == int(timeout):
+		timeout = int(timeout)
+	return timeout
+
+# the proxy gives up on a held request a little after cleanup is due to
+#   answer it
+def _hold_timeout(wait_timeout):
+	if wait_timeout is None:
+		return None
+	return int(math.ceil(wait_timeout)) + 5
+
 def _ignore_header(name):
 	name = name.lower()
 	for h in ignore_headers:
@@ -59,7 +86,44 @@ def _convert_header_name(name):
 			out += c.lower()
 	return out
 
-def _req_to_item(req):
+# a malformed or negative length is treated as unknown, much as django
+#   does
+# return the declared body length, or None
+def _content_length(req):
+	try:
+		content_length = int(req.META.get('CONTENT_LENGTH'))
+	except (ValueError, TypeError):
+		return None
+	if content_length < 0:
+		return None
+	return content_length
+
+# read the request body in chunks, keeping at most limit bytes. the
+#   original length is None if the sender didn't declare it
+# return (body, original length, truncated)
+def _read_body(req, limit):
+	content_length = _content_length(req)
+	# asgi request streams aren't limited to the declared length
+	want = limit
+	if content_length is not None:
+		want = min(limit, content_length)
+	chunks = list()
+	size = 0
+	while size < want:
+		chunk = req.read(min(want - size, 65536))
+		if not chunk:
+			break
+		chunks.append(chunk)
+		size += len(chunk)
+	body = b''.join(chunks)
+	if content_length is not None:
+		return (body, max(content_length, size), content_length > size)
+	# don't read the rest, just check if there is any
+	if size >= limit and req.read(1):
+		return (body, None, True)
+	return (body, size, False)
+
+def _req_to_item(req, body, body_length, body_truncated):
 	item = dict()
 	item['method'] = req.method
 	item['path'] = req.path
@@ -95,13 +159,22 @@ def _req_to_item(req):
 				tmp.append(h)
 		headers = tmp
 	item['headers'] = headers
-	if len(req.body) > 0:
+	if body_offload_size and len(body) > body_offload_size:
+		# large bodies are stored apart from the item and served by
+		#   item_body
+		item['body-size'] = len(body)
+		item['body-sha256'] = hashlib.sha256(body).hexdigest()
+	elif len(body) > 0:
 		try:
 			# if the body is valid utf-8, then store as text
-			item['body'] = req.body.decode('utf-8')
+			item['body'] = body.decode('utf-8')
 		except:
 			# else, store as binary
-			item['body-bin'] = b64encode(req.body)
+			item['body-bin'] = b64encode(body).decode('ascii')
+	if body_truncated:
+		item['body-truncated'] = True
+		if body_length is not None:
+			item['body-length'] = body_length
 	forwardedfor = req.META.get('HTTP_X_FORWARDED_FOR')
 	if forwardedfor:
 		ip_address = forwardedfor.split(',')[0].strip()
@@ -110,56 +183,326 @@ def _req_to_item(req):
 	item['ip_address'] = ip_address
 	return item
 
-def _convert_item(item, responded=False):
-	out = copy.deepcopy(item)
-	created = datetime.datetime.fromtimestamp(item['created']).isoformat()
-	if len(created) > 0 and created[-1] != 'Z':
-		created += 'Z'
-	out['created'] = created
+# items of a page tend to share creation times
+@functools.lru_cache(maxsize=1024)
+def _format_created(created):
+	out = datetime.datetime.fromtimestamp(created).isoformat()
+	if len(out) > 0 and out[-1] != 'Z':
+		out += 'Z'
+	return out
+
+# item ids are generated by the backend and never need escaping, and the
+#   stored fields are rendered once, so an item is assembled without
+#   serializing it
+def _item_json(item, responded=False):
 	if responded:
-		out['state'] = 'responded'
+		state = 'responded'
 	else:
-		out['state'] = 'response-pending'
-	return out
+		state = 'response-pending'
+	out = '{"id":"%s","created":"%s","state":"%s"' % (item['id'], _format_created(item['created']), state)
+	fields = backend.render_item_fields(item)
+	if fields:
+		out += ',' + fields
+	return out + '}'
+
+# return json of an items response
+def _items_json(item_jsons, last_cursor=None):
+	if last_cursor is not None:
+		return '{"last_cursor":"%s","items":[%s]}' % (last_cursor, ','.join(item_jsons))
+	return '{"items":[%s]}' % ','.join(item_jsons)
+
+# return formats announcing consecutive new items to long-pollers and
+#   streams of an inbox
+def _items_formats(item_jsons, last_id):
+	hr_headers = dict()
+	hr_headers['Content-Type'] = 'application/json'
+	hr_body = _items_json(item_jsons, last_id) + '\n'
+	hs_body = ''.join(i + '\n' for i in item_jsons)
+
+	formats = list()
+	formats.append(HttpResponseFormat(headers=hr_headers, body=hr_body))
+	formats.append(HttpStreamFormat(hs_body))
+	return formats
 
 def root(req):
 	return HttpResponseNotFound('Not Found\n')
 
-def create(req):
-	if req.method == 'POST':
-		host = req.META.get('HTTP_HOST')
-		if not host:
-			return HttpResponseBadRequest('Bad Request: No \'Host\' header\n')
-		inbox_id = req.POST.get('id')
-		if inbox_id is not None and len(inbox_id) > 64:
-			return HttpResponseBadRequest('Bad Request: Id length must not exceed 64\n')
+# scrapers authenticate with WHINBOX_METRICS_TOKEN as a bearer token.
+#   without one set, the metrics are not served
+def metrics_view(req):
+	token = _setting('WHINBOX_METRICS_TOKEN', None)
+	if not metrics.enabled or not token:
+		return HttpResponseNotFound('Not Found\n')
+	auth = req.META.get('HTTP_AUTHORIZATION', '')
+	if not hmac.compare_digest(auth.encode('utf-8'), ('Bearer ' + token).encode('utf-8')):
+		resp = HttpResponse('Unauthorized\n', status=401)
+		resp['WWW-Authenticate'] = 'Bearer'
+		return resp
+	if req.method == 'GET':
+		try:
+			out = metrics.render()
+		except:
+			return HttpResponse('Service Unavailable\n', status=503)
+		return HttpResponse(out, content_type='text/plain; version=0.0.4; charset=utf-8')
+	else:
+		return HttpResponseNotAllowed(['GET'])
 
-		ttl = req.POST.get('ttl')
-		if ttl is not None:
-			ttl = int(ttl)
-		if ttl is None:
-			ttl = 3600
-		response_mode = req.POST.get('response_mode')
-		if not response_mode:
-			response_mode = 'auto'
-		if response_mode not in ('auto', 'wait-verify', 'wait'):
-			return HttpResponseBadRequest('Bad Request: response_mode must be "auto", "wait-verify", or "wait"\n')
+# the ingest and polling views parse requests and build responses with
+#   the helpers below, shared with async_views, so that the two only
+#   differ in how they call the backend
+
+# return the response for an exception raised by a backend call
+def _backend_error(e):
+	if isinstance(e, backend.InvalidId):
+		return HttpResponseBadRequest('Bad Request: Invalid id\n')
+	elif isinstance(e, backend.ObjectDoesNotExist):
+		return HttpResponseNotFound('Not Found\n')
+	elif isinstance(e, backend.ObjectExists):
+		return HttpResponse('Conflict: Inbox already exists\n', status=409)
+	else:
+		return HttpResponse('Service Unavailable\n', status=503)
+
+# return (error response, None), or (None, dict of inbox_create arguments)
+def _parse_create(req):
+	host = req.META.get('HTTP_HOST')
+	if not host:
+		return (HttpResponseBadRequest('Bad Request: No \'Host\' header\n'), None)
+	inbox_id = req.POST.get('id')
+	if inbox_id is not None and len(inbox_id) > 64:
+		return (HttpResponseBadRequest('Bad Request: Id length must not exceed 64\n'), None)
+
+	ttl = req.POST.get('ttl')
+	if ttl is not None:
+		ttl = int(ttl)
+	if ttl is None:
+		ttl = 3600
+	response_mode = req.POST.get('response_mode')
+	if not response_mode:
+		response_mode = 'auto'
+	if response_mode not in ('auto', 'wait-verify', 'wait'):
+		return (HttpResponseBadRequest('Bad Request: response_mode must be "auto", "wait-verify", or "wait"\n'), None)
+	body_max = req.POST.get('body_max')
+	if body_max is not None:
+		if not body_max.isdigit():
+			return (HttpResponseBadRequest('Bad Request: body_max must be a non-negative integer\n'), None)
+		body_max = int(body_max)
+	try:
+		wait_timeout = _parse_wait_timeout(req.POST.get('wait_timeout'))
+	except ValueError:
+		return (HttpResponseBadRequest('Bad Request: wait_timeout must be a number of seconds, at most %d\n' % wait_timeout_max), None)
+
+	args = dict()
+	args['id'] = inbox_id
+	args['ttl'] = ttl
+	args['response_mode'] = response_mode
+	args['body_max'] = body_max
+	args['wait_timeout'] = wait_timeout
+	return (None, args)
+
+def _inbox_response(req, inbox_id, inbox):
+	out = dict()
+	out['id'] = inbox_id
+	out['base_url'] = 'http://' + req.META['HTTP_HOST'] + '/i/' + inbox_id + '/'
+	out['ttl'] = inbox['ttl']
+	response_mode = inbox.get('response_mode')
+	if not response_mode:
+		response_mode = 'auto'
+	out['response_mode'] = response_mode
+	if inbox.get('body_max') is not None:
+		out['body_max'] = inbox['body_max']
+	if inbox.get('wait_timeout') is not None:
+		out['wait_timeout'] = inbox['wait_timeout']
+	return HttpResponse(json.dumps(out) + '\n', content_type='application/json')
+
+# return (error response, None), or (None, format of the response to
+#   the held sender)
+def _parse_respond(req):
+	try:
+		content = json.loads(req.body)
+	except:
+		return (HttpResponseBadRequest('Bad Request: Body must be valid JSON\n'), None)
+
+	try:
+		code = content.get('code')
+		if code is not None:
+			code = int(code)
+		else:
+			code = 200
+
+		reason = content.get('reason')
+		headers = content.get('headers')
+
+		if 'body-bin' in content:
+			body = b64decode(content['body-bin'])
+		elif 'body' in content:
+			body = content['body']
+		else:
+			body = ''
+	except:
+		return (HttpResponseBadRequest('Bad Request: Bad format of response\n'), None)
+
+	return (None, HttpResponseFormat(code=code, reason=reason, headers=headers, body=body))
+
+def _publish_response(inbox_id, item_id, format):
+	publish(grip_prefix + 'wait-%s-%s' % (inbox_id, item_id), format, id='1', prev_id='0')
+
+# a retried request that pushpin is still holding
+# return response, or None
+def _hit_retry(req):
+	if len(req.grip.last) > 0:
+		for channel, last_id in req.grip.last.items():
+			break
+		set_hold_longpoll(req, Channel(channel, last_id))
+		return HttpResponse('Service Unavailable\n', status=503, content_type='text/html')
+	return None
+
+class _Hit(object):
+	def __init__(self, item, body, respond_now, hub_challenge):
+		self.item = item
+		self.body = body
+		self.respond_now = respond_now
+		self.hub_challenge = hub_challenge
+
+# read the body and make the item
+# return (error response, None), or (None, _Hit)
+def _parse_hit(req, inbox):
+	response_mode = inbox.get('response_mode')
+	if not response_mode:
+		response_mode = 'auto'
+
+	# pubsubhubbub verify request?
+	hub_challenge = req.GET.get('hub.challenge')
+
+	if response_mode == 'wait' or (response_mode == 'wait-verify' and hub_challenge):
+		respond_now = False
+	else:
+		respond_now = True
+
+	body_limit = body_max_size
+	if inbox.get('body_max') is not None:
+		body_limit = min(body_limit, inbox['body_max'])
+
+	# refuse before reading anything if the sender says it's too big
+	if body_oversize == 'reject':
+		content_length = _content_length(req)
+		if content_length is not None and content_length > body_limit:
+			return (HttpResponse('Payload Too Large\n', status=413), None)
+
+	# under asgi, the handler has already received the body, up to the
+	#   cap of BodyLimitMiddleware, so this doesn't block the event loop
+	body, body_length, body_truncated = _read_body(req, body_limit)
+	metrics.observe('whinbox_item_body_bytes', '', len(body))
+	if body_truncated and body_oversize == 'reject':
+		return (HttpResponse('Payload Too Large\n', status=413), None)
+
+	item = _req_to_item(req, body, body_length, body_truncated)
+	if hub_challenge:
+		item['type'] = 'hub-verify'
+	else:
+		item['type'] = 'normal'
+
+	if 'body-size' not in item:
+		body = None
+
+	# rendered once, for storage and for the payloads below
+	item['_fields'] = backend.render_item_fields(item)
+
+	return (None, _Hit(item, body, respond_now, hub_challenge))
+
+# announce the stored item
+def _publish_hit(inbox_id, hit, item_id, prev_id, item_created):
+	hit.item['id'] = item_id
+	hit.item['created'] = item_created
+	item_json = _item_json(hit.item, hit.respond_now)
+	publish_item(grip_prefix + 'inbox-%s' % inbox_id, item_json, item_id, prev_id, _items_formats)
 
+# wait_timeout is the inbox's, if set. the request was added as pending
+#   unless responding now
+def _hit_response(req, inbox_id, hit, wait_timeout):
+	if hit.respond_now:
+		if hit.hub_challenge:
+			return HttpResponse(hit.hub_challenge)
+		else:
+			return HttpResponse('Ok\n')
+	else:
+		# wait for the user to respond
+		set_hold_longpoll(req, Channel(grip_prefix + 'wait-%s-%s' % (inbox_id, hit.item['id']), '0'), timeout=_hold_timeout(wait_timeout))
+		return HttpResponse('Service Unavailable\n', status=503, content_type='text/html')
+
+# return (error response, None), or (None, (item_id, item_max, order))
+def _parse_items(req):
+	order = req.GET.get('order')
+	if order and order not in ('created', '-created'):
+		return (HttpResponseBadRequest('Bad Request: Invalid order value\n'), None)
+
+	if not order:
+		order = 'created'
+
+	imax = req.GET.get('max')
+	if imax:
 		try:
-			inbox_id = db.inbox_create(inbox_id, ttl, response_mode)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectExists:
-			return HttpResponse('Conflict: Inbox already exists\n', status=409)
+			imax = int(imax)
+			if imax < 1:
+				raise ValueError('max too small')
 		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+			return (HttpResponseBadRequest('Bad Request: Invalid max value\n'), None)
+
+	if not imax or imax > 50:
+		imax = 50
+
+	since = req.GET.get('since')
+	since_id = None
+	since_cursor = None
+	if since:
+		if since.startswith('id:'):
+			since_id = since[3:]
+		elif since.startswith('cursor:'):
+			since_cursor = since[7:]
+		else:
+			return (HttpResponseBadRequest('Bad Request: Invalid since value\n'), None)
+
+	# at the moment, cursor is identical to id
+	item_id = None
+	if since_id:
+		item_id = since_id
+	elif since_cursor:
+		item_id = since_cursor
+
+	return (None, (item_id, imax, order))
+
+# result is what inbox_read_items returned
+def _items_response(req, inbox_id, order, result):
+	items, last_id, eof, pending = result
+	last_cursor = None
+	if order == 'created':
+		last_cursor = last_id
+	elif not eof and last_id:
+		last_cursor = last_id
+	out_items = list()
+	for i in items:
+		out_items.append(_item_json(i, i['id'] not in pending))
+
+	if order == 'created' and len(out_items) == 0:
+		set_hold_longpoll(req, Channel(grip_prefix + 'inbox-%s' % inbox_id, last_id))
+
+	return HttpResponse(_items_json(out_items, last_cursor) + '\n', content_type='application/json')
+
+def _stream_response(req, inbox_id):
+	set_hold_stream(req, grip_prefix + 'inbox-%s' % inbox_id)
+	return HttpResponse('[opened]\n', content_type='text/plain')
 
-		out = dict()
-		out['id'] = inbox_id
-		out['base_url'] = 'http://' + host + '/i/' + inbox_id + '/'
-		out['ttl'] = ttl
-		out['response_mode'] = response_mode
-		return HttpResponse(json.dumps(out) + '\n', content_type='application/json')
+def create(req):
+	if req.method == 'POST':
+		error, args = _parse_create(req)
+		if error is not None:
+			return error
+
+		try:
+			args['id'] = db.inbox_create(args['id'], args['ttl'], args['response_mode'], args['body_max'], args['wait_timeout'])
+		except Exception as e:
+			return _backend_error(e)
+
+		return _inbox_response(req, args['id'], args)
 	else:
 		return HttpResponseNotAllowed(['POST'])
 
@@ -171,31 +514,15 @@ def inbox(req, inbox_id):
 
 		try:
 			inbox = db.inbox_get(inbox_id)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectDoesNotExist:
-			return HttpResponseNotFound('Not Found\n')
-		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+		except Exception as e:
+			return _backend_error(e)
 
-		out = dict()
-		out['id'] = inbox_id
-		out['base_url'] = 'http://' + host + '/i/' + inbox_id + '/'
-		out['ttl'] = inbox['ttl']
-		response_mode = inbox.get('response_mode')
-		if not response_mode:
-			response_mode = 'auto'
-		out['response_mode'] = response_mode
-		return HttpResponse(json.dumps(out) + '\n', content_type='application/json')
+		return _inbox_response(req, inbox_id, inbox)
 	elif req.method == 'DELETE':
 		try:
 			db.inbox_delete(inbox_id)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectDoesNotExist:
-			return HttpResponseNotFound('Not Found\n')
-		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+		except Exception as e:
+			return _backend_error(e)
 
 		# we'll push a 404 to any long polls because we're that cool
 		publish(grip_prefix + 'inbox-%s' % inbox_id, HttpResponseFormat(code=404, headers={'Content-Type': 'text/html'}, body='Not Found\n'))
@@ -212,12 +539,8 @@ def refresh(req, inbox_id):
 
 		try:
 			db.inbox_refresh(inbox_id, ttl)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectDoesNotExist:
-			return HttpResponseNotFound('Not Found\n')
-		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+		except Exception as e:
+			return _backend_error(e)
 
 		return HttpResponse('Refreshed\n')
 	else:
@@ -225,220 +548,82 @@ def refresh(req, inbox_id):
 
 def respond(req, inbox_id, item_id):
 	if req.method == 'POST':
-		try:
-			content = json.loads(req.body)
-		except:
-			return HttpResponseBadRequest('Bad Request: Body must be valid JSON\n')
-
-		try:
-			code = content.get('code')
-			if code is not None:
-				code = int(code)
-			else:
-				code = 200
-
-			reason = content.get('reason')
-			headers = content.get('headers')
-
-			if 'body-bin' in content:
-				body = b64decode(content['body-bin'])
-			elif 'body' in content:
-				body = content['body']
-			else:
-				body = ''
-		except:
-			return HttpResponseBadRequest('Bad Request: Bad format of response\n')
+		error, format = _parse_respond(req)
+		if error is not None:
+			return error
 
 		try:
 			db.request_remove_pending(inbox_id, item_id)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectDoesNotExist:
-			return HttpResponseNotFound('Not Found\n')
-		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+		except Exception as e:
+			return _backend_error(e)
 
-		publish(grip_prefix + 'wait-%s-%s' % (inbox_id, item_id), HttpResponseFormat(code=code, reason=reason, headers=headers, body=body), id='1', prev_id='0')
+		_publish_response(inbox_id, item_id, format)
 
 		return HttpResponse('Ok\n')
 	else:
 		return HttpResponseNotAllowed(['POST'])
 
 def hit(req, inbox_id):
-	if len(req.grip.last) > 0:
-		for channel, last_id in req.grip.last.items():
-			break
-		set_hold_longpoll(req, Channel(channel, last_id))
-		return HttpResponse('Service Unavailable\n', status=503, content_type='text/html')
+	resp = _hit_retry(req)
+	if resp is not None:
+		return resp
 
 	try:
 		inbox = db.inbox_get(inbox_id)
-	except redis_ops.InvalidId:
-		return HttpResponseBadRequest('Bad Request: Invalid id\n')
-	except redis_ops.ObjectDoesNotExist:
-		return HttpResponseNotFound('Not Found\n')
-	except:
-		return HttpResponse('Service Unavailable\n', status=503)
+	except Exception as e:
+		return _backend_error(e)
 
-	response_mode = inbox.get('response_mode')
-	if not response_mode:
-		response_mode = 'auto'
-
-	# pubsubhubbub verify request?
-	hub_challenge = req.GET.get('hub.challenge')
-
-	if response_mode == 'wait' or (response_mode == 'wait-verify' and hub_challenge):
-		respond_now = False
-	else:
-		respond_now = True
-
-	item = _req_to_item(req)
-	if hub_challenge:
-		item['type'] = 'hub-verify'
-	else:
-		item['type'] = 'normal'
+	error, hit = _parse_hit(req, inbox)
+	if error is not None:
+		return error
 
 	try:
-		item_id, prev_id, item_created = db.inbox_append_item(inbox_id, item)
-		db.inbox_clear_expired_items(inbox_id)
-	except redis_ops.InvalidId:
-		return HttpResponseBadRequest('Bad Request: Invalid id\n')
-	except redis_ops.ObjectDoesNotExist:
-		return HttpResponseNotFound('Not Found\n')
-	except:
-		return HttpResponse('Service Unavailable\n', status=503)
+		item_id, prev_id, item_created = db.inbox_ingest_item(inbox_id, hit.item, hit.body)
+	except Exception as e:
+		return _backend_error(e)
 
-	item['id'] = item_id
-	item['created'] = item_created
+	_publish_hit(inbox_id, hit, item_id, prev_id, item_created)
 
-	item = _convert_item(item, respond_now)
+	wait_timeout = inbox.get('wait_timeout')
+	if not hit.respond_now:
+		db.request_add_pending(inbox_id, item_id, wait_timeout)
+	return _hit_response(req, inbox_id, hit, wait_timeout)
 
-	hr_headers = dict()
-	hr_headers['Content-Type'] = 'application/json'
-	hr = dict()
-	hr['last_cursor'] = item_id
-	hr['items'] = [item]
-	hr_body = json.dumps(hr) + '\n'
-	hs_body = json.dumps(item) + '\n'
+def items(req, inbox_id):
+	if req.method == 'GET':
+		error, args = _parse_items(req)
+		if error is not None:
+			return error
+		item_id, imax, order = args
 
-	formats = list()
-	formats.append(HttpResponseFormat(headers=hr_headers, body=hr_body))
-	formats.append(HttpStreamFormat(hs_body))
-	publish(grip_prefix + 'inbox-%s' % inbox_id, formats, id=item_id, prev_id=prev_id)
+		# reading the items also refreshes the inbox
+		try:
+			result = db.inbox_read_items(inbox_id, item_id, imax, reverse=(order == '-created'))
+		except Exception as e:
+			return _backend_error(e)
 
-	if respond_now:
-		if hub_challenge:
-			return HttpResponse(hub_challenge)
-		else:
-			return HttpResponse('Ok\n')
+		return _items_response(req, inbox_id, order, result)
 	else:
-		# wait for the user to respond
-		db.request_add_pending(inbox_id, item_id)
-		set_hold_longpoll(req, Channel(grip_prefix + 'wait-%s-%s' % (inbox_id, item_id), '0'))
-		return HttpResponse('Service Unavailable\n', status=503, content_type='text/html')
+		return HttpResponseNotAllowed(['GET'])
 
-def items(req, inbox_id):
+def stream(req, inbox_id):
 	if req.method == 'GET':
 		try:
-			db.inbox_refresh(inbox_id)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectDoesNotExist:
-			return HttpResponseNotFound('Not Found\n')
-		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+			db.inbox_get(inbox_id)
+		except Exception as e:
+			return _backend_error(e)
 
-		order = req.GET.get('order')
-		if order and order not in ('created', '-created'):
-			return HttpResponseBadRequest('Bad Request: Invalid order value\n')
-
-		if not order:
-			order = 'created'
-
-		imax = req.GET.get('max')
-		if imax:
-			try:
-				imax = int(imax)
-				if imax < 1:
-					raise ValueError('max too small')
-			except:
-				return HttpResponseBadRequest('Bad Request: Invalid max value\n')
-
-		if not imax or imax > 50:
-			imax = 50
-
-		since = req.GET.get('since')
-		since_id = None
-		since_cursor = None
-		if since:
-			if since.startswith('id:'):
-				since_id = since[3:]
-			elif since.startswith('cursor:'):
-				since_cursor = since[7:]
-			else:
-				return HttpResponseBadRequest('Bad Request: Invalid since value\n')
-
-		# at the moment, cursor is identical to id
-		item_id = None
-		if since_id:
-			item_id = since_id
-		elif since_cursor:
-			item_id = since_cursor
-
-		if order == 'created':
-			try:
-				items, last_id = db.inbox_get_items_after(inbox_id, item_id, imax)
-			except redis_ops.InvalidId:
-				return HttpResponseBadRequest('Bad Request: Invalid id\n')
-			except redis_ops.ObjectDoesNotExist:
-				return HttpResponseNotFound('Not Found\n')
-			except:
-				return HttpResponse('Service Unavailable\n', status=503)
-
-			out = dict()
-			out['last_cursor'] = last_id
-			out_items = list()
-			for i in items:
-				out_items.append(_convert_item(i, not db.request_is_pending(inbox_id, i['id'])))
-			out['items'] = out_items
-
-			if len(out_items) == 0:
-				set_hold_longpoll(req, Channel(grip_prefix + 'inbox-%s' % inbox_id, last_id))
-
-			return HttpResponse(json.dumps(out) + '\n', content_type='application/json')
-		else: # -created
-			try:
-				items, last_id, eof = db.inbox_get_items_before(inbox_id, item_id, imax)
-			except redis_ops.InvalidId:
-				return HttpResponseBadRequest('Bad Request: Invalid id\n')
-			except redis_ops.ObjectDoesNotExist:
-				return HttpResponseNotFound('Not Found\n')
-			except:
-				return HttpResponse('Service Unavailable\n', status=503)
-
-			out = dict()
-			if not eof and last_id:
-				out['last_cursor'] = last_id
-			out_items = list()
-			for i in items:
-				out_items.append(_convert_item(i, not db.request_is_pending(inbox_id, i['id'])))
-			out['items'] = out_items
-			return HttpResponse(json.dumps(out) + '\n', content_type='application/json')
+		return _stream_response(req, inbox_id)
 	else:
 		return HttpResponseNotAllowed(['GET'])
 
-def stream(req, inbox_id):
+def item_body(req, inbox_id, item_id):
 	if req.method == 'GET':
 		try:
-			db.inbox_get(inbox_id)
-		except redis_ops.InvalidId:
-			return HttpResponseBadRequest('Bad Request: Invalid id\n')
-		except redis_ops.ObjectDoesNotExist:
-			return HttpResponseNotFound('Not Found\n')
-		except:
-			return HttpResponse('Service Unavailable\n', status=503)
+			body = db.inbox_get_item_body(inbox_id, item_id)
+		except Exception as e:
+			return _backend_error(e)
 
-		set_hold_stream(req, grip_prefix + 'inbox-%s' % inbox_id)
-		return HttpResponse('[opened]\n', content_type='text/plain')
+		return HttpResponse(body, content_type='application/octet-stream')
 	else:
 		return HttpResponseNotAllowed(['GET'])
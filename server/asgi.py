@@ -0,0 +1,31 @@
+"""
+ASGI config for server project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Set WHINBOX_ASYNC_VIEWS=1 to have the api's ingest and polling views run
+natively on the event loop, and WHINBOX_REALTIME=builtin to hold long-polls
+and streams here instead of behind Pushpin.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
+"""
+
+import os
+
+import dotenv
+from django.core.asgi import get_asgi_application
+
+dotenv.read_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
+
+application = get_asgi_application()
+
+from django.conf import settings
+from api.middleware import BodyLimitMiddleware
+
+application = BodyLimitMiddleware(application)
+
+if settings.WHINBOX_REALTIME == 'builtin':
+    from api.realtime import RealtimeMiddleware
+    application = RealtimeMiddleware(application)
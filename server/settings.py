@@ -45,18 +45,26 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django_hosts.middleware.HostsRequestMiddleware',
     'django_grip.GripMiddleware',
+    'api.middleware.OptionsMiddleware',
+    'api.middleware.WebsiteMiddleware',
+    'django_hosts.middleware.HostsResponseMiddleware',
+]
+
+# run by api.middleware.WebsiteMiddleware, for all but api requests
+WEBSITE_MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'api.middleware.OptionsMiddleware',
     #'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django_hosts.middleware.HostsResponseMiddleware',
 ]
 
+# the admin checks look for its middleware in MIDDLEWARE only
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
 ROOT_HOSTCONF = 'server.hosts'
 ROOT_URLCONF = 'server.urls'
 
@@ -168,10 +176,27 @@ if 'REDIS_PORT' in os.environ:
     REDIS_PORT = int(os.environ['REDIS_PORT'])
 if 'REDIS_DB' in os.environ:
     REDIS_DB = int(os.environ['REDIS_DB'])
+REDIS_UNIX_SOCKET_PATH = os.environ.get('REDIS_UNIX_SOCKET_PATH')
+if 'REDIS_MAX_CONNECTIONS' in os.environ:
+    REDIS_MAX_CONNECTIONS = int(os.environ['REDIS_MAX_CONNECTIONS'])
+REDIS_POOL_BLOCKING = (os.environ.get('REDIS_POOL_BLOCKING', '1') == '1')
+if 'REDIS_POOL_TIMEOUT' in os.environ:
+    REDIS_POOL_TIMEOUT = float(os.environ['REDIS_POOL_TIMEOUT'])
+if 'REDIS_SOCKET_TIMEOUT' in os.environ:
+    REDIS_SOCKET_TIMEOUT = float(os.environ['REDIS_SOCKET_TIMEOUT'])
+if 'REDIS_SOCKET_CONNECT_TIMEOUT' in os.environ:
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(os.environ['REDIS_SOCKET_CONNECT_TIMEOUT'])
+if 'REDIS_HEALTH_CHECK_INTERVAL' in os.environ:
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.environ['REDIS_HEALTH_CHECK_INTERVAL'])
 
 from gripcontrol import parse_grip_uri
 
-GRIP_PROXY_REQUIRED = True
+# pushpin, or builtin to hold requests in the asgi workers themselves
+WHINBOX_REALTIME = os.environ.get('WHINBOX_REALTIME', 'pushpin')
+if 'WHINBOX_REALTIME_TIMEOUT' in os.environ:
+    WHINBOX_REALTIME_TIMEOUT = int(os.environ['WHINBOX_REALTIME_TIMEOUT'])
+
+GRIP_PROXY_REQUIRED = (WHINBOX_REALTIME != 'builtin')
 GRIP_URL = os.environ.get('GRIP_URL')
 
 WHINBOX_API_BASE = os.environ.get('WHINBOX_API_BASE')
@@ -184,5 +209,58 @@ if 'WHINBOX_ITEM_BURST_TIME' in os.environ:
 if 'WHINBOX_ITEM_BURST_MAX' in os.environ:
     WHINBOX_ITEM_BURST_MAX = int(os.environ['WHINBOX_ITEM_BURST_MAX'])
 WHINBOX_ORIG_HEADERS = (os.environ.get('WHINBOX_ORIG_HEADERS', '0') == '1')
+if 'WHINBOX_BODY_OFFLOAD_SIZE' in os.environ:
+    WHINBOX_BODY_OFFLOAD_SIZE = int(os.environ['WHINBOX_BODY_OFFLOAD_SIZE'])
+if 'WHINBOX_BODY_MAX_SIZE' in os.environ:
+    WHINBOX_BODY_MAX_SIZE = int(os.environ['WHINBOX_BODY_MAX_SIZE'])
+WHINBOX_BODY_OVERSIZE = os.environ.get('WHINBOX_BODY_OVERSIZE', 'truncate')
+# redis, or memory to keep everything in the api process. memory is only
+#   for a single process (development, tests), and needs no cleanup command
+WHINBOX_BACKEND = os.environ.get('WHINBOX_BACKEND', 'redis')
+WHINBOX_REDIS_SCRIPTS = (os.environ.get('WHINBOX_REDIS_SCRIPTS', '1') == '1')
+WHINBOX_REDIS_STORAGE = os.environ.get('WHINBOX_REDIS_STORAGE', 'list')
+WHINBOX_REDIS_KEY_TTL = (os.environ.get('WHINBOX_REDIS_KEY_TTL', '0') == '1')
+WHINBOX_ITEM_ENCODING = os.environ.get('WHINBOX_ITEM_ENCODING', 'rendered')
+WHINBOX_ASYNC_VIEWS = (os.environ.get('WHINBOX_ASYNC_VIEWS', '0') == '1')
+WHINBOX_METRICS = (os.environ.get('WHINBOX_METRICS', '0') == '1')
+# bearer token that /metrics requires. metrics are recorded without one,
+#   but not served
+WHINBOX_METRICS_TOKEN = os.environ.get('WHINBOX_METRICS_TOKEN')
+if 'WHINBOX_METRICS_FLUSH_INTERVAL' in os.environ:
+    WHINBOX_METRICS_FLUSH_INTERVAL = float(os.environ['WHINBOX_METRICS_FLUSH_INTERVAL'])
+if 'WHINBOX_EXPIRE_BATCH_SIZE' in os.environ:
+    WHINBOX_EXPIRE_BATCH_SIZE = int(os.environ['WHINBOX_EXPIRE_BATCH_SIZE'])
+if 'WHINBOX_EXPIRE_TIME_BUDGET' in os.environ:
+    WHINBOX_EXPIRE_TIME_BUDGET = float(os.environ['WHINBOX_EXPIRE_TIME_BUDGET'])
+if 'WHINBOX_CLEANUP_IDLE_MAX' in os.environ:
+    WHINBOX_CLEANUP_IDLE_MAX = float(os.environ['WHINBOX_CLEANUP_IDLE_MAX'])
+if 'WHINBOX_CLEANUP_PARTITIONS' in os.environ:
+    WHINBOX_CLEANUP_PARTITIONS = int(os.environ['WHINBOX_CLEANUP_PARTITIONS'])
+if 'WHINBOX_CLEANUP_LEASE_TIME' in os.environ:
+    WHINBOX_CLEANUP_LEASE_TIME = float(os.environ['WHINBOX_CLEANUP_LEASE_TIME'])
+if 'WHINBOX_WAIT_TIMEOUT' in os.environ:
+    WHINBOX_WAIT_TIMEOUT = float(os.environ['WHINBOX_WAIT_TIMEOUT'])
+if 'WHINBOX_CLEANUP_SWEEP_DELAY' in os.environ:
+    WHINBOX_CLEANUP_SWEEP_DELAY = float(os.environ['WHINBOX_CLEANUP_SWEEP_DELAY'])
+if 'WHINBOX_INBOX_CACHE_SIZE' in os.environ:
+    WHINBOX_INBOX_CACHE_SIZE = int(os.environ['WHINBOX_INBOX_CACHE_SIZE'])
+if 'WHINBOX_INBOX_CACHE_TTL' in os.environ:
+    WHINBOX_INBOX_CACHE_TTL = float(os.environ['WHINBOX_INBOX_CACHE_TTL'])
+if 'WHINBOX_REFRESH_FRACTION' in os.environ:
+    WHINBOX_REFRESH_FRACTION = float(os.environ['WHINBOX_REFRESH_FRACTION'])
+if 'WHINBOX_REFRESH_WINDOW' in os.environ:
+    WHINBOX_REFRESH_WINDOW = float(os.environ['WHINBOX_REFRESH_WINDOW'])
+if 'WHINBOX_PUBLISH_QUEUE_MAX' in os.environ:
+    WHINBOX_PUBLISH_QUEUE_MAX = int(os.environ['WHINBOX_PUBLISH_QUEUE_MAX'])
+if 'WHINBOX_PUBLISH_BATCH_MAX' in os.environ:
+    WHINBOX_PUBLISH_BATCH_MAX = int(os.environ['WHINBOX_PUBLISH_BATCH_MAX'])
+if 'WHINBOX_PUBLISH_INTERVAL' in os.environ:
+    WHINBOX_PUBLISH_INTERVAL = float(os.environ['WHINBOX_PUBLISH_INTERVAL'])
+if 'WHINBOX_PUBLISH_RETRY_MAX' in os.environ:
+    WHINBOX_PUBLISH_RETRY_MAX = int(os.environ['WHINBOX_PUBLISH_RETRY_MAX'])
+if 'WHINBOX_PUBLISH_COALESCE_WINDOW' in os.environ:
+    WHINBOX_PUBLISH_COALESCE_WINDOW = float(os.environ['WHINBOX_PUBLISH_COALESCE_WINDOW'])
+if 'WHINBOX_PUBLISH_COALESCE_MAX' in os.environ:
+    WHINBOX_PUBLISH_COALESCE_MAX = int(os.environ['WHINBOX_PUBLISH_COALESCE_MAX'])
 
 GA_ID = os.environ.get('GA_ID')